@@ -1,8 +1,8 @@
 import graphene
-from crm.schema import Query as CRMQuery, Mutation as CRMMutation
+from crm.schema import Query as CRMQuery, Mutation as CRMMutation, Subscription as CRMSubscription
 
 class Query(CRMQuery, graphene.ObjectType):
     hello = graphene.String(default_value="Hello, GraphQL!")
     hi = graphene.String(default_value="hi, GraphQL!")
 
-schema = graphene.Schema(query=Query, mutation=CRMMutation)
\ No newline at end of file
+schema = graphene.Schema(query=Query, mutation=CRMMutation, subscription=CRMSubscription)
\ No newline at end of file
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -51,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'crm.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'alx_backend_graphql_crm.urls'
@@ -126,11 +128,96 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 GRAPHENE = {
-    'SCHEMA': 'alx_backend_graphql_crm.schema.schema'
+    'SCHEMA': 'alx_backend_graphql_crm.schema.schema',
+    # Tags slow queries with the resolver that ran them (crm.slowlog)
+    'MIDDLEWARE': ['crm.slowlog.ResolverPathMiddleware'],
 }
 
+# Maximum operations accepted in one batched POST to /graphql
+GRAPHQL_MAX_BATCH_SIZE = 20
+
 # Django Crontab Configuration
 CRONJOBS = [
     ('*/5 * * * *', 'crm.cron.log_crm_heartbeat'),
 ]
 
+
+# Celery/Redis (async mutations are enqueued from the web process)
+CELERY_BROKER_URL = 'redis://localhost:6379/0'
+CELERY_RESULT_BACKEND = CELERY_BROKER_URL
+CELERY_TIMEZONE = TIME_ZONE
+CELERY_ENABLE_UTC = True
+
+# Where crm.tasks.relay_outbox POSTs batches of outbox events (unset: off)
+CRM_OUTBOX_WEBHOOK_URL = os.environ.get('CRM_OUTBOX_WEBHOOK_URL')
+
+# /readyz and the heartbeat (crm.health): per-check timeout in seconds, how
+# long a result is reused, and the queue depth above which status is degraded
+CRM_HEALTH_TIMEOUT = 1.0
+CRM_HEALTH_CACHE_SECONDS = 5
+CRM_HEALTH_MAX_QUEUE_DEPTH = 1000
+
+# Shared tier of the entity cache (crm.entity_cache), also holding revenue
+# buckets (crm.analytics). Without a redis URL each process gets its own
+# local-memory cache, sized for a few years of daily buckets.
+if os.environ.get('CRM_CACHE_REDIS_URL'):
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['CRM_CACHE_REDIS_URL'],
+    }}
+else:
+    CACHES = {'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }}
+CRM_ENTITY_CACHE_TIMEOUT = 300
+CRM_ENTITY_CACHE_LOCAL_SIZE = 1024
+CRM_ENTITY_CACHE_LOCAL_TTL = 5
+
+# allCustomers/allProducts/allOrders (crm.connections): compiled filters kept
+# per process, how long a totalCount is reused, and where CAPPED counts stop
+CRM_FILTER_CACHE_SIZE = 256
+CRM_COUNT_CACHE_SECONDS = 10
+CRM_COUNT_CAP = 10000
+
+# revenueSeries/topCustomers (crm.analytics): 'sql' groups in the database,
+# 'numpy' (needs numpy installed) in this process from chunks of rows.
+# Closed buckets are cached; a series may span at most MAX_BUCKETS buckets.
+CRM_ANALYTICS_ENGINE = 'sql'
+CRM_ANALYTICS_CHUNK_SIZE = 50000
+CRM_ANALYTICS_CACHE_SECONDS = 24 * 60 * 60
+CRM_ANALYTICS_MAX_BUCKETS = 1000
+
+# adjustStock (crm.stock): how long concurrent adjustments are collected
+# before one batched UPDATE, and the most per batch
+CRM_STOCK_COALESCE_WINDOW = 0.01
+CRM_STOCK_COALESCE_MAX_BATCH = 500
+
+# Statements slower than this many ms are logged with their EXPLAIN and
+# GraphQL resolver (crm.slowlog); None turns it off. Summarize the log with
+# `manage.py crm_slow_queries`.
+CRM_SLOW_QUERY_MS = 100
+CRM_SLOW_QUERY_EXPLAIN = True
+
+# /graphql profiling (crm.profiling), off unless one of the first three is
+# set. Inspect the results with `manage.py crm_profiles`.
+CRM_PROFILE_SAMPLE_RATE = float(os.environ.get('CRM_PROFILE_SAMPLE_RATE', 0))
+CRM_PROFILE_OPERATIONS = [name for name in os.environ.get('CRM_PROFILE_OPERATIONS', '').split(',') if name]
+CRM_PROFILE_TOKEN = os.environ.get('CRM_PROFILE_TOKEN')
+CRM_PROFILE_MODE = 'sample'
+CRM_PROFILE_INTERVAL = 0.005
+CRM_PROFILE_DIR = os.environ.get('CRM_PROFILE_DIR', '/tmp/crm_profiles')
+CRM_PROFILE_KEEP = 50
+
+# GraphQL subscription events are delivered in-process unless this is set;
+# point it at redis so events from every process and Celery worker reach
+# every subscriber.
+CRM_EVENTS_REDIS_URL = os.environ.get('CRM_EVENTS_REDIS_URL')
+
+# Job logs (crm.logsink): JSON lines, rotated by size and age and gzipped.
+# CRM_LOG_DIR moves them all (unset: each job's default /tmp path);
+# CRM_LOG_PATHS = {'heartbeat': ...} sets individual paths.
+CRM_LOG_DIR = os.environ.get('CRM_LOG_DIR')
+CRM_LOG_MAX_BYTES = 10 * 1024 * 1024
+CRM_LOG_ROTATE_SECONDS = 24 * 60 * 60
+CRM_LOG_BACKUP_COUNT = 7
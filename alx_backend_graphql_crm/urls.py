@@ -16,10 +16,13 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from graphene_django.views import GraphQLView
 from django.views.decorators.csrf import csrf_exempt
+from crm import views as crm_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path("graphql", csrf_exempt(GraphQLView.as_view(graphiql=True))),
+    path("graphql", csrf_exempt(crm_views.CRMGraphQLView.as_view(graphiql=True))),
+    path("export/<str:entity>", crm_views.export, name="crm-export"),
+    path("healthz", crm_views.healthz, name="healthz"),
+    path("readyz", crm_views.readyz, name="readyz"),
 ]
@@ -0,0 +1,310 @@
+"""
+Revenue analytics: revenue per day, week or month, optionally per product
+or customer, and the top customers by revenue.
+
+    revenue_series('week', date_from, date_to, group_by='product')
+    # [{'bucket': <Monday 00:00>, 'key': 12, 'revenue': Decimal(...), 'orders': 3}, ...]
+
+Buckets start at midnight in the current time zone (weeks on Monday), and
+`date_from`/`date_to` are widened to whole buckets. Order revenue is
+total_amount; product revenue is quantity * unit_price of the line items.
+Archived orders (crm.archive) are included when the range reaches them.
+
+Engines (CRM_ANALYTICS_ENGINE):
+  sql    GROUP BY in the database (the default)
+  numpy  streams the matching rows in chunks of CRM_ANALYTICS_CHUNK_SIZE
+         into NumPy arrays and groups them in this process, keeping the
+         grouping off a busy database. NumPy is imported on first use and
+         is not a requirement otherwise.
+
+Buckets that have ended are cached (in Django's default cache, for
+CRM_ANALYTICS_CACHE_SECONDS) one bucket per key, so a series over a range
+recomputes only the buckets it has not seen plus the current one. Writes
+to an order dated in a closed bucket drop that bucket: saving or deleting
+the order (crm.signals), editing its line items (Order.add_items,
+recalculate_total, OrderItem.save/delete) and bulk_create_orders(), which
+crm_import uses. Only a raw queryset.update() of orders bypasses this and
+should call invalidate(order_date).
+"""
+
+import calendar
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .archive import reaches_archive
+from .models import ArchivedOrder, ArchivedOrderItem, Order, OrderItem
+
+GRANULARITIES = ('day', 'week', 'month')
+GROUP_BY = (None, 'product', 'customer')
+
+DEFAULT_ENGINE = 'sql'
+DEFAULT_CHUNK_SIZE = 50000
+DEFAULT_CACHE_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_BUCKETS = 1000
+
+CENTS = Decimal('0.01')
+
+logger = logging.getLogger(__name__)
+
+
+# Buckets
+# -------
+
+def bucket_start(moment, granularity):
+    """Start of the bucket containing `moment` (an aware datetime)."""
+    local = timezone.localtime(moment)
+    day = local.date()
+    if granularity == 'week':
+        day -= timedelta(days=day.weekday())
+    elif granularity == 'month':
+        day = day.replace(day=1)
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def next_bucket(start, granularity):
+    day = timezone.localtime(start).date()
+    if granularity == 'day':
+        day += timedelta(days=1)
+    elif granularity == 'week':
+        day += timedelta(days=7)
+    else:
+        day += timedelta(days=calendar.monthrange(day.year, day.month)[1])
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def buckets(granularity, date_from, date_to):
+    """Starts of the buckets covering date_from..date_to, in order."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity: {granularity}")
+    if date_to < date_from:
+        raise ValueError("`to` is before `from`")
+    limit = getattr(settings, 'CRM_ANALYTICS_MAX_BUCKETS', DEFAULT_MAX_BUCKETS)
+    starts = [bucket_start(date_from, granularity)]
+    while True:
+        following = next_bucket(starts[-1], granularity)
+        if following > date_to:
+            return starts
+        if len(starts) >= limit:
+            raise ValueError(f"The range spans more than {limit} {granularity} buckets")
+        starts.append(following)
+
+
+# Engines
+# -------
+# An engine takes (granularity, group_by, start, end) and returns
+# {(bucket, key): [revenue, orders]} for the orders dated start <= d < end,
+# with key None when not grouped.
+
+def _sources(group_by, start):
+    """(model, date field, key field, revenue expression) per table to read."""
+    if group_by == 'product':
+        line_total = ExpressionWrapper(
+            F('quantity') * F('unit_price'), output_field=DecimalField(max_digits=12, decimal_places=2),
+        )
+        tables = [(OrderItem, 'order__order_date', 'product_id', line_total)]
+        if reaches_archive(start):
+            tables.append((ArchivedOrderItem, 'order__order_date', 'product_id', line_total))
+        return tables
+    key = 'customer_id' if group_by == 'customer' else None
+    tables = [(Order, 'order_date', key, F('total_amount'))]
+    if reaches_archive(start):
+        tables.append((ArchivedOrder, 'order_date', key, F('total_amount')))
+    return tables
+
+
+def sql_engine(granularity, group_by, start, end):
+    totals = defaultdict(lambda: [Decimal('0'), 0])
+    for model, date_field, key, revenue in _sources(group_by, start):
+        rows = (
+            model.objects.filter(**{f'{date_field}__gte': start, f'{date_field}__lt': end})
+            .annotate(bucket=Trunc(date_field, granularity))
+            .values('bucket', *([key] if key else []))
+            .annotate(revenue=Sum(revenue), orders=Count('pk'))
+            .order_by()
+        )
+        for row in rows:
+            point = totals[row['bucket'], row[key] if key else None]
+            point[0] += row['revenue'] or 0
+            point[1] += row['orders']
+    return totals
+
+
+def numpy_engine(granularity, group_by, start, end):
+    import numpy as np
+
+    chunk_size = getattr(settings, 'CRM_ANALYTICS_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    cents = defaultdict(int)
+    orders = defaultdict(int)
+
+    def rollup(dates, keys, amounts):
+        # Day numbers in local time -> bucket day numbers
+        days = np.array(dates, dtype='datetime64[D]').astype(np.int64)
+        if granularity == 'week':
+            days -= (days + 3) % 7  # 1970-01-01 was a Thursday
+        elif granularity == 'month':
+            days = days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+        groups, inverse = np.unique(np.stack([days, np.array(keys, dtype=np.int64)]), axis=1, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        summed = np.zeros(groups.shape[1], dtype=np.int64)
+        np.add.at(summed, inverse, np.array(amounts, dtype=np.int64))
+        counted = np.bincount(inverse, minlength=groups.shape[1])
+        for (day, key), total, count in zip(groups.T.tolist(), summed.tolist(), counted.tolist()):
+            cents[day, key] += total
+            orders[day, key] += count
+
+    for model, date_field, key, _ in _sources(group_by, start):
+        fields = [date_field, key or 'pk']
+        fields += ['quantity', 'unit_price'] if group_by == 'product' else ['total_amount']
+        rows = (
+            model.objects.filter(**{f'{date_field}__gte': start, f'{date_field}__lt': end})
+            .order_by().values_list(*fields).iterator(chunk_size=chunk_size)
+        )
+        dates, keys, amounts = [], [], []
+        for row in rows:
+            dates.append(timezone.localtime(row[0]).date())
+            keys.append(row[1] if key else 0)
+            amount = row[2] * row[3] if group_by == 'product' else row[2]
+            amounts.append(int(amount * 100))
+            if len(dates) >= chunk_size:
+                rollup(dates, keys, amounts)
+                dates, keys, amounts = [], [], []
+        if dates:
+            rollup(dates, keys, amounts)
+
+    epoch = datetime(1970, 1, 1).date()
+    return {
+        (
+            timezone.make_aware(datetime.combine(epoch + timedelta(days=day), time.min)),
+            key if group_by else None,
+        ): [(Decimal(total) * CENTS), orders[day, key]]
+        for (day, key), total in cents.items()
+    }
+
+
+ENGINES = {'sql': sql_engine, 'numpy': numpy_engine}
+
+
+# Series
+# ------
+
+def _cache_key(granularity, group_by, start):
+    return f'crm:analytics:{granularity}:{group_by or "total"}:{start.isoformat()}'
+
+
+def revenue_series(granularity, date_from, date_to, group_by=None, engine=None):
+    """
+    Revenue per bucket from date_from to date_to (aware datetimes). Returns
+    [{'bucket', 'key', 'revenue', 'orders'}] ordered by bucket. Ungrouped,
+    there is one point per bucket including empty ones; grouped by
+    'product' or 'customer', one point per key with orders in the bucket.
+    """
+    if group_by not in GROUP_BY:
+        raise ValueError(f"Cannot group revenue by {group_by}")
+    engine = ENGINES[engine or getattr(settings, 'CRM_ANALYTICS_ENGINE', DEFAULT_ENGINE)]
+    starts = buckets(granularity, date_from, date_to)
+    current = bucket_start(timezone.now(), granularity)
+
+    closed = [start for start in starts if start < current]
+    try:
+        cached = cache.get_many([_cache_key(granularity, group_by, start) for start in closed])
+    except Exception:
+        logger.warning("Analytics cache read failed", exc_info=True)
+        cached = {}
+    results = {start: cached.get(_cache_key(granularity, group_by, start)) for start in starts}
+
+    missing = [start for start, points in results.items() if points is None]
+    if missing:
+        # One pass over the span of everything missing; buckets in between
+        # that were cached are simply recomputed
+        totals = engine(granularity, group_by, missing[0], next_bucket(missing[-1], granularity))
+        computed = defaultdict(list)
+        for (start, key), (revenue, orders) in totals.items():
+            computed[start].append((key, revenue, orders))
+        fresh = {}
+        for start in missing:
+            results[start] = sorted(computed.get(start, []), key=lambda point: -point[1])
+            if start < current:
+                fresh[_cache_key(granularity, group_by, start)] = results[start]
+        try:
+            cache.set_many(fresh, getattr(settings, 'CRM_ANALYTICS_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))
+        except Exception:
+            logger.warning("Analytics cache write failed", exc_info=True)
+
+    series = []
+    for start in starts:
+        points = results[start]
+        if group_by is None and not points:
+            points = [(None, Decimal('0'), 0)]
+        series.extend(
+            {'bucket': start, 'key': key, 'revenue': Decimal(revenue).quantize(CENTS), 'orders': orders}
+            for key, revenue, orders in points
+        )
+    return series
+
+
+def top_customers(limit=10, date_from=None, date_to=None):
+    """
+    The `limit` customers with the highest revenue from orders dated
+    date_from..date_to (either may be None), as
+    [{'customer_id', 'revenue', 'orders'}], highest first.
+    """
+    filters = {}
+    if date_from is not None:
+        filters['order_date__gte'] = date_from
+    if date_to is not None:
+        filters['order_date__lte'] = date_to
+
+    def grouped(model):
+        return (
+            model.objects.filter(**filters).values('customer_id')
+            .annotate(revenue=Sum('total_amount'), orders=Count('pk'))
+            .order_by('-revenue', 'customer_id')
+        )
+
+    if not reaches_archive(date_from):
+        rows = list(grouped(Order)[:limit])
+    else:
+        # Per-customer sums from each table, combined here
+        totals = defaultdict(lambda: {'revenue': Decimal('0'), 'orders': 0})
+        for model in (Order, ArchivedOrder):
+            for row in grouped(model):
+                totals[row['customer_id']]['revenue'] += row['revenue']
+                totals[row['customer_id']]['orders'] += row['orders']
+        rows = sorted(
+            ({'customer_id': pk, **total} for pk, total in totals.items()),
+            key=lambda row: (-row['revenue'], row['customer_id']),
+        )[:limit]
+    for row in rows:
+        row['revenue'] = Decimal(row['revenue']).quantize(CENTS)
+    return rows
+
+
+def invalidate(*order_dates):
+    """Drop cached buckets containing any of `order_dates`, now and when the transaction commits."""
+    # Only closed buckets are cached, and today's buckets are all open
+    today = bucket_start(timezone.now(), 'day')
+    days = {bucket_start(date, 'day') for date in order_dates if date is not None and date < today}
+    if not days:
+        return
+    keys = list({
+        _cache_key(granularity, group_by, bucket_start(day, granularity))
+        for day in days for granularity in GRANULARITIES for group_by in GROUP_BY
+    })
+
+    def drop():
+        try:
+            cache.delete_many(keys)
+        except Exception:
+            logger.warning("Analytics cache invalidation failed", exc_info=True)
+
+    drop()
+    transaction.on_commit(drop)
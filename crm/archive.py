@@ -0,0 +1,149 @@
+"""
+Archive of historical orders.
+
+archive_orders() (the archive_orders management command) moves orders
+placed before a cutoff, with their line items, from crm_order and
+crm_order_products into crm_archivedorder and crm_archivedorderitem. It
+works in batches, one transaction each, so an interrupted run leaves every
+order in exactly one place. Each customer's archived count, value and
+latest date are added to CustomerArchiveSummary, which keeps
+Customer.with_order_summary() and the order summary loader exact without
+scanning the archive.
+
+Moving an order is not a change to it, so nothing is written to the
+outbox; archived orders are read-only. The raw deletes send no signals,
+so each batch itself invalidates the connection counts (crm.counts) and
+the cached entries (crm.entity_cache) of the customers it touched.
+
+Reads: the allOrders connection (crm.connections.OrderHistoryConnectionField)
+only looks at the archive when the orderDate_Gte filter reaches back to
+watermark(), the newest archived order date. Otherwise it reads the hot
+table alone, exactly as before.
+"""
+
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Sum, Value
+from django.utils import timezone
+
+from . import counts, entity_cache
+from .models import ArchivedOrder, ArchivedOrderItem, CustomerArchiveSummary, Order, OrderItem
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def watermark():
+    """order_date of the newest archived order (None if nothing is archived)."""
+    return ArchivedOrder.objects.aggregate(latest=Max('order_date'))['latest']
+
+
+def reaches_archive(date_from):
+    """Whether orders on or after `date_from` (a date, or None for no lower bound) may be archived."""
+    latest = watermark()
+    if latest is None:
+        return False
+    if date_from is None:
+        return True
+    if isinstance(date_from, datetime):
+        return date_from <= latest
+    return date_from <= timezone.localtime(latest).date()
+
+
+def _archive_batch(order_ids):
+    orders = list(Order.objects.filter(pk__in=order_ids).values('id', 'customer_id', 'order_date', 'total_amount'))
+    items = list(OrderItem.objects.filter(order_id__in=order_ids).values('order_id', 'product_id', 'quantity', 'unit_price'))
+
+    ArchivedOrder.objects.bulk_create([ArchivedOrder(**order) for order in orders])
+    ArchivedOrderItem.objects.bulk_create([ArchivedOrderItem(**item) for item in items])
+
+    per_customer = (
+        Order.objects.filter(pk__in=order_ids).values('customer_id')
+        .annotate(count=Count('id'), value=Sum('total_amount'), latest=Max('order_date'))
+    )
+    for row in per_customer:
+        summary, created = CustomerArchiveSummary.objects.get_or_create(
+            customer_id=row['customer_id'],
+            defaults={'order_count': row['count'], 'lifetime_value': row['value'], 'last_order_date': row['latest']},
+        )
+        if not created:
+            CustomerArchiveSummary.objects.filter(pk=summary.pk).update(
+                order_count=F('order_count') + row['count'],
+                lifetime_value=F('lifetime_value') + row['value'],
+            )
+            if summary.last_order_date is None or row['latest'] > summary.last_order_date:
+                CustomerArchiveSummary.objects.filter(pk=summary.pk).update(last_order_date=row['latest'])
+
+    # Raw deletes: the rows still exist (in the archive), so the delete
+    # signals (outbox DELETED events, cascades through the collector) must
+    # not fire.
+    OrderItem.objects.filter(order_id__in=order_ids)._raw_delete(OrderItem.objects.db)
+    Order.objects.filter(pk__in=order_ids)._raw_delete(Order.objects.db)
+
+    counts.invalidate()
+    customer_ids = [row['customer_id'] for row in per_customer]
+    entity_cache.customers.invalidate(pks=customer_ids)
+    transaction.on_commit(lambda: entity_cache.customers.invalidate(pks=customer_ids))
+    return len(orders), len(items)
+
+
+def archive_orders(before, batch_size=DEFAULT_BATCH_SIZE, max_batches=None, on_batch=None):
+    """
+    Move orders with order_date < `before` into the archive, `batch_size`
+    orders per transaction. `on_batch(orders, items)` is called after
+    each committed batch. Returns (orders, items) moved in total.
+    """
+    moved_orders = moved_items = batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            order_ids = list(
+                Order.objects.filter(order_date__lt=before).order_by('pk')
+                .select_for_update().values_list('pk', flat=True)[:batch_size]
+            )
+            if not order_ids:
+                break
+            orders, items = _archive_batch(order_ids)
+        moved_orders += orders
+        moved_items += items
+        batches += 1
+        if on_batch:
+            on_batch(orders, items)
+    return moved_orders, moved_items
+
+
+class OrderHistory:
+    """
+    Hot and archived orders matching the same filters, seen as one list
+    ordered by id. Slicing runs a UNION ALL of the ids of both sides with
+    ORDER BY/LIMIT, then loads the page's orders from each table through
+    `prepare` (OrderType.get_queryset), which adds the joins and prefetches.
+    """
+
+    def __init__(self, hot, archived, prepare):
+        self.hot = hot
+        self.archived = archived
+        self.prepare = prepare
+
+    def _ids(self):
+        hot = self.hot.order_by().values_list('id', Value(False))
+        archived = self.archived.order_by().values_list('id', Value(True))
+        return hot.union(archived, all=True).order_by('id')
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        rows = list(self._ids()[key])
+        hot_ids = [pk for pk, is_archived in rows if not is_archived]
+        archived_ids = [pk for pk, is_archived in rows if is_archived]
+        loaded = {}
+        if hot_ids:
+            loaded.update((o.pk, o) for o in self.prepare(Order.objects.filter(pk__in=hot_ids)))
+        if archived_ids:
+            loaded.update((o.pk, o) for o in self.prepare(ArchivedOrder.objects.filter(pk__in=archived_ids)))
+        return [loaded[pk] for pk, _ in rows if pk in loaded]
+
+    def count(self):
+        return self.hot.count() + self.archived.count()
+
+    def __len__(self):
+        return self.count()
@@ -0,0 +1,292 @@
+"""
+Benchmarks for the GraphQL API and the CRM jobs.
+
+Each benchmark is a `run(state)` callable, optionally paired with an
+untimed `setup(state)` that runs before every iteration. run_benchmarks()
+times them against whatever database is active and records latency
+percentiles, throughput (`ops` operations per run, per second), SQL query
+counts and peak Python memory; see the crm_benchmark management command,
+which seeds a throwaway database first.
+"""
+
+import itertools
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import logsink
+from .models import Customer, Product
+
+BENCHMARKS = {}
+
+
+def benchmark(name, setup=None, ops=1):
+    def register(run):
+        BENCHMARKS[name] = (setup, run, ops)
+        return run
+    return register
+
+
+def execute(query, variables=None):
+    """Run a GraphQL document against the project schema with a fresh request."""
+    from alx_backend_graphql_crm.schema import schema
+
+    request = RequestFactory().post('/graphql')
+    result = schema.execute(query, variable_values=variables, context_value=request)
+    if result.errors:
+        raise RuntimeError(f"GraphQL errors: {result.errors}")
+    return result.data
+
+
+ALL_ORDERS_NESTED = '''
+query {
+  allOrders(first: 50) {
+    edges { node {
+      id orderDate totalAmount
+      customer { name email }
+      products { edges { node { name price } } }
+    } }
+  }
+}
+'''
+
+ALL_PRODUCTS_FILTERED = '''
+query {
+  allProducts(lowStock: true, price_Gte: 5, first: 50) {
+    edges { node { id name price stock } }
+  }
+}
+'''
+
+CREATE_ORDER = '''
+mutation($customerId: ID!, $productId: ID!) {
+  createOrder(customerId: $customerId, items: [{productId: $productId, quantity: 1}]) {
+    order { id totalAmount }
+  }
+}
+'''
+
+BULK_CREATE_CUSTOMERS = '''
+mutation($input: [CustomerInput]!) {
+  bulkCreateCustomers(input: $input) { customers { id } errors }
+}
+'''
+
+UPDATE_LOW_STOCK = '''
+mutation { updateLowStockProducts { updatedProducts { id name stock } success message } }
+'''
+
+
+@benchmark('all_orders_nested')
+def all_orders_nested(state):
+    execute(ALL_ORDERS_NESTED)
+
+
+@benchmark('all_products_filtered')
+def all_products_filtered(state):
+    execute(ALL_PRODUCTS_FILTERED)
+
+
+@benchmark('create_order')
+def create_order(state):
+    execute(CREATE_ORDER, {
+        'customerId': state['rng'].choice(state['customer_ids']),
+        'productId': state['rng'].choice(state['in_stock_ids']),
+    })
+
+
+CONCURRENT_CLIENTS = 8
+ORDERS_PER_CLIENT = 5
+
+
+# Clients place their orders at the same time, each on its own thread and
+# database connection. Its throughput is concurrent orders per second; its
+# query count only covers this thread, so it reads 0. SQLite reports writer
+# contention as "database (table) is locked", and clients retry on it.
+@benchmark('create_order_concurrent', ops=CONCURRENT_CLIENTS * ORDERS_PER_CLIENT)
+def create_order_concurrent(state):
+    rng = state['rng']
+    clients = [
+        [(rng.choice(state['customer_ids']), rng.choice(state['in_stock_ids'])) for _ in range(ORDERS_PER_CLIENT)]
+        for _ in range(CONCURRENT_CLIENTS)
+    ]
+    errors = []
+
+    def place(orders):
+        try:
+            for customer_id, product_id in orders:
+                for attempt in itertools.count():
+                    try:
+                        execute(CREATE_ORDER, {'customerId': customer_id, 'productId': product_id})
+                        break
+                    except RuntimeError as e:
+                        if 'locked' not in str(e) or attempt >= 1000:
+                            raise
+                        time.sleep(0.001)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=place, args=(orders,)) for orders in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+@benchmark('bulk_create_customers')
+def bulk_create_customers(state):
+    batch = next(state['batches'])
+    execute(BULK_CREATE_CUSTOMERS, {'input': [
+        {'name': f'Bench {batch}-{i}', 'email': f'bench{batch}-{i}@example.com'}
+        for i in range(100)
+    ]})
+
+
+@benchmark('generate_crm_report')
+def generate_crm_report(state):
+    from . import tasks
+
+    with mock.patch.object(tasks, 'LOG_PATH', state['log_path']):
+        tasks.generate_crm_report()
+
+
+REVENUE_BY_PRODUCT = '''
+query($from: DateTime!) {
+  revenueSeries(granularity: WEEK, from: $from, groupBy: PRODUCT) { bucket key revenue orders }
+}
+'''
+
+
+def _clear_cache(state):
+    cache.clear()
+
+
+# Cold: every bucket computed from the orders (warm runs only read the cache)
+@benchmark('revenue_by_product', setup=_clear_cache)
+def revenue_by_product(state):
+    execute(REVENUE_BY_PRODUCT, {'from': (timezone.now() - timedelta(days=365)).isoformat()})
+
+
+def _restore_low_stock(state):
+    Product.objects.filter(pk__in=state['low_stock_ids']).update(stock=5)
+
+
+# crm.cron.update_low_stock sends this mutation over HTTP; the benchmark
+# runs the same mutation in-process so it measures the server-side work.
+@benchmark('update_low_stock', setup=_restore_low_stock)
+def update_low_stock(state):
+    execute(UPDATE_LOW_STOCK)
+
+
+def _percentiles(samples):
+    if len(samples) < 2:
+        value = samples[0] if samples else 0.0
+        return {'p50': value, 'p90': value, 'p95': value, 'p99': value}
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {'p50': cuts[49], 'p90': cuts[89], 'p95': cuts[94], 'p99': cuts[98]}
+
+
+def _measure(setup, run, ops, state, iterations, warmup):
+    latencies, queries = [], []
+    for i in range(warmup + iterations):
+        if setup:
+            setup(state)
+        with CaptureQueriesContext(connection) as ctx:
+            started = time.perf_counter()
+            run(state)
+            elapsed = time.perf_counter() - started
+        if i >= warmup:
+            latencies.append(elapsed * 1000)
+            queries.append(len(ctx.captured_queries))
+
+    # Memory is traced on a separate run so tracing overhead does not
+    # skew the latencies.
+    if setup:
+        setup(state)
+    tracemalloc.start()
+    try:
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'latency_ms': dict(
+            _percentiles(latencies),
+            mean=statistics.fmean(latencies),
+            min=min(latencies),
+            max=max(latencies),
+        ),
+        'ops_per_s': round(ops * 1000 / statistics.fmean(latencies), 1),
+        'queries': {'min': min(queries), 'median': statistics.median(queries), 'max': max(queries)},
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(names=None, iterations=20, warmup=2, random_seed=0):
+    """Run the named benchmarks (all by default) and return their results."""
+    names = names or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    fd, log_path = tempfile.mkstemp(prefix='crm_bench_', suffix='.log')
+    os.close(fd)
+    state = {
+        'rng': random.Random(random_seed),
+        'customer_ids': list(Customer.objects.values_list('pk', flat=True)),
+        'in_stock_ids': list(Product.objects.filter(stock__gte=100).values_list('pk', flat=True)),
+        'low_stock_ids': list(Product.objects.filter(stock__lt=10).values_list('pk', flat=True)),
+        'batches': itertools.count(),
+        'log_path': log_path,
+    }
+    try:
+        results = {}
+        for name in names:
+            setup, run, ops = BENCHMARKS[name]
+            results[name] = _measure(setup, run, ops, state, iterations, warmup)
+        return results
+    finally:
+        logsink.shutdown()
+        os.remove(log_path)
+
+
+def compare(current, baseline):
+    """
+    Yield (benchmark, metric, baseline value, current value, % change) for the
+    headline metrics of every benchmark present in both result sets. Higher
+    is better only for ops/s.
+    """
+    for name, result in current['benchmarks'].items():
+        before = baseline.get('benchmarks', {}).get(name)
+        if not before:
+            continue
+        for metric, get in (
+            ('p50 ms', lambda r: r['latency_ms']['p50']),
+            ('p95 ms', lambda r: r['latency_ms']['p95']),
+            ('ops/s', lambda r: r.get('ops_per_s')),  # not in older baselines
+            ('queries', lambda r: r['queries']['max']),
+            ('peak KB', lambda r: r['peak_memory_kb']),
+        ):
+            old, new = get(before), get(result)
+            if old is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            yield name, metric, old, new, change
@@ -0,0 +1,349 @@
+"""
+Connection field and connection type for the allCustomers, allProducts and
+allOrders connections.
+
+CachedFilterConnectionField differs from DjangoFilterConnectionField in
+these ways:
+
+* Filter compilation is cached. The FilterSet is built, validated and
+  applied once per distinct combination of filter arguments (including
+  orderBy). The filtered queryset is kept in a per-process LRU
+  (CRM_FILTER_CACHE_SIZE entries), and later requests clone its query
+  instead of redoing the form validation and the filter chain.
+* Pages are read without counting. Forward pagination (first/after)
+  fetches one row more than requested to fill hasNextPage, so no COUNT(*)
+  runs unless asked for. Backward pagination (last) still counts, because
+  it needs the end of the list.
+* totalCount is opt-in. It is only computed when selected, and the count
+  is cached for CRM_COUNT_CACHE_SECONDS in Django's cache, keyed on the
+  counted SQL and the crm.counts version. Within that window it can lag
+  behind single-row writes; deletes, archiving and bulk imports bump the
+  version, so counts are recomputed after them.
+
+How totalCount is computed is chosen per request with countStrategy:
+
+    EXACT      COUNT(*) over the filtered rows
+    CAPPED     counts at most CRM_COUNT_CAP rows (COUNT over a LIMIT
+               subquery); beyond that totalCount is the cap and
+               totalCountIsExact is false, i.e. "N+"
+    ESTIMATED  the planner's row estimate (EXPLAIN on PostgreSQL) or, on
+               SQLite, the row count ANALYZE recorded in sqlite_stat1 for an
+               unfiltered table; where neither applies, falls back to CAPPED
+
+OrderHistoryConnectionField (allOrders) adds archived orders when the date
+filter reaches back into the archive; see crm.archive.
+
+With deferCount: true the page never waits for the count. totalCount is
+served from the cache when it is there; otherwise it is null, the count
+runs in a background thread, and the next request for the same filters
+picks it up.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import graphene
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Manager, QuerySet
+from graphene.relay.connection import connection_adapter, page_info_adapter
+from graphene.utils.str_converters import to_snake_case
+from graphene_django.filter import DjangoFilterConnectionField
+from graphene_django.filter.fields import convert_enum
+from graphene_django.utils import maybe_queryset
+from graphql_relay import connection_from_array_slice, cursor_to_offset, get_offset_with_default, offset_to_cursor
+
+from . import counts
+from .archive import OrderHistory, reaches_archive
+from .models import ArchivedOrder
+
+DEFAULT_FILTER_CACHE_SIZE = 256
+DEFAULT_COUNT_CACHE_SECONDS = 10
+DEFAULT_COUNT_CAP = 10000
+
+_compiled = OrderedDict()  # (filterset class, model, normalized args) -> (queryset, cleaned data)
+_compiled_lock = threading.Lock()
+
+_pending_counts = set()
+_pending_lock = threading.Lock()
+_count_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='crm-count')
+
+
+class CountStrategy(graphene.Enum):
+    EXACT = 'exact'
+    CAPPED = 'capped'
+    ESTIMATED = 'estimated'
+
+
+def _exact(queryset, cap):
+    return queryset.count(), True
+
+
+def _capped(queryset, cap):
+    # COUNT(*) over a LIMIT subquery stops reading after cap + 1 rows
+    count = queryset.order_by()[:cap + 1].count()
+    return (cap, False) if count > cap else (count, True)
+
+
+def _estimate(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    if connection.vendor == 'sqlite' and not queryset.query.where and not queryset.query.distinct:
+        # sqlite_stat1 holds per-table (and per-index) row counts after ANALYZE
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s', [queryset.model._meta.db_table])
+            counts = [int(row[0].split()[0]) for row in cursor.fetchall()]
+        return max(counts) if counts else None
+    return None
+
+
+def _estimated(queryset, cap):
+    estimate = _estimate(queryset)
+    if estimate is None:
+        return _capped(queryset, cap)
+    return estimate, False
+
+
+_COUNTERS = {
+    CountStrategy.EXACT.value: _exact,
+    CountStrategy.CAPPED.value: _capped,
+    CountStrategy.ESTIMATED.value: _estimated,
+}
+
+
+def _count_key(queryset, strategy, cap):
+    sql, params = queryset.order_by().query.sql_with_params()
+    digest = hashlib.md5(repr((sql, params, strategy, cap)).encode()).hexdigest()
+    return f'crm:count:{counts.version()}:{digest}'
+
+
+def _count_and_store(queryset, strategy, cap, key):
+    result = _COUNTERS[strategy](queryset, cap)
+    cache.set(key, result, getattr(settings, 'CRM_COUNT_CACHE_SECONDS', DEFAULT_COUNT_CACHE_SECONDS))
+    return result
+
+
+def _count_in_background(queryset, strategy, cap, key):
+    try:
+        _count_and_store(queryset, strategy, cap, key)
+    finally:
+        with _pending_lock:
+            _pending_counts.discard(key)
+        connections.close_all()
+
+
+def count_queryset(queryset, strategy=CountStrategy.EXACT.value, cap=None, defer=False):
+    """
+    Return (count, exact) for `queryset` with the given strategy, cached
+    for CRM_COUNT_CACHE_SECONDS per distinct SQL or until
+    crm.counts.invalidate() is called. With defer=True a cache
+    miss returns (None, False) and the count runs in the background.
+    """
+    if cap is None:
+        cap = getattr(settings, 'CRM_COUNT_CAP', DEFAULT_COUNT_CAP)
+    key = _count_key(queryset, strategy, cap)
+    cached = cache.get(key)
+    if cached is not None:
+        return tuple(cached)
+    if not defer:
+        return _count_and_store(queryset, strategy, cap, key)
+    with _pending_lock:
+        if key in _pending_counts:
+            return None, False
+        _pending_counts.add(key)
+    _count_executor.submit(_count_in_background, queryset.all(), strategy, cap, key)
+    return None, False
+
+
+def _combine_counts(parts):
+    if any(count is None for count, _ in parts):
+        return None, False
+    return sum(count for count, _ in parts), all(exact for _, exact in parts)
+
+
+class CountableConnection(graphene.relay.Connection):
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int(description=(
+        "Number of matching rows, computed per countStrategy; may lag recent "
+        "writes by a few seconds. Null while a deferred count is running."
+    ))
+    total_count_is_exact = graphene.Boolean(
+        description="False when totalCount is a cap (read it as \"N+\") or an estimate",
+    )
+
+    def _count(self):
+        if not hasattr(self, '_total_count'):
+            iterable = self.iterable
+            if getattr(self, 'length', None) is not None:
+                # Backward pagination already paid for an exact count
+                self._total_count = (self.length, True)
+            elif isinstance(iterable, (QuerySet, OrderHistory)):
+                strategy = getattr(self, 'count_strategy', CountStrategy.EXACT.value)
+                defer = getattr(self, 'defer_count', False)
+                if isinstance(iterable, OrderHistory):
+                    parts = [count_queryset(qs, strategy=strategy, defer=defer) for qs in (iterable.hot, iterable.archived)]
+                    self._total_count = _combine_counts(parts)
+                else:
+                    self._total_count = count_queryset(iterable, strategy=strategy, defer=defer)
+            else:
+                self._total_count = (len(iterable), True)
+        return self._total_count
+
+    def resolve_total_count(self, info):
+        return self._count()[0]
+
+    def resolve_total_count_is_exact(self, info):
+        count, exact = self._count()
+        return exact if count is not None else None
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class CachedFilterConnectionField(DjangoFilterConnectionField):
+    def __init__(self, type_, *args, count_strategy=CountStrategy.EXACT, **kwargs):
+        kwargs.setdefault('count_strategy', graphene.Argument(
+            CountStrategy, default_value=count_strategy, description="How totalCount is computed",
+        ))
+        kwargs.setdefault('defer_count', graphene.Boolean(
+            default_value=False, description="Don't wait for totalCount; null until counted",
+        ))
+        super().__init__(type_, *args, **kwargs)
+
+    @staticmethod
+    def filter_data(args, filtering_args):
+        data = {}
+        for k, v in args.items():
+            if k in filtering_args:
+                if k == "order_by" and v is not None:
+                    v = to_snake_case(v)
+                data[k] = convert_enum(v)
+        return data
+
+    @staticmethod
+    def compile_filters(filterset_class, data, manager, request):
+        """
+        Return (filtered queryset, cleaned data) for `data` applied to all of
+        `manager`'s rows, from the per-process cache when possible. The
+        queryset is shared: clone it before adding to it.
+        """
+        key = (filterset_class, manager.model, tuple(sorted((k, _freeze(v)) for k, v in data.items() if v is not None)))
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+
+        if key is not None:
+            with _compiled_lock:
+                compiled = _compiled.get(key)
+                if compiled is not None:
+                    _compiled.move_to_end(key)
+                    return compiled
+        filterset = filterset_class(data=data, queryset=manager.all(), request=request)
+        if not filterset.is_valid():
+            raise ValidationError(filterset.form.errors.as_json())
+        compiled = (filterset.qs, filterset.form.cleaned_data)
+        if key is not None:
+            size = getattr(settings, 'CRM_FILTER_CACHE_SIZE', DEFAULT_FILTER_CACHE_SIZE)
+            with _compiled_lock:
+                _compiled[key] = compiled
+                while len(_compiled) > size:
+                    _compiled.popitem(last=False)
+        return compiled
+
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args, filtering_args, filterset_class):
+        # Only the plain manager has a fixed base queryset to compile against;
+        # a custom resolver's queryset goes through the uncached path.
+        if not isinstance(iterable, Manager):
+            return super().resolve_queryset(connection, iterable, info, args, filtering_args, filterset_class)
+        queryset, _ = cls.compile_filters(filterset_class, cls.filter_data(args, filtering_args), iterable, info.context)
+        return connection._meta.node.get_queryset(queryset.all(), info)
+
+    @classmethod
+    def resolve_connection(cls, connection, args, iterable, max_limit=None):
+        strategy = args.pop('count_strategy', None)
+        defer = args.pop('defer_count', False)
+        result = cls._paginate(connection, args, iterable, max_limit)
+        result.count_strategy = getattr(strategy, 'value', strategy) or CountStrategy.EXACT.value
+        result.defer_count = defer
+        return result
+
+    @classmethod
+    def _paginate(cls, connection, args, iterable, max_limit):
+        iterable = maybe_queryset(iterable)
+        if not isinstance(iterable, (QuerySet, OrderHistory)) or args.get("last") is not None:
+            return super().resolve_connection(connection, args, iterable, max_limit=max_limit)
+
+        # Remove the offset parameter and convert it to an after cursor.
+        offset = args.pop("offset", None)
+        after = args.get("after")
+        if offset:
+            if after:
+                offset += cursor_to_offset(after) + 1
+            # input offset starts at 1 while the graphene offset starts at 0
+            args["after"] = offset_to_cursor(offset - 1)
+        if max_limit is not None and args.get("first") is None:
+            args["first"] = max_limit
+
+        slice_start = get_offset_with_default(args.get("after"), -1) + 1
+        page = args.get("first")
+        if page is None:
+            rows = list(iterable[slice_start:])
+        else:
+            # One extra row tells whether there is a next page
+            rows = list(iterable[slice_start:slice_start + page + 1])
+
+        result = connection_from_array_slice(
+            rows,
+            args,
+            slice_start=slice_start,
+            array_length=slice_start + len(rows),
+            array_slice_length=len(rows),
+            connection_type=partial(connection_adapter, connection),
+            edge_type=connection.Edge,
+            page_info_type=page_info_adapter,
+        )
+        result.iterable = iterable
+        return result
+
+
+class OrderHistoryConnectionField(CachedFilterConnectionField):
+    """
+    Orders connection that also reads archived orders (see crm.archive)
+    when the orderDate_Gte filter reaches back to the archive watermark,
+    or when there is no such filter and something is archived.
+    """
+
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args, filtering_args, filterset_class):
+        if not isinstance(iterable, Manager):
+            return super().resolve_queryset(connection, iterable, info, args, filtering_args, filterset_class)
+        data = cls.filter_data(args, filtering_args)
+        hot, cleaned = cls.compile_filters(filterset_class, data, iterable, info.context)
+        node = connection._meta.node
+        if not reaches_archive(cleaned.get('order_date__gte')):
+            return node.get_queryset(hot.all(), info)
+        archived, _ = cls.compile_filters(filterset_class, data, ArchivedOrder.objects, info.context)
+        return OrderHistory(hot.all(), archived.all(), lambda queryset: node.get_queryset(queryset, info))
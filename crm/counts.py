@@ -0,0 +1,34 @@
+"""
+Version of the cached totalCounts (see crm.connections).
+
+Counts are cached for CRM_COUNT_CACHE_SECONDS under keys that include the
+current version, so invalidate() turns every cached count into a miss at
+once, in every process sharing Django's cache. Single-row saves rely on
+the short expiry. Writes that change many rows at once call invalidate():
+deletes (crm.signals), archiving (crm.archive), crm_import and the bulk
+customer mutation and task.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'crm:count:version'
+
+
+def version():
+    """The current count cache version (0 until something invalidates)."""
+    return cache.get(VERSION_KEY, 0)
+
+
+def _bump():
+    # A timestamp rather than a counter: no read-modify-write between processes
+    cache.set(VERSION_KEY, time.time_ns(), None)
+
+
+def invalidate():
+    """Drop every cached count now and again once the current transaction commits."""
+    _bump()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(_bump)
@@ -1,50 +1,49 @@
 """
 Cron jobs for CRM application.
+
+gql (and requests under it) are only imported when a job actually talks to
+the GraphQL endpoint, so loading this module stays cheap. The heartbeat does
+not: it runs the crm.health checks directly.
 """
 
-from datetime import datetime
-from gql import gql, Client
-from gql.transport.requests import RequestsHTTPTransport
+import logging
+
+from .logsink import get_logger
+
+GRAPHQL_URL = "http://localhost:8000/graphql"
+
+# Default log paths; see crm.logsink for overriding them and for rotation
+HEARTBEAT_LOG = "/tmp/crm_heartbeat_log.txt"
+LOW_STOCK_LOG = "/tmp/low_stock_updates_log.txt"
+
+
+def _graphql_client():
+    from gql import Client
+    from gql.transport.requests import RequestsHTTPTransport
+
+    transport = RequestsHTTPTransport(url=GRAPHQL_URL)
+    return Client(transport=transport, fetch_schema_from_transport=False)
 
 
 def log_crm_heartbeat():
     """
-    Log a heartbeat message every 5 minutes to confirm the CRM application's health.
-    Logs to /tmp/crm_heartbeat_log.txt in the format: DD/MM/YYYY-HH:MM:SS CRM is alive
-    Optionally queries the GraphQL hello field to verify the endpoint is responsive.
+    Log a heartbeat every 5 minutes to confirm the CRM application's health.
+    Writes a JSON line with message "CRM is alive" and the same structured
+    status /readyz reports (database, broker, queue depth; see crm.health)
+    to the heartbeat log (/tmp/crm_heartbeat_log.txt by default). The checks
+    run in-process, so no request goes through the GraphQL endpoint.
     """
+    log = get_logger('heartbeat', HEARTBEAT_LOG)
     try:
-        log_file = "/tmp/crm_heartbeat_log.txt"
-        
-        # Format timestamp as DD/MM/YYYY-HH:MM:SS
-        timestamp = datetime.now().strftime("%d/%m/%Y-%H:%M:%S")
-        heartbeat_message = f"{timestamp} CRM is alive"
-        
-        # Try to query GraphQL endpoint for additional verification (optional)
-        try:
-            query = gql("""
-                query {
-                    hello
-                }
-            """)
-            transport = RequestsHTTPTransport(url="http://localhost:8000/graphql")
-            client = Client(transport=transport, fetch_schema_from_transport=False)
-            result = client.execute(query)
-            
-            # If successful, append additional info
-            if result:
-                heartbeat_message += " | GraphQL endpoint responsive"
-        except Exception as graphql_error:
-            # Log heartbeat even if GraphQL query fails
-            heartbeat_message += " | GraphQL endpoint unreachable"
-        
-        # Append to log file (does not overwrite)
-        with open(log_file, "a") as log:
-            log.write(heartbeat_message + "\n")
-        
-        print(f"Heartbeat logged: {heartbeat_message}")
-        
+        from . import health
+
+        result = health.run_checks(use_cache=False)
+        level = logging.INFO if result['status'] == 'ok' else logging.WARNING
+        log.log(level, "CRM is alive", extra={'status': result['status'], 'checks': result['checks']})
+        print(f"Heartbeat logged: CRM is alive | status {result['status']}")
+
     except Exception as e:
+        log.error("Heartbeat failed", extra={'error': str(e)})
         print(f"Error logging CRM heartbeat: {e}")
 
 
@@ -52,9 +51,13 @@ def update_low_stock():
     """
     Cron job that runs every 12 hours.
     Executes the UpdateLowStockProducts GraphQL mutation.
-    Logs updated product names and new stock levels to /tmp/low_stock_updates_log.txt with timestamp.
+    Logs a summary line and one line per updated product (name and new
+    stock level) to the low stock log (/tmp/low_stock_updates_log.txt by default).
     """
+    log = get_logger('low_stock', LOW_STOCK_LOG)
     try:
+        from gql import gql
+
         # GraphQL mutation to update low stock products
         mutation = gql("""
             mutation {
@@ -69,53 +72,28 @@ def update_low_stock():
                 }
             }
         """)
-        
-        # Connect to GraphQL endpoint
-        transport = RequestsHTTPTransport(url="http://localhost:8000/graphql")
-        client = Client(transport=transport, fetch_schema_from_transport=False)
-        
-        # Execute mutation
-        result = client.execute(mutation)
-        
+
+        # Execute mutation against the GraphQL endpoint
+        result = _graphql_client().execute(mutation)
+
         # Extract data
         update_result = result.get('updateLowStockProducts', {})
         updated_products = update_result.get('updatedProducts', [])
         success = update_result.get('success', False)
         message = update_result.get('message', '')
-        
-        # Format timestamp as DD/MM/YYYY-HH:MM:SS
-        timestamp = datetime.now().strftime("%d/%m/%Y-%H:%M:%S")
-        
-        # Prepare log content
-        log_file = "/tmp/low_stock_updates_log.txt"
-        log_entries = [f"\n{'='*60}"]
-        log_entries.append(f"Update Time: {timestamp}")
-        log_entries.append(f"Status: {'SUCCESS' if success else 'FAILED'}")
-        log_entries.append(f"Message: {message}")
-        log_entries.append(f"Total Products Updated: {len(updated_products)}")
-        log_entries.append("="*60)
-        
-        # Log each updated product
-        if updated_products:
-            log_entries.append("Updated Products:")
-            for product in updated_products:
-                log_entries.append(f"  - {product['name']}: New Stock = {product['stock']}")
-        else:
-            log_entries.append("No products were updated")
-        
-        # Write to log file (append mode)
-        with open(log_file, "a", encoding="utf-8") as log:
-            for entry in log_entries:
-                log.write(entry + "\n")
-        
+
+        log.info("Low stock update", extra={
+            'status': 'SUCCESS' if success else 'FAILED',
+            'detail': message,
+            'updated': len(updated_products),
+        })
+        for product in updated_products:
+            log.info("Product restocked", extra={
+                'product_id': product['id'], 'name': product['name'], 'stock': product['stock'],
+            })
+
         print(f"Low stock update logged: {message}")
-        
+
     except Exception as e:
-        # Log the error
-        timestamp = datetime.now().strftime("%d/%m/%Y-%H:%M:%S")
-        log_file = "/tmp/low_stock_updates_log.txt"
-        
-        with open(log_file, "a", encoding="utf-8") as log:
-            log.write(f"\n{timestamp} ERROR: {str(e)}\n")
-        
+        log.error("Low stock update failed", extra={'error': str(e)})
         print(f"Error updating low stock products: {e}")
@@ -8,9 +8,15 @@ from gql import gql, Client
 from gql.transport.requests import RequestsHTTPTransport
 from datetime import datetime, timedelta
 import os
+import sys
+
+# Run as a plain script: make the project importable for the shared log sink
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from crm.logsink import get_logger  # noqa: E402
 
 # GraphQL endpoint
 GRAPHQL_URL = "http://localhost:8000/graphql"
+# Default log path; see crm.logsink for overriding it and for rotation
 LOG_FILE = "/tmp/order_reminders_log.txt"
 
 # GraphQL query to fetch orders from the last 7 days
@@ -65,30 +71,29 @@ def get_orders_from_last_7_days():
         return None
 
 def log_order_reminders(orders_result):
-    """Log order reminders with timestamp to the log file."""
+    """Log one JSON line per order reminder to the reminders log."""
     if not orders_result:
         print("No orders found or error occurred.")
         return
     
     try:
-        with open(LOG_FILE, "a") as log:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            
-            # Extract orders from GraphQL response
-            edges = orders_result.get("allOrders", {}).get("edges", [])
-            
-            if not edges:
-                log.write(f"[{timestamp}] No orders found for reminders.\n")
-                return
-            
-            # Log each order
-            for edge in edges:
-                node = edge.get("node", {})
-                order_id = node.get("id", "Unknown")
-                customer_email = node.get("customer", {}).get("email", "Unknown")
-                
-                log_entry = f"[{timestamp}] Order ID: {order_id}, Customer Email: {customer_email}\n"
-                log.write(log_entry)
+        log = get_logger('order_reminders', LOG_FILE)
+        
+        # Extract orders from GraphQL response
+        edges = orders_result.get("allOrders", {}).get("edges", [])
+        
+        if not edges:
+            log.info("No orders found for reminders")
+            return
+        
+        # Log each order
+        for edge in edges:
+            node = edge.get("node", {})
+            log.info("Order reminder", extra={
+                'order_id': node.get("id", "Unknown"),
+                'customer_email': (node.get("customer") or {}).get("email", "Unknown"),
+                'order_date': node.get("orderDate"),
+            })
         
         print(f"Logged {len(edges)} order reminders.")
     except Exception as e:
@@ -0,0 +1,246 @@
+"""
+Read-through cache for Customer and Product lookups by primary key, and
+for Customer by email.
+
+    customers.get_many([1, 2])       # {1: <Customer>, 2: <Customer>}
+    customers.get_by('email', email)  # <Customer> or Customer.DoesNotExist
+
+There are two tiers. A per-process LRU (CRM_ENTITY_CACHE_LOCAL_SIZE entries,
+each trusted for CRM_ENTITY_CACHE_LOCAL_TTL seconds) sits in front of
+Django's default cache, which keeps entries for CRM_ENTITY_CACHE_TIMEOUT
+seconds and is shared between processes when it is redis or memcached.
+Whatever both tiers miss is loaded from the database with one query per
+call. The shared cache being down only turns its hits into misses.
+
+Entries hold field values, not instances, and every lookup builds fresh
+model instances, so callers may modify what they get. Fields that change on
+every order (Product.stock) are not cached. They come back deferred and are
+loaded from the database if accessed.
+
+Saves and deletes (see crm.signals) invalidate this process's tier and the
+shared tier at once, and again when the transaction commits, in case a
+reader repopulated the entry from the old row in between. Until the
+transaction ends, rows it wrote are read from the database and never
+cached, so an uncommitted (possibly rolled back) row is not shared. Other
+processes' local tiers catch up within the local TTL. queryset.update() and
+bulk_create() bypass the hooks, like the outbox; call invalidate() after
+changing cached fields that way.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .models import Customer, Product
+
+DEFAULT_LOCAL_SIZE = 1024
+DEFAULT_LOCAL_TTL = 5
+DEFAULT_TIMEOUT = 300
+
+logger = logging.getLogger(__name__)
+
+_written = threading.local()
+
+
+def _written_keys():
+    """
+    Keys invalidated by this thread's open transaction, if there is one.
+    Cleared on commit; after a rollback they are kept (only costing cache
+    hits) until the thread next looks outside a transaction.
+    """
+    if not transaction.get_connection().in_atomic_block or not hasattr(_written, 'keys'):
+        _written.keys = set()
+    return _written.keys
+
+
+class EntityCache:
+    def __init__(self, model, keys=(), exclude=()):
+        self.model = model
+        self.keys = tuple(keys)
+        self.fields = [f.attname for f in model._meta.concrete_fields if f.name not in exclude]
+        self.pk_name = model._meta.pk.attname
+        self.prefix = f'crm:entity:{model._meta.label_lower}'
+        self.stats = Counter()
+        self._local = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    # Keys: values dicts live under the pk key; each secondary key maps a
+    # field value to a pk and is checked against the row it points at.
+
+    def _pk_key(self, pk):
+        return f'{self.prefix}:pk:{pk}'
+
+    def _field_key(self, field, value):
+        digest = hashlib.md5(str(value).encode()).hexdigest()
+        return f'{self.prefix}:{field}:{digest}'
+
+    def _local_get(self, key):
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._local.pop(key, None)
+            return None
+        self._local.move_to_end(key)
+        return entry[1]
+
+    def _local_set(self, entries):
+        size = getattr(settings, 'CRM_ENTITY_CACHE_LOCAL_SIZE', DEFAULT_LOCAL_SIZE)
+        expires = time.monotonic() + getattr(settings, 'CRM_ENTITY_CACHE_LOCAL_TTL', DEFAULT_LOCAL_TTL)
+        with self._lock:
+            for key, value in entries.items():
+                self._local[key] = (expires, value)
+                self._local.move_to_end(key)
+            while len(self._local) > size:
+                self._local.popitem(last=False)
+
+    def _shared_get_many(self, keys):
+        try:
+            return cache.get_many(keys)
+        except Exception:
+            logger.warning("Entity cache read failed", exc_info=True)
+            return {}
+
+    def _shared_set_many(self, entries):
+        try:
+            cache.set_many(entries, getattr(settings, 'CRM_ENTITY_CACHE_TIMEOUT', DEFAULT_TIMEOUT))
+        except Exception:
+            logger.warning("Entity cache write failed", exc_info=True)
+
+    def _build(self, values):
+        return self.model.from_db(DEFAULT_DB_ALIAS, self.fields, [values[f] for f in self.fields])
+
+    def _store(self, rows):
+        entries = {self._pk_key(row[self.pk_name]): row for row in rows}
+        for row in rows:
+            for field in self.keys:
+                entries[self._field_key(field, row[field])] = row[self.pk_name]
+        written = _written_keys()
+        if written:
+            entries = {key: value for key, value in entries.items() if key not in written}
+        self._local_set(entries)
+        self._shared_set_many(entries)
+
+    def get_many(self, pks):
+        """Return {pk: instance} for the pks that exist, like in_bulk()."""
+        pks = {self.model._meta.pk.to_python(pk) for pk in pks}
+        written = _written_keys()
+        found = {}
+        with self._lock:
+            for pk in pks:
+                key = self._pk_key(pk)
+                values = None if key in written else self._local_get(key)
+                if values is not None:
+                    found[pk] = values
+            self.stats['local_hits'] += len(found)
+
+        missing = pks - found.keys()
+        cacheable = {pk for pk in missing if self._pk_key(pk) not in written}
+        if cacheable:
+            shared = self._shared_get_many([self._pk_key(pk) for pk in cacheable])
+            hits = {values[self.pk_name]: values for values in shared.values()}
+            self.stats['shared_hits'] += len(hits)
+            self._local_set(shared)
+            found.update(hits)
+            missing -= hits.keys()
+        if missing:
+            self.stats['misses'] += len(missing)
+            rows = list(self.model._default_manager.filter(pk__in=missing).values(*self.fields))
+            self._store(rows)
+            found.update((row[self.pk_name], row) for row in rows)
+        return {pk: self._build(values) for pk, values in found.items()}
+
+    def get(self, pk):
+        try:
+            return self.get_many([pk])[self.model._meta.pk.to_python(pk)]
+        except (KeyError, ValidationError):
+            raise self.model.DoesNotExist(f"{self.model.__name__} {pk} does not exist") from None
+
+    def get_by(self, field, value):
+        """Return the instance whose unique `field` equals `value`."""
+        if field not in self.keys:
+            raise ValueError(f"{self.model.__name__} is not cached by {field}")
+        key = self._field_key(field, value)
+        with self._lock:
+            pk = None if key in _written_keys() else self._local_get(key)
+        if pk is None and key not in _written_keys():
+            pk = self._shared_get_many([key]).get(key)
+        if pk is not None:
+            # The pk may be stale (value changed or row deleted): trust it
+            # only if the row it points at still has this value.
+            instance = self.get_many([pk]).get(pk)
+            if instance is not None and getattr(instance, field) == value:
+                return instance
+        self.stats['misses'] += 1
+        row = self.model._default_manager.values(*self.fields).get(**{field: value})
+        self._store([row])
+        return self._build(row)
+
+    def keys_for(self, instance):
+        """Every key under which `instance` may be cached."""
+        return [self._pk_key(instance.pk)] + [
+            self._field_key(field, getattr(instance, field)) for field in self.keys
+        ]
+
+    def invalidate(self, pks=(), keys=()):
+        """Drop the given pks (and/or raw keys) from this process's tier and the shared tier."""
+        keys = [self._pk_key(pk) for pk in pks] + list(keys)
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        try:
+            cache.delete_many(keys)
+        except Exception:
+            logger.warning("Entity cache invalidation failed", exc_info=True)
+
+    def clear(self):
+        """Empty this process's tier (the shared tier expires on its own)."""
+        with self._lock:
+            self._local.clear()
+
+    def report(self):
+        hits = self.stats['local_hits'] + self.stats['shared_hits']
+        lookups = hits + self.stats['misses']
+        return {
+            'local_hits': self.stats['local_hits'],
+            'shared_hits': self.stats['shared_hits'],
+            'misses': self.stats['misses'],
+            'hit_rate': round(hits / lookups, 4) if lookups else None,
+            'local_entries': len(self._local),
+        }
+
+
+customers = EntityCache(Customer, keys=('email',))
+products = EntityCache(Product, exclude=('stock',))
+
+_caches = {Customer: customers, Product: products}
+
+
+def invalidate(instance):
+    """Invalidate `instance` now and again once the current transaction commits."""
+    entity_cache = _caches.get(type(instance))
+    if entity_cache is None:
+        return
+    # Computed up front: a deleted instance's pk is cleared after post_delete
+    keys = entity_cache.keys_for(instance)
+    entity_cache.invalidate(keys=keys)
+    if transaction.get_connection().in_atomic_block:
+        _written_keys().update(keys)
+
+    def committed():
+        _written.keys = set()
+        entity_cache.invalidate(keys=keys)
+
+    transaction.on_commit(committed)
+
+
+def stats():
+    """Hit/miss counts for this process, per model."""
+    return {model._meta.label_lower: c.report() for model, c in _caches.items()}
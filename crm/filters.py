@@ -1,5 +1,13 @@
 import django_filters
-from .models import Customer, Product, Order
+from .models import Customer, Product, Order, ORDER_SUMMARY_FIELDS
+
+class OrderSummaryOrderingFilter(django_filters.OrderingFilter):
+    """OrderingFilter that annotates the order summaries before sorting on them."""
+
+    def filter(self, qs, value):
+        if value and any(v.lstrip('-') in ORDER_SUMMARY_FIELDS for v in value):
+            qs = qs.with_order_summary()
+        return super().filter(qs, value)
 
 class CustomerFilter(django_filters.FilterSet):
     name = django_filters.CharFilter(field_name='name', lookup_expr='icontains')
@@ -7,15 +15,31 @@ class CustomerFilter(django_filters.FilterSet):
     created_at__gte = django_filters.DateFilter(field_name='created_at', lookup_expr='gte')
     created_at__lte = django_filters.DateFilter(field_name='created_at', lookup_expr='lte')
     phone_pattern = django_filters.CharFilter(method='filter_phone_pattern')
+    # Order summaries are annotated and filtered in SQL (HAVING), see
+    # CustomerQuerySet.with_order_summary
+    order_count__gte = django_filters.NumberFilter(method='filter_order_summary')
+    order_count__lte = django_filters.NumberFilter(method='filter_order_summary')
+    lifetime_value__gte = django_filters.NumberFilter(method='filter_order_summary')
+    lifetime_value__lte = django_filters.NumberFilter(method='filter_order_summary')
+    last_order_date__gte = django_filters.DateFilter(method='filter_order_summary')
+    last_order_date__lte = django_filters.DateFilter(method='filter_order_summary')
+    order_by = OrderSummaryOrderingFilter(
+        fields=('name', 'email', 'created_at') + ORDER_SUMMARY_FIELDS
+    )
 
     class Meta:
         model = Customer
-        fields = ['name', 'email', 'created_at__gte', 'created_at__lte', 'phone_pattern']
+        fields = ['name', 'email', 'created_at__gte', 'created_at__lte', 'phone_pattern',
+                  'order_count__gte', 'order_count__lte', 'lifetime_value__gte', 'lifetime_value__lte',
+                  'last_order_date__gte', 'last_order_date__lte']
 
     def filter_phone_pattern(self, queryset, name, value):
         # Custom filter for phone number starting with pattern
         return queryset.filter(phone__startswith=value)
 
+    def filter_order_summary(self, queryset, name, value):
+        return queryset.with_order_summary().filter(**{name: value})
+
 class ProductFilter(django_filters.FilterSet):
     name = django_filters.CharFilter(field_name='name', lookup_expr='icontains')
     price__gte = django_filters.NumberFilter(field_name='price', lookup_expr='gte')
@@ -50,4 +74,5 @@ class OrderFilter(django_filters.FilterSet):
         return queryset.filter(products__name__icontains=value).distinct()
 
     def filter_product_id(self, queryset, name, value):
-        return queryset.filter(products__id=value).distinct()
\ No newline at end of file
+        # Only needs the line items table, not a join to crm_product
+        return queryset.filter(items__product_id=value).distinct()
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""
+Health checks behind /healthz, /readyz and the heartbeat cron job.
+
+run_checks() checks the database and the Celery broker concurrently, each
+bounded by CRM_HEALTH_TIMEOUT seconds, and reports the depth of the
+default task queue. Results are cached for CRM_HEALTH_CACHE_SECONDS so
+frequent probes from a load balancer cost one check per process per period.
+
+Each check runs on its own daemon thread. One that hangs past the timeout
+is reported as failed and left to finish; until it does, later probes
+report that check as still running instead of starting another, so a hung
+broker neither piles up threads nor delays the database check.
+
+Overall status:
+  ok        every check passed
+  degraded  the queue is deeper than CRM_HEALTH_MAX_QUEUE_DEPTH (workers are
+            behind, but this process can still serve requests)
+  fail      the database or the broker is unreachable
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_CACHE_SECONDS = 5
+DEFAULT_MAX_QUEUE_DEPTH = 1000
+
+_cache = {'expires': 0.0, 'result': None}
+_lock = threading.Lock()
+_running = {}  # check name -> its thread from an earlier run, possibly hung
+
+
+def check_database():
+    # Runs in its own thread, so it opens (and closes) its own connection:
+    # what is checked is that new connections succeed.
+    try:
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+    finally:
+        connections.close_all()
+    return {}
+
+
+def check_broker(timeout):
+    from kombu import Connection
+
+    queue = getattr(settings, 'CELERY_TASK_DEFAULT_QUEUE', 'celery')
+    with Connection(
+        settings.CELERY_BROKER_URL,
+        connect_timeout=timeout,
+        transport_options={'socket_timeout': timeout, 'socket_connect_timeout': timeout},
+    ) as conn:
+        conn.ensure_connection(max_retries=1, interval_start=0, interval_step=0, timeout=timeout)
+        try:
+            _, depth, _ = conn.default_channel.queue_declare(queue, passive=True)
+        except conn.channel_errors:
+            # The queue is only created once something is published to it
+            depth = 0
+    return {'queue': queue, 'queue_depth': depth}
+
+
+def _timed(check, *args):
+    started = time.perf_counter()
+    try:
+        result = dict(check(*args), status='ok')
+    except Exception as e:
+        result = {'status': 'fail', 'error': f"{type(e).__name__}: {e}"}
+    result['ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def _start(name, check, *args):
+    """Run `check` on a daemon thread; returns (thread, dict filled with its result)."""
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(_timed(check, *args)), name=f'crm-health-{name}', daemon=True,
+    )
+    thread.start()
+    return thread, result
+
+
+def _run(timeout):
+    started = {}
+    checks = {}
+    for name, check, args in [('database', check_database, ()), ('broker', check_broker, (timeout,))]:
+        previous = _running.get(name)
+        if previous is not None and previous.is_alive():
+            checks[name] = {'status': 'fail', 'error': f"still running after timing out ({timeout}s)"}
+        else:
+            started[name] = _start(name, check, *args)
+            _running[name] = started[name][0]
+    deadline = time.monotonic() + timeout
+    for name, (thread, result) in started.items():
+        thread.join(max(deadline - time.monotonic(), 0))
+        if thread.is_alive():
+            checks[name] = {'status': 'fail', 'error': f"timed out after {timeout}s"}
+        else:
+            checks[name] = result
+
+    status = 'ok'
+    if any(check['status'] != 'ok' for check in checks.values()):
+        status = 'fail'
+    elif checks['broker']['queue_depth'] > getattr(settings, 'CRM_HEALTH_MAX_QUEUE_DEPTH', DEFAULT_MAX_QUEUE_DEPTH):
+        status = 'degraded'
+    return {'status': status, 'checks': checks}
+
+
+def run_checks(use_cache=True):
+    """Return {'status': ..., 'checks': {...}, 'cached': bool}."""
+    timeout = getattr(settings, 'CRM_HEALTH_TIMEOUT', DEFAULT_TIMEOUT)
+    with _lock:
+        # Probes arriving together wait for one run instead of each starting one
+        if use_cache and _cache['result'] and time.monotonic() < _cache['expires']:
+            return dict(_cache['result'], cached=True)
+        result = _run(timeout)
+        _cache['result'] = result
+        _cache['expires'] = time.monotonic() + getattr(settings, 'CRM_HEALTH_CACHE_SECONDS', DEFAULT_CACHE_SECONDS)
+    return dict(result, cached=False)
@@ -0,0 +1,52 @@
+"""
+Per-request batched loader for customer order summaries.
+
+Resolvers that receive customers without the with_order_summary()
+annotations (e.g. customers returned by mutations) go through this loader,
+which caches summaries on the request and fetches any number of missing
+customers with one query. Fields returning lists of such customers call
+CustomerType.prime_order_summaries with the whole list first; otherwise
+each customer's resolver would load its own summary.
+"""
+
+from decimal import Decimal
+
+from .models import ORDER_SUMMARY_FIELDS, Customer
+
+
+EMPTY_SUMMARY = {'order_count': 0, 'lifetime_value': Decimal('0'), 'last_order_date': None}
+
+
+class OrderSummaryLoader:
+    def __init__(self):
+        self._cache = {}
+
+    def load_many(self, customer_ids):
+        missing = [pk for pk in dict.fromkeys(customer_ids) if pk not in self._cache]
+        if missing:
+            # Same annotations as the connections use, so archived orders
+            # (see crm.archive) are included
+            rows = (
+                Customer.objects.filter(pk__in=missing)
+                .with_order_summary()
+                .values('pk', *ORDER_SUMMARY_FIELDS)
+            )
+            for pk in missing:
+                self._cache[pk] = EMPTY_SUMMARY
+            for row in rows:
+                self._cache[row.pop('pk')] = row
+        return [self._cache[pk] for pk in customer_ids]
+
+    def load(self, customer_id):
+        return self.load_many([customer_id])[0]
+
+
+def get_order_summary_loader(context):
+    """Return the loader stored on the request, creating it on first use."""
+    if context is None:
+        return OrderSummaryLoader()
+    loader = getattr(context, '_order_summary_loader', None)
+    if loader is None:
+        loader = OrderSummaryLoader()
+        context._order_summary_loader = loader
+    return loader
@@ -0,0 +1,233 @@
+"""
+Structured log sink for cron jobs, tasks and scripts.
+
+    log = get_logger('heartbeat', '/tmp/crm_heartbeat_log.txt')
+    log.info('CRM is alive', extra={'graphql': 'responsive'})
+
+writes {"ts": ..., "level": "INFO", "logger": "crm.heartbeat",
+"message": "CRM is alive", "graphql": "responsive"} as one JSON line.
+
+Records go through a queue to one background thread per file, which
+writes them into a 64KB buffer and flushes whenever the queue drains, so a
+job logging thousands of lines makes a handful of write() calls. Files are
+rotated when they exceed CRM_LOG_MAX_BYTES or when a CRM_LOG_ROTATE_SECONDS
+period ends (UTC-aligned, so daily means at midnight UTC). Rotated files
+are gzipped and only the newest CRM_LOG_BACKUP_COUNT are kept, which
+bounds disk use.
+
+Settings are read from Django settings when configured and from the
+environment otherwise, so plain scripts can use the sink too. CRM_LOG_DIR
+moves every log into one directory (keeping file names); CRM_LOG_PATHS maps
+a logger name to its own path. A path may contain {pid}: rotation assumes a
+single writing process per file, so multi-process workers should use it.
+"""
+
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+DEFAULTS = {
+    'CRM_LOG_DIR': None,
+    'CRM_LOG_PATHS': {},
+    'CRM_LOG_MAX_BYTES': 10 * 1024 * 1024,
+    'CRM_LOG_ROTATE_SECONDS': 24 * 60 * 60,
+    'CRM_LOG_BACKUP_COUNT': 7,
+}
+BUFFER_SIZE = 64 * 1024
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_lock = threading.Lock()
+_listeners = {}
+_loggers = {}  # logger name -> path it currently writes to
+_owner_pid = None
+
+
+def _setting(name):
+    try:
+        from django.conf import settings
+
+        if settings.configured:
+            return getattr(settings, name, DEFAULTS[name])
+    except ImportError:
+        pass
+    value = os.environ.get(name)
+    if value is None or name == 'CRM_LOG_PATHS':
+        return DEFAULTS[name]
+    return value if name == 'CRM_LOG_DIR' else int(value)
+
+
+def resolve_path(name, default_path):
+    """Where logger `name` writes, after CRM_LOG_PATHS and CRM_LOG_DIR."""
+    path = _setting('CRM_LOG_PATHS').get(name)
+    if path is None:
+        log_dir = _setting('CRM_LOG_DIR')
+        path = os.path.join(log_dir, os.path.basename(default_path)) if log_dir else default_path
+    return path.format(pid=os.getpid())
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+class RotatingJsonFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    Appends to `filename`, rotating on size and on time. Writes are not
+    flushed one by one; whoever drives the handler calls flush() (the
+    background listener does so whenever its queue is empty).
+    """
+
+    def __init__(self, filename, max_bytes, rotate_seconds, backup_count, compress=True):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        super().__init__(filename, 'a', encoding='utf-8', delay=True)
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.suffix = '.gz' if compress else ''
+        if compress:
+            self.rotator = _gzip_rotator
+        self.setFormatter(JsonFormatter())
+        # A file left over from an earlier period is rotated on first write
+        started = os.path.getmtime(self.baseFilename) if os.path.exists(self.baseFilename) else time.time()
+        self.rollover_at = self._next_rollover(started)
+        self.size = os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0
+
+    def _next_rollover(self, now):
+        if not self.rotate_seconds:
+            return float('inf')
+        return (now // self.rotate_seconds + 1) * self.rotate_seconds
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, encoding=self.encoding, buffering=BUFFER_SIZE)
+
+    def shouldRollover(self, record, length=0):
+        if time.time() >= self.rollover_at:
+            return True
+        return bool(self.max_bytes) and self.size > 0 and self.size + length > self.max_bytes
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+            dest, n = f"{self.baseFilename}.{stamp}", 1
+            while os.path.exists(dest + self.suffix):
+                dest, n = f"{self.baseFilename}.{stamp}-{n}", n + 1
+            self.rotate(self.baseFilename, dest + self.suffix)
+            self._prune()
+        self.size = 0
+        self.rollover_at = self._next_rollover(time.time())
+
+    def _prune(self):
+        directory, base = os.path.split(self.baseFilename)
+        rotated = [
+            os.path.join(directory, f) for f in os.listdir(directory or '.')
+            if f.startswith(base + '.')
+        ]
+        rotated.sort(key=lambda path: os.stat(path).st_mtime_ns, reverse=True)
+        for path in rotated[self.backup_count:]:
+            os.remove(path)
+
+    def emit(self, record):
+        try:
+            # json.dumps escapes non-ASCII, so characters == bytes
+            msg = self.format(record) + self.terminator
+            if self.shouldRollover(record, len(msg)):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(msg)
+            self.size += len(msg)
+        except Exception:
+            self.handleError(record)
+
+
+class _BufferedListener(logging.handlers.QueueListener):
+    def dequeue(self, block):
+        # About to wait for more records: write out what is buffered
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+        return self.queue.get(block)
+
+
+def _listener(path):
+    listener = _listeners.get(path)
+    if listener is None:
+        handler = RotatingJsonFileHandler(
+            path,
+            max_bytes=_setting('CRM_LOG_MAX_BYTES'),
+            rotate_seconds=_setting('CRM_LOG_ROTATE_SECONDS'),
+            backup_count=_setting('CRM_LOG_BACKUP_COUNT'),
+        )
+        listener = _BufferedListener(queue.SimpleQueue(), handler)
+        listener.start()
+        _listeners[path] = listener
+    return listener
+
+
+def get_logger(name, default_path):
+    """
+    Return the logger 'crm.<name>', writing JSON lines to `default_path`
+    (or its configured override) through the shared background writer.
+    Fields passed as `extra` become top-level keys of the line.
+    """
+    global _owner_pid
+    path = resolve_path(name, default_path)
+    with _lock:
+        if _owner_pid != os.getpid():
+            # Forked (e.g. a Celery prefork child): the parent's writer
+            # threads did not come along, so start afresh
+            _listeners.clear()
+            _loggers.clear()
+            _owner_pid = os.getpid()
+        logger = logging.getLogger(f'crm.{name}')
+        if _loggers.get(name) != path:
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            logger.addHandler(logging.handlers.QueueHandler(_listener(path).queue))
+            _loggers[name] = path
+    return logger
+
+
+def shutdown():
+    """Write out everything queued and stop the writer threads."""
+    with _lock:
+        listeners = list(_listeners.values()) if _owner_pid == os.getpid() else []
+        _listeners.clear()
+        _loggers.clear()
+    for listener in listeners:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,66 @@
+"""
+Move old orders out of the hot tables into the order archive.
+
+    python manage.py archive_orders --older-than-days 365
+    python manage.py archive_orders --before 2024-01-01 --batch-size 5000
+
+Orders placed before the cutoff are moved with their line items in
+batches, one transaction per batch (see crm.archive). allOrders keeps
+returning them when its date filter reaches back that far.
+"""
+
+import time
+from datetime import datetime, time as dt_time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from crm.archive import DEFAULT_BATCH_SIZE, archive_orders
+from crm.models import Order
+
+
+class Command(BaseCommand):
+    help = "Move orders placed before a cutoff into the order archive"
+
+    def add_arguments(self, parser):
+        cutoff = parser.add_mutually_exclusive_group(required=True)
+        cutoff.add_argument('--before', help="Archive orders placed before this date (YYYY-MM-DD)")
+        cutoff.add_argument('--older-than-days', type=int, help="Archive orders older than this many days")
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="Orders per transaction")
+        parser.add_argument('--max-batches', type=int, help="Stop after this many batches")
+        parser.add_argument('--dry-run', action='store_true', help="Only report how many orders would move")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive")
+        if options['before']:
+            try:
+                day = datetime.strptime(options['before'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--before must be a date in YYYY-MM-DD format")
+            before = timezone.make_aware(datetime.combine(day, dt_time.min))
+        else:
+            if options['older_than_days'] < 0:
+                raise CommandError("--older-than-days must not be negative")
+            before = timezone.now() - timedelta(days=options['older_than_days'])
+
+        if options['dry_run']:
+            count = Order.objects.filter(order_date__lt=before).count()
+            self.stdout.write(f"{count} orders placed before {before:%Y-%m-%d %H:%M} would be archived")
+            return
+
+        started = time.perf_counter()
+        self.moved = 0
+
+        def progress(orders, items):
+            self.moved += orders
+            if options['verbosity'] >= 2:
+                self.stdout.write(f"{self.moved} orders archived")
+
+        orders, items = archive_orders(
+            before, batch_size=options['batch_size'], max_batches=options['max_batches'], on_batch=progress,
+        )
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {orders} orders ({items} line items) placed before {before:%Y-%m-%d %H:%M} in {elapsed:.2f}s"
+        ))
@@ -0,0 +1,111 @@
+"""
+Seed a throwaway SQLite database and benchmark the CRM.
+
+    python manage.py crm_benchmark --orders 20000 --output bench.json
+    python manage.py crm_benchmark --output new.json --compare bench.json
+
+The project database is never touched: the command creates a test
+database (in memory unless --db-file names a new file), seeds it with
+crm.seed and runs crm.benchmarks against it.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from crm.benchmarks import BENCHMARKS, compare, run_benchmarks
+from crm.seed import seed
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmark GraphQL operations and CRM jobs against a freshly seeded database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--products', type=int, default=200)
+        parser.add_argument('--orders', type=int, default=5000)
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for data and operations")
+        parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="Benchmarks to run")
+        parser.add_argument('--db-file', help="Seed a new on-disk SQLite file (deleted afterwards) instead of an in-memory database")
+        parser.add_argument('--output', help="Write the JSON results to this file")
+        parser.add_argument('--compare', help="Baseline JSON from an earlier run to compare against")
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError("--iterations must be at least 1")
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = json.load(f)
+
+        if options['db_file']:
+            # The file is created here and destroyed afterwards, so never
+            # point this at an existing database
+            if os.path.exists(options['db_file']):
+                raise CommandError(f"--db-file {options['db_file']} already exists; give a path for a new file")
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = options['db_file']
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            started = time.perf_counter()
+            counts = seed(
+                customers=options['customers'],
+                products=options['products'],
+                orders=options['orders'],
+                random_seed=options['seed'],
+            )
+            self.stdout.write(f"Seeded {counts} in {time.perf_counter() - started:.1f}s")
+            benchmarks = run_benchmarks(
+                options['only'], iterations=options['iterations'],
+                warmup=options['warmup'], random_seed=options['seed'],
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = {
+            'meta': {
+                'revision': _git_revision(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'seed': counts,
+                'random_seed': options['seed'],
+            },
+            'benchmarks': benchmarks,
+        }
+
+        for name, result in benchmarks.items():
+            latency = result['latency_ms']
+            self.stdout.write(
+                f"{name:<24} p50 {latency['p50']:8.2f} ms  p95 {latency['p95']:8.2f} ms  "
+                f"{result['ops_per_s']:>8.1f} ops/s  queries {result['queries']['max']:>4}  peak {result['peak_memory_kb']:>9.1f} KB"
+            )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline:
+            self.stdout.write(f"\nCompared with {baseline['meta'].get('revision') or options['compare']}:")
+            for name, metric, old, new, change in compare(results, baseline):
+                worse = -change if metric == 'ops/s' else change
+                style = self.style.ERROR if worse > 10 else self.style.SUCCESS if worse < -10 else str
+                self.stdout.write(style(f"{name:<24} {metric:<8} {old:>10.2f} -> {new:>10.2f}  ({change:+.1f}%)"))
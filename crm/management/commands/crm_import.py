@@ -0,0 +1,369 @@
+"""
+Streaming bulk import of customers, products and orders from CSV or NDJSON.
+
+    python manage.py crm_import customers customers.csv
+    python manage.py crm_import orders orders.ndjson.gz --workers 4 --wal
+
+Rows are read lazily, validated with the model validators in a process pool
+and written with bulk_create, one transaction per chunk, together with an
+outbox event per row (see crm.outbox; --no-outbox skips them for initial
+loads that downstream systems will snapshot anyway). The file formats
+match the /export/<entity> view, so an export can be imported back.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import DateTimeField
+from django.utils import timezone
+
+from crm import counts
+from crm.models import Customer, Product, Order, OrderItem, OutboxEvent, bulk_create_orders
+
+
+def _reason(error):
+    if isinstance(error, ValidationError) and hasattr(error, 'message_dict'):
+        return '; '.join(f"{field}: {' '.join(msgs)}" for field, msgs in error.message_dict.items())
+    if isinstance(error, ValidationError):
+        return ' '.join(error.messages)
+    return str(error)
+
+
+def _blank_to_none(value):
+    return None if value == '' else value
+
+
+# Row cleaners run in worker processes. They only use the models' field
+# validators and clean() — never the database — and return plain dicts.
+# Uniqueness and foreign keys are checked per chunk by the writers.
+
+def _clean_fields(model, row, names):
+    """
+    Run each field's to_python and validators (what full_clean does per
+    field) without building a model instance, collecting errors per field.
+    """
+    cleaned, errors = {}, {}
+    for name in names:
+        field = model._meta.get_field(name)
+        try:
+            cleaned[name] = field.clean(_blank_to_none(row.get(name)), None)
+        except ValidationError as e:
+            errors[name] = e.error_list
+    if errors:
+        raise ValidationError(errors)
+    return cleaned
+
+
+def _clean_customer(row):
+    return _clean_fields(Customer, row, ('name', 'email', 'phone'))
+
+
+def _clean_product(row):
+    if _blank_to_none(row.get('stock')) is None:
+        row = dict(row, stock=0)
+    cleaned = _clean_fields(Product, row, ('name', 'price', 'stock'))
+    Product(**cleaned).clean()
+    return cleaned
+
+
+def _parse_list(value):
+    if value is None or value == '':
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return str(value).replace(',', ' ').split()
+
+
+def _clean_order_items(row):
+    """
+    Parse the parallel product_ids / quantities / unit_prices columns into
+    {product_id: [quantity, unit_price or None]}. Quantities default to 1;
+    missing unit prices are captured from the product when writing.
+    """
+    product_ids = [int(v) for v in _parse_list(row.get('product_ids'))]
+    if not product_ids:
+        raise ValidationError("product_ids is required")
+    quantities = _parse_list(row.get('quantities')) or [1] * len(product_ids)
+    unit_prices = _parse_list(row.get('unit_prices')) or [None] * len(product_ids)
+    if len(quantities) != len(product_ids) or len(unit_prices) != len(product_ids):
+        raise ValidationError("quantities and unit_prices must match product_ids")
+
+    quantity_field = OrderItem._meta.get_field('quantity')
+    price_field = OrderItem._meta.get_field('unit_price')
+    items = {}
+    for product_id, quantity, unit_price in zip(product_ids, quantities, unit_prices):
+        quantity = quantity_field.clean(quantity, None)
+        if quantity < 1:
+            raise ValidationError("quantities must be at least 1")
+        if unit_price is not None:
+            unit_price = price_field.clean(unit_price, None)
+        if product_id in items:
+            items[product_id][0] += quantity
+        else:
+            items[product_id] = [quantity, unit_price]
+    return items
+
+
+def _clean_order(row):
+    customer_id = _blank_to_none(row.get('customer_id'))
+    customer_email = _blank_to_none(row.get('customer_email'))
+    if customer_id is None and customer_email is None:
+        raise ValidationError("customer_id or customer_email is required")
+    items = _clean_order_items(row)
+    order_date = _blank_to_none(row.get('order_date'))
+    if order_date:
+        order_date = DateTimeField().to_python(order_date)
+        if timezone.is_naive(order_date):
+            order_date = timezone.make_aware(order_date)
+    return {
+        'customer_id': int(customer_id) if customer_id is not None else None,
+        'customer_email': customer_email,
+        'items': items,
+        'order_date': order_date,
+    }
+
+
+CLEANERS = {
+    'customers': _clean_customer,
+    'products': _clean_product,
+    'orders': _clean_order,
+}
+
+
+def _validate_chunk(entity, rows):
+    """Split a chunk of (line, row) pairs into cleaned rows and rejects."""
+    clean = CLEANERS[entity]
+    valid, rejected = [], []
+    for line, row in rows:
+        try:
+            if not isinstance(row, dict):
+                raise ValidationError("Row must be an object")
+            if '_error' in row:
+                raise ValidationError(row['_error'])
+            valid.append((line, clean(row)))
+        except Exception as e:
+            rejected.append((line, _reason(e), row))
+    return valid, rejected
+
+
+def _init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = "Stream CSV/NDJSON files of customers, products or orders into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('entity', choices=sorted(CLEANERS))
+        parser.add_argument('path', help="File to import ('-' for stdin); .gz files are decompressed")
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help="Defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows per bulk_create INSERT")
+        parser.add_argument('--chunk-size', type=int, default=20000,
+                            help="Rows per validation task and per transaction")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Validation processes (default: one per CPU); 0 or 1 validates in this process")
+        parser.add_argument('--wal', action='store_true',
+                            help="Switch SQLite to WAL mode with synchronous=NORMAL before importing")
+        parser.add_argument('--rejects', help="Write rejected rows to this file as NDJSON")
+        parser.add_argument('--no-outbox', action='store_true',
+                            help="Do not record outbox events for the imported rows")
+
+    def handle(self, *args, **options):
+        entity = options['entity']
+        path = options['path']
+        fmt = options['format'] or self._guess_format(path)
+        batch_size = options['batch_size']
+        chunk_size = options['chunk_size']
+        workers = options['workers']
+        if batch_size < 1 or chunk_size < 1 or workers < 0:
+            raise CommandError("--batch-size and --chunk-size must be positive, --workers non-negative")
+
+        if options['wal']:
+            if connection.vendor != 'sqlite':
+                raise CommandError("--wal only applies to SQLite databases")
+            if connection.in_atomic_block:
+                raise CommandError("--wal cannot switch modes inside a transaction")
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+                cursor.execute('PRAGMA synchronous=NORMAL')
+
+        rejects_file = open(options['rejects'], 'w', encoding='utf-8') if options['rejects'] else None
+        self.stats = {'read': 0, 'inserted': 0, 'rejected': 0}
+        self.record_outbox = not options['no_outbox']
+        writer = getattr(self, f'_write_{entity}')
+        started = time.perf_counter()
+
+        try:
+            with self._open(path) as stream:
+                rows = self._read(stream, fmt)
+                for valid, rejected in self._validate(entity, self._chunks(rows, chunk_size), workers):
+                    with transaction.atomic():
+                        failed = writer(valid, batch_size)
+                        counts.invalidate()
+                    self.stats['inserted'] += len(valid) - len(failed)
+                    self._reject(rejected + failed, rejects_file)
+                    if options['verbosity'] >= 2:
+                        self.stdout.write(self._summary(started))
+        finally:
+            if rejects_file:
+                rejects_file.close()
+
+        self.stdout.write(self.style.SUCCESS(self._summary(started)))
+
+    def _summary(self, started):
+        elapsed = time.perf_counter() - started
+        rate = self.stats['read'] / elapsed if elapsed else 0
+        return (f"{self.stats['read']} rows read, {self.stats['inserted']} inserted, "
+                f"{self.stats['rejected']} rejected in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+
+    # Reading
+
+    def _guess_format(self, path):
+        name = path[:-3] if path.endswith('.gz') else path
+        if name.endswith(('.ndjson', '.jsonl')):
+            return 'ndjson'
+        if name.endswith('.csv'):
+            return 'csv'
+        raise CommandError("Cannot tell the format from the file name; pass --format")
+
+    def _open(self, path):
+        if path == '-':
+            return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rt', encoding='utf-8', newline='')
+        return open(path, 'r', encoding='utf-8', newline='')
+
+    def _read(self, stream, fmt):
+        """Yield (line number, row dict) pairs without loading the file."""
+        if fmt == 'csv':
+            reader = csv.DictReader(stream)
+            for row in reader:
+                self.stats['read'] += 1
+                yield reader.line_num, row
+        else:
+            for line_num, line in enumerate(stream, start=1):
+                if not line.strip():
+                    continue
+                self.stats['read'] += 1
+                try:
+                    yield line_num, json.loads(line)
+                except ValueError as e:
+                    yield line_num, {'_error': f"Invalid JSON: {e}"}
+
+    def _chunks(self, rows, size):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _validate(self, entity, chunks, workers):
+        """Validate chunks in order, keeping at most 2 * workers chunks in flight."""
+        # A single worker process would only add pickling to the same work
+        if workers <= 1:
+            for chunk in chunks:
+                yield _validate_chunk(entity, chunk)
+            return
+
+        settings_module = os.environ.get('DJANGO_SETTINGS_MODULE', 'alx_backend_graphql_crm.settings')
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(settings_module,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_validate_chunk, entity, chunk))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _reject(self, rejected, rejects_file):
+        self.stats['rejected'] += len(rejected)
+        for line, reason, row in rejected:
+            if rejects_file:
+                rejects_file.write(json.dumps({'line': line, 'reason': reason, 'row': row}, default=str) + '\n')
+            elif self.stats['rejected'] <= 10:
+                self.stderr.write(f"line {line}: {reason}")
+
+    # Writing. Each writer runs inside the chunk's transaction and returns
+    # the rows it had to reject on database grounds (duplicates, unknown ids).
+
+    def _write_customers(self, valid, batch_size):
+        # Earlier chunks are already committed, so checking against the
+        # database also catches duplicates across chunks; `existing` grows
+        # with this chunk's rows for duplicates within it
+        emails = [data['email'] for _, data in valid]
+        existing = set(Customer.objects.filter(email__in=emails).values_list('email', flat=True))
+        customers, rejected = [], []
+        for line, data in valid:
+            if data['email'] in existing:
+                rejected.append((line, f"email: Customer with email {data['email']} already exists", data))
+                continue
+            existing.add(data['email'])
+            customers.append(Customer(**data))
+        Customer.objects.bulk_create(customers, batch_size=batch_size)
+        if self.record_outbox:
+            OutboxEvent.record(customers, OutboxEvent.CREATED)
+        return rejected
+
+    def _write_products(self, valid, batch_size):
+        products = Product.objects.bulk_create([Product(**data) for _, data in valid], batch_size=batch_size)
+        if self.record_outbox:
+            OutboxEvent.record(products, OutboxEvent.CREATED)
+        return []
+
+    def _write_orders(self, valid, batch_size):
+        emails = {data['customer_email'] for _, data in valid if data['customer_id'] is None}
+        by_email = dict(Customer.objects.filter(email__in=emails).values_list('email', 'pk'))
+        customer_ids = {data['customer_id'] for _, data in valid if data['customer_id'] is not None}
+        known_customers = set(Customer.objects.filter(pk__in=customer_ids).values_list('pk', flat=True))
+        product_ids = {pk for _, data in valid for pk in data['items']}
+        prices = dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'price'))
+
+        orders, order_items, rejected = [], [], []
+        for line, data in valid:
+            customer_id = data['customer_id']
+            if customer_id is None:
+                customer_id = by_email.get(data['customer_email'])
+            if customer_id is None or (data['customer_id'] is not None and customer_id not in known_customers):
+                rejected.append((line, "customer: Customer not found", data))
+                continue
+            missing = [pk for pk in data['items'] if pk not in prices]
+            if missing:
+                rejected.append((line, f"product_ids: Unknown products {missing}", data))
+                continue
+            items = [
+                OrderItem(product_id=pk, quantity=quantity,
+                          unit_price=prices[pk] if unit_price is None else unit_price)
+                for pk, (quantity, unit_price) in data['items'].items()
+            ]
+            orders.append(Order(
+                customer_id=customer_id,
+                order_date=data['order_date'],  # None: stamped on insert
+                total_amount=sum((item.line_total for item in items), Decimal('0')),
+            ))
+            order_items.append(items)
+
+        bulk_create_orders(orders, batch_size=batch_size)
+        for order, items in zip(orders, order_items):
+            for item in items:
+                item.order_id = order.pk
+        OrderItem.objects.bulk_create([item for items in order_items for item in items], batch_size=batch_size)
+        if self.record_outbox:
+            OutboxEvent.record(orders, OutboxEvent.CREATED)
+        return rejected
@@ -0,0 +1,69 @@
+"""
+Inspect /graphql request profiles recorded by crm.profiling.
+
+    python manage.py crm_profiles                        # list, newest last
+    python manage.py crm_profiles 20261019T104500123456-1a2b
+    python manage.py crm_profiles --operation Orders --folded > orders.folded
+    flamegraph.pl orders.folded > orders.svg
+
+--folded prints the stack samples of sample-mode profiles in the folded
+format flamegraph.pl and speedscope read, summed over every matching
+profile. cprofile-mode profiles point at their pstats file instead.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.profiling import folded, list_profile_ids, load_profile, pstats_path
+
+TOP_STACKS = 15
+
+
+class Command(BaseCommand):
+    help = "List recorded /graphql profiles, show one, or print folded stacks for flamegraphs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', help="Profile ids (default: all, filtered by --operation)")
+        parser.add_argument('--operation', help="Only profiles of this GraphQL operation name")
+        parser.add_argument('--folded', action='store_true', help="Print folded stacks summed over the profiles")
+
+    def handle(self, *args, **options):
+        ids = options['ids'] or list_profile_ids()
+        try:
+            profiles = [load_profile(profile_id) for profile_id in ids]
+        except FileNotFoundError as e:
+            raise CommandError(f"No such profile: {e.filename}")
+        if options['operation']:
+            profiles = [p for p in profiles if options['operation'] in p['operations']]
+
+        if options['folded']:
+            for line in folded(profiles):
+                self.stdout.write(line)
+        elif options['ids']:
+            for profile in profiles:
+                self._show(profile)
+        else:
+            for p in profiles:
+                self.stdout.write(
+                    f"{p['id']}  {p['duration_ms']:>9.1f} ms  {p['sql']['count']:>4} queries  "
+                    f"{p['mode']:<8}  {p['reason']:<9}  {','.join(p['operations']) or '-'}"
+                )
+
+    def _show(self, p):
+        self.stdout.write(self.style.SUCCESS(f"{p['id']} ({p['mode']}, {p['reason']})"))
+        self.stdout.write(
+            f"{p['ts']}  {p['path']}  status {p['status']}  {p['duration_ms']} ms  "
+            f"operations: {', '.join(p['operations']) or '-'}"
+        )
+        self.stdout.write(f"SQL: {p['sql']['count']} queries, {p['sql']['total_ms']} ms")
+        for query in p['sql']['slowest']:
+            self.stdout.write(f"  {query['ms']:>8.3f} ms  {query['sql'][:200]}")
+        if p['mode'] == 'cprofile':
+            self.stdout.write(f"pstats: {pstats_path(p['id'])}")
+            return
+        self.stdout.write(f"Stack samples: {p['samples']} (hottest leaf frames)")
+        leaves = {}
+        for stack, count in p['stacks'].items():
+            leaf = stack.rsplit(';', 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+        for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:TOP_STACKS]:
+            self.stdout.write(f"  {count:>6}  {leaf}")
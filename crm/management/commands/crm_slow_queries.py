@@ -0,0 +1,98 @@
+"""
+Summarize the slow-query log (crm.slowlog) by statement fingerprint.
+
+    python manage.py crm_slow_queries
+    python manage.py crm_slow_queries --limit 5 --plans
+    python manage.py crm_slow_queries /var/log/crm/crm_slow_queries.log.20261018-000000.gz
+
+Reads the current log and its rotated (gzipped) backups unless files are
+given. Fingerprints are listed by total time; each shows how often it ran,
+the GraphQL operations and resolver paths that ran it, and, with --plans,
+its query plan. Plans that scan a table without an index are flagged.
+"""
+
+import glob
+import gzip
+import json
+import os
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.logsink import resolve_path
+from crm.slowlog import LOG_PATH
+
+# Plan lines that read a whole table: SQLite and PostgreSQL wording
+FULL_SCAN_MARKERS = ('SCAN ', 'Seq Scan')
+
+
+def _needs_index(plan):
+    return any(
+        marker in line and 'USING INDEX' not in line and 'USING COVERING INDEX' not in line
+        for line in plan for marker in FULL_SCAN_MARKERS
+    )
+
+
+def _read(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+class Command(BaseCommand):
+    help = "Aggregate the slow-query log by statement fingerprint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help="Log files (default: the current log and its backups)")
+        parser.add_argument('--limit', type=int, default=20, help="Show this many fingerprints")
+        parser.add_argument('--plans', action='store_true', help="Print each fingerprint's query plan")
+
+    def handle(self, *args, **options):
+        files = options['files']
+        if not files:
+            path = resolve_path('slow_queries', LOG_PATH)
+            files = [p for p in [path] + sorted(glob.glob(glob.escape(path) + '.*')) if os.path.exists(p)]
+        if not files:
+            raise CommandError("No slow-query log found; is CRM_SLOW_QUERY_MS set?")
+
+        groups = defaultdict(lambda: {
+            'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'operations': Counter(), 'paths': Counter(),
+        })
+        for path in files:
+            try:
+                entries = list(_read(path))
+            except OSError as e:
+                raise CommandError(f"Cannot read {path}: {e}")
+            for entry in entries:
+                if 'fingerprint' not in entry:
+                    continue
+                group = groups[entry['fingerprint']]
+                group['count'] += 1
+                group['total_ms'] += entry['ms']
+                if entry['ms'] >= group['max_ms']:
+                    group['max_ms'] = entry['ms']
+                    group['sql'], group['params'] = entry['sql'], entry['params']
+                if entry.get('plan'):
+                    group['plan'] = entry['plan']
+                group['operations'][entry.get('operation') or '-'] += 1
+                group['paths'][entry.get('path') or '-'] += 1
+
+        ranked = sorted(groups.items(), key=lambda item: -item[1]['total_ms'])[:options['limit']]
+        for key, g in ranked:
+            flag = '  [full scan]' if _needs_index(g.get('plan', [])) else ''
+            self.stdout.write(self.style.SUCCESS(
+                f"{key}  {g['count']}x  total {g['total_ms']:.1f} ms  "
+                f"avg {g['total_ms'] / g['count']:.1f} ms  max {g['max_ms']:.1f} ms{flag}"
+            ))
+            self.stdout.write(f"  {g['sql'][:300]}")
+            self.stdout.write(f"  params (slowest): {g['params']}")
+            self.stdout.write("  operations: " + ', '.join(f"{k} ({n})" for k, n in g['operations'].most_common(3)))
+            self.stdout.write("  paths: " + ', '.join(f"{k} ({n})" for k, n in g['paths'].most_common(3)))
+            if options['plans'] and g.get('plan'):
+                for line in g['plan']:
+                    self.stdout.write(f"    {line}")
+        self.stdout.write(f"{len(groups)} fingerprints in {len(files)} file(s)")
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def capture_unit_prices(apps, schema_editor):
+    # Existing line items get the product's current price, the best
+    # approximation of what was charged.
+    OrderItem = apps.get_model('crm', 'OrderItem')
+    Product = apps.get_model('crm', 'Product')
+    OrderItem.objects.filter(unit_price__isnull=True).update(
+        unit_price=Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0004_orderitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.RunPython(capture_unit_prices, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=None, max_digits=10),
+        ),
+    ]
@@ -1,11 +1,70 @@
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models, transaction
+from django.db.models import Count, ExpressionWrapper, F, Max, Q, Sum, Value
+from django.db.models.functions import Coalesce
 from django.core.validators import RegexValidator
 from django.core.exceptions import ValidationError
 import re
+import uuid
+from decimal import Decimal
 
 # Create your models here.
 
-class Customer(models.Model):
+ORDER_SUMMARY_FIELDS = ('order_count', 'lifetime_value', 'last_order_date')
+CENTS = Decimal('0.01')
+
+
+def _invalidate_revenue(*order_dates):
+    # Drops cached revenue buckets; imported here because crm.analytics imports this module
+    from .analytics import invalidate
+    invalidate(*order_dates)
+
+
+class CustomerQuerySet(models.QuerySet):
+    def with_order_summary(self):
+        """
+        Annotate order_count, lifetime_value and last_order_date in SQL.
+        Safe to call more than once; the annotations are only added once.
+        """
+        if 'order_count' in self.query.annotations:
+            return self
+        # Archived orders (see crm.archive) are folded in from the one row
+        # per customer in CustomerArchiveSummary, so the join adds no rows.
+        # Hot orders are always newer than archived ones.
+        money = models.DecimalField(max_digits=12, decimal_places=2)
+        return self.annotate(
+            order_count=Count('order') + Coalesce(F('archive_summary__order_count'), Value(0)),
+            lifetime_value=ExpressionWrapper(
+                Coalesce(Sum('order__total_amount'), Value(0), output_field=money)
+                + Coalesce(F('archive_summary__lifetime_value'), Value(0), output_field=money),
+                output_field=money,
+            ),
+            last_order_date=Coalesce(Max('order__order_date'), F('archive_summary__last_order_date')),
+        )
+
+class OutboxMixin:
+    """
+    Appends an OutboxEvent for every save() in the same transaction as the
+    write. Deletes are recorded by the post_delete hook in crm.signals, which
+    also sees cascaded deletes. Bulk writes (bulk_create, queryset.update)
+    must call OutboxEvent.record themselves.
+    """
+    outbox_entity = None
+
+    def outbox_payload(self):
+        """The event payload: every concrete field but the primary key, by attname."""
+        return {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields if not field.primary_key
+        }
+
+    def save(self, *args, **kwargs):
+        action = OutboxEvent.CREATED if self._state.adding else OutboxEvent.UPDATED
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super().save(*args, **kwargs)
+            OutboxEvent.record([self], action)
+
+class Customer(OutboxMixin, models.Model):
     name = models.CharField(max_length=100)
     email = models.EmailField(unique=True)
     phone = models.CharField(max_length=15, blank=True, null=True, validators=[
@@ -16,35 +75,302 @@ class Customer(models.Model):
     ])
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CustomerQuerySet.as_manager()
+
+    outbox_entity = 'customer'
+
+    def outbox_payload(self):
+        return {'name': self.name, 'email': self.email, 'phone': self.phone, 'created_at': self.created_at}
+
     def __str__(self):
         return self.name
 
-class Product(models.Model):
+class Product(OutboxMixin, models.Model):
     name = models.CharField(max_length=100)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField(default=0)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Stock as loaded (None if deferred), for stockChanged (crm.signals)
+        instance._saved_stock = instance.__dict__.get('stock')
+        return instance
+
     def clean(self):
         if self.price <= 0:
             raise ValidationError("Price must be positive")
         if self.stock < 0:
             raise ValidationError("Stock cannot be negative")
 
+    outbox_entity = 'product'
+
+    def outbox_payload(self):
+        return {'name': self.name, 'price': Decimal(self.price).quantize(CENTS), 'stock': self.stock}
+
     def __str__(self):
         return self.name
 
-class Order(models.Model):
+class Order(OutboxMixin, models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
-    products = models.ManyToManyField(Product)
+    products = models.ManyToManyField(Product, through='OrderItem')
     order_date = models.DateTimeField(auto_now_add=True)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        # Calculate total_amount as sum of product prices after saving
-        if self.pk:
-            self.total_amount = sum(product.price for product in self.products.all())
-            super().save(update_fields=['total_amount'])
+    # total_amount is maintained incrementally by OrderItem (see add_items,
+    # OrderItem.save/delete) from the captured unit prices, so it no longer
+    # changes when product prices do. Those writes also drop the cached
+    # revenue buckets of the order's date (crm.analytics).
+
+    outbox_entity = 'order'
+
+    def outbox_payload(self):
+        return {
+            'customer_id': self.customer_id,
+            'order_date': self.order_date,
+            'total_amount': Decimal(self.total_amount).quantize(CENTS),
+        }
+
+    def add_items(self, items):
+        """
+        Bulk insert OrderItems for this order, capturing each product's
+        current price if no unit_price was given, and add their line totals
+        to total_amount in a single UPDATE. Call inside a transaction; the
+        new total is recorded in the outbox.
+        """
+        added = 0
+        for item in items:
+            item.order = self
+            if item.unit_price is None:
+                item.unit_price = item.product.price
+            added += item.line_total
+        OrderItem.objects.bulk_create(items)
+        Order.objects.filter(pk=self.pk).update(total_amount=F('total_amount') + added)
+        self.total_amount += added
+        OutboxEvent.record([self], OutboxEvent.UPDATED)
+        _invalidate_revenue(self.order_date)
+        return items
+
+    def recalculate_total(self):
+        """Recompute total_amount from the line items (only reads crm_order_products)."""
+        total = self.items.aggregate(
+            total=Sum(F('quantity') * F('unit_price'), output_field=models.DecimalField(max_digits=12, decimal_places=2))
+        )['total'] or 0
+        Order.objects.filter(pk=self.pk).update(total_amount=total)
+        self.total_amount = total
+        _invalidate_revenue(self.order_date)
+        return total
 
     def __str__(self):
         return f"Order {self.id} by {self.customer.name}"
+
+def bulk_create_orders(orders, batch_size=None):
+    """
+    bulk_create `orders`, keeping the order_date set on each (imported or
+    seeded dates). order_date is auto_now_add, so the INSERT stamps now();
+    the given dates are then written back with one executemany UPDATE,
+    rather than switching auto_now_add off on the shared field, which would
+    also affect orders created concurrently by other threads. Cached
+    revenue buckets of the given dates are dropped (crm.analytics).
+    """
+    dates = [order.order_date for order in orders]
+    Order.objects.bulk_create(orders, batch_size=batch_size)
+    dated = [(order, date) for order, date in zip(orders, dates) if date is not None]
+    if dated:
+        field = Order._meta.get_field('order_date')
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"UPDATE {qn(Order._meta.db_table)} SET {qn(field.column)} = %s WHERE {qn(Order._meta.pk.column)} = %s",
+                [(field.get_db_prep_value(date, connection), order.pk) for order, date in dated],
+            )
+        for order, date in dated:
+            order.order_date = date
+        _invalidate_revenue(*dates)
+    return orders
+
+class OrderItem(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+    # Price of the product when the order was placed
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=None)
+
+    class Meta:
+        # Reuses the table of the former auto-created Order.products M2M
+        db_table = 'crm_order_products'
+        unique_together = [('order', 'product')]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_line_total = instance.line_total
+        return instance
+
+    @property
+    def line_total(self):
+        if self.quantity is None or self.unit_price is None:
+            return 0
+        return self.quantity * self.unit_price
+
+    def _apply_to_order_total(self, delta):
+        Order.objects.filter(pk=self.order_id).update(total_amount=F('total_amount') + delta)
+        orders = list(Order.objects.filter(pk=self.order_id))
+        OutboxEvent.record(orders, OutboxEvent.UPDATED)
+        _invalidate_revenue(*(order.order_date for order in orders))
+
+    def save(self, *args, **kwargs):
+        if self.unit_price is None:
+            self.unit_price = self.product.price
+        previous = getattr(self, '_saved_line_total', 0)
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            super().save(*args, **kwargs)
+            delta = self.line_total - previous
+            if delta:
+                self._apply_to_order_total(delta)
+        self._saved_line_total = self.line_total
+
+    def delete(self, *args, **kwargs):
+        previous = getattr(self, '_saved_line_total', self.line_total)
+        with transaction.atomic(using=kwargs.get('using'), savepoint=False):
+            result = super().delete(*args, **kwargs)
+            if previous:
+                self._apply_to_order_total(-previous)
+        return result
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} in order {self.order_id}"
+
+
+class ArchivedOrder(models.Model):
+    """
+    An order moved out of crm_order by the archive_orders command (see
+    crm.archive). Keeps the original id, so Relay ids stay valid, and the
+    same field and relation names as Order, so OrderFilter and OrderType
+    work on it unchanged. Archived orders are read-only.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='archived_orders')
+    products = models.ManyToManyField(Product, through='ArchivedOrderItem', related_name='+')
+    order_date = models.DateTimeField(db_index=True)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archived order {self.id}"
+
+class ArchivedOrderItem(models.Model):
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField(default=1)
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        unique_together = [('order', 'product')]
+
+    @property
+    def line_total(self):
+        return self.quantity * self.unit_price
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} in archived order {self.order_id}"
+
+class CustomerArchiveSummary(models.Model):
+    """Running totals of a customer's archived orders, kept by crm.archive."""
+    customer = models.OneToOneField(Customer, primary_key=True, on_delete=models.CASCADE, related_name='archive_summary')
+    order_count = models.PositiveIntegerField(default=0)
+    lifetime_value = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    last_order_date = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Archive summary for customer {self.customer_id}"
+
+
+class Job(models.Model):
+    """
+    Background job record for mutations that run asynchronously on Celery.
+    Tracks progress, partial results and per-row errors so clients can poll it.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=50)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    result = models.JSONField(default=dict, blank=True)
+    errors = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def progress(self):
+        if not self.total:
+            return 1.0 if self.status == self.STATUS_SUCCEEDED else 0.0
+        return self.processed / self.total
+
+    def __str__(self):
+        return f"Job {self.id} ({self.kind}, {self.status})"
+
+
+class OutboxEvent(models.Model):
+    """
+    Append-only change log for customers, products and orders, written in
+    the same transaction as the change it describes (the transactional
+    outbox pattern). The auto-increment id is the feed cursor: consumers
+    read `changes(since:)` or receive batches from the relay_outbox task.
+    The payload is the entity's fields after the change (empty on delete).
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    ACTION_CHOICES = [(CREATED, 'Created'), (UPDATED, 'Updated'), (DELETED, 'Deleted')]
+
+    id = models.BigAutoField(primary_key=True)
+    entity = models.CharField(max_length=20)
+    entity_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    relayed_at = models.DateTimeField(blank=True, null=True)
+    # Lease of the relay currently sending this event (crm.outbox)
+    claimed_until = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Keeps the relay's "oldest unrelayed events" scan proportional
+            # to the backlog, not to the size of the table
+            models.Index(fields=['id'], condition=Q(relayed_at__isnull=True), name='crm_outbox_unrelayed'),
+        ]
+
+    @classmethod
+    def record(cls, instances, action):
+        """
+        Append one event per instance with a single INSERT. Must run in the
+        transaction that made the change; `instances` may be a queryset.
+        """
+        events = [
+            cls(
+                entity=instance.outbox_entity,
+                entity_id=instance.pk,
+                action=action,
+                payload={} if action == cls.DELETED else instance.outbox_payload(),
+            )
+            for instance in instances
+        ]
+        if events:
+            cls.objects.bulk_create(events)
+        return events
+
+    def __str__(self):
+        return f"{self.entity} {self.entity_id} {self.action} (#{self.id})"
@@ -0,0 +1,125 @@
+"""
+Reading and relaying the transactional outbox (crm.models.OutboxEvent).
+
+Consumers can pull with read_changes() (the `changes` GraphQL field) or
+receive pushed batches from the relay_outbox Celery task, which POSTs
+unrelayed events to CRM_OUTBOX_WEBHOOK_URL. Either way the work is
+proportional to the number of changes, not the size of the tables.
+
+Event ids are the cursor. Delivery from the relay is at-least-once: a
+batch whose POST succeeded but whose relayed_at update failed, or whose
+lease ran out mid-POST, is sent again, so consumers should ignore ids they
+have already applied. Batches are sent in id order, also with several
+relays running.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+MAX_CHANGES_PAGE = 1000
+RELAY_BATCH_SIZE = 500
+RELAY_TIMEOUT = 10
+# How long a relay owns the batch it is sending; well above RELAY_TIMEOUT
+RELAY_LEASE = timedelta(seconds=60)
+
+
+def read_changes(since=None, first=100, entity=None):
+    """
+    Return (events, has_more) for up to `first` events after cursor `since`,
+    oldest first, with one query.
+    """
+    first = max(1, min(first, MAX_CHANGES_PAGE))
+    events = OutboxEvent.objects.order_by('id')
+    if since is not None:
+        events = events.filter(id__gt=since)
+    if entity:
+        events = events.filter(entity=entity)
+    events = list(events[:first + 1])
+    return events[:first], len(events) > first
+
+
+def serialize_event(event):
+    return {
+        'id': event.id,
+        'entity': event.entity,
+        'entity_id': event.entity_id,
+        'action': event.action,
+        'payload': event.payload,
+        'created_at': event.created_at.isoformat(),
+    }
+
+
+def post_to_webhook(events):
+    """Default relay sink: POST a batch as {"events": [...]} to the webhook."""
+    import requests
+
+    response = requests.post(
+        settings.CRM_OUTBOX_WEBHOOK_URL,
+        json={'events': [serialize_event(e) for e in events]},
+        timeout=RELAY_TIMEOUT,
+    )
+    response.raise_for_status()
+
+
+def _claim(batch_size, lease):
+    """
+    Lease the oldest `batch_size` unrelayed events to this relay, in a short
+    transaction of its own. Returns [] when nothing is waiting and None when
+    another relay holds an unexpired lease on the oldest events; taking the
+    batch after them instead would deliver out of id order.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # No skip_locked: a second relay waits here for the first one's claim
+        # to commit, then sees its lease and backs off
+        batch = list(
+            OutboxEvent.objects.select_for_update()
+            .filter(relayed_at__isnull=True).order_by('id')[:batch_size]
+        )
+        if not batch:
+            return []
+        # The condition repeats the lease check for SQLite, which ignores
+        # select_for_update
+        claimed = OutboxEvent.objects.filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lte=now), pk__in=[e.pk for e in batch],
+        ).update(claimed_until=now + lease)
+        if claimed != len(batch):
+            transaction.set_rollback(True)
+            return None
+    return batch
+
+
+def relay(sink=post_to_webhook, batch_size=RELAY_BATCH_SIZE, max_batches=None, lease=RELAY_LEASE):
+    """
+    Hand unrelayed events to `sink` in id order, one batch at a time, marking
+    each batch relayed once the sink returns. Stops at the first failure (the
+    batch is retried on the next run) and returns the number relayed.
+
+    Each batch is leased to this relay for `lease` (see _claim) and the sink
+    runs outside any transaction, so no locks or connections are held across
+    the POST. A relay that dies mid-batch leaves a lease that expires, after
+    which the batch is sent again.
+    """
+    relayed = batches = 0
+    while max_batches is None or batches < max_batches:
+        batch = _claim(batch_size, lease)
+        if not batch:
+            break
+        ids = [e.pk for e in batch]
+        try:
+            sink(batch)
+        except Exception:
+            OutboxEvent.objects.filter(pk__in=ids).update(claimed_until=None)
+            raise
+        OutboxEvent.objects.filter(pk__in=ids).update(relayed_at=timezone.now(), claimed_until=None)
+        relayed += len(batch)
+        batches += 1
+        if len(batch) < batch_size:
+            break
+    return relayed
@@ -0,0 +1,239 @@
+"""
+Opt-in profiling of /graphql requests in a running deployment.
+
+ProfilingMiddleware profiles a request when any of these match:
+  CRM_PROFILE_SAMPLE_RATE   fraction of requests, chosen at random (0 = off)
+  CRM_PROFILE_OPERATIONS    GraphQL operation names to always profile
+  X-CRM-Profile header      equal to CRM_PROFILE_TOKEN (unset: header ignored)
+and otherwise costs one path comparison.
+
+CRM_PROFILE_MODE picks the profiler:
+  sample    a thread records the request thread's stack every
+            CRM_PROFILE_INTERVAL seconds; cheap enough for production, and
+            gives flamegraph input (folded stacks)
+  cprofile  deterministic cProfile; exact call counts but slows the request
+            several times over. The pstats file is kept next to the profile.
+
+Every profiled request also records the SQL it ran with timings. Profiles
+are JSON files in CRM_PROFILE_DIR, of which the newest CRM_PROFILE_KEEP are
+kept, so every process writes to the same ring. Inspect them with
+
+    python manage.py crm_profiles                       # list
+    python manage.py crm_profiles <id>                  # summary and SQL
+    python manage.py crm_profiles --operation Orders --folded > orders.folded
+
+and feed folded output to flamegraph.pl or speedscope.
+"""
+
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import connection
+from django.utils.crypto import constant_time_compare
+
+DEFAULTS = {
+    'CRM_PROFILE_SAMPLE_RATE': 0.0,
+    'CRM_PROFILE_OPERATIONS': (),
+    'CRM_PROFILE_TOKEN': None,
+    'CRM_PROFILE_MODE': 'sample',
+    'CRM_PROFILE_INTERVAL': 0.005,
+    'CRM_PROFILE_DIR': '/tmp/crm_profiles',
+    'CRM_PROFILE_KEEP': 50,
+}
+PROFILED_PATHS = ('/graphql',)
+HEADER = 'HTTP_X_CRM_PROFILE'
+MAX_STACK_DEPTH = 200
+SLOWEST_QUERIES = 20
+
+
+def _setting(name):
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def _frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StackSampler(threading.Thread):
+    """Samples another thread's stack at a fixed interval into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='crm-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.stacks
+
+
+def operation_names(request):
+    """Operation names of a /graphql request (several for a batch)."""
+    if request.method == 'GET':
+        return [request.GET.get('operationName')]
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return []
+    entries = data if isinstance(data, list) else [data]
+    return [entry.get('operationName') for entry in entries if isinstance(entry, dict)]
+
+
+def profile_reason(request):
+    """Why `request` should be profiled, or None."""
+    token = _setting('CRM_PROFILE_TOKEN')
+    if token and constant_time_compare(request.META.get(HEADER, ''), token):
+        return 'header'
+    operations = _setting('CRM_PROFILE_OPERATIONS')
+    if operations and set(operation_names(request)) & set(operations):
+        return 'operation'
+    rate = _setting('CRM_PROFILE_SAMPLE_RATE')
+    if rate and random.random() < rate:
+        return 'sampled'
+    return None
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path not in PROFILED_PATHS:
+            return self.get_response(request)
+        reason = profile_reason(request)
+        if reason is None:
+            return self.get_response(request)
+
+        queries = []
+
+        def record_sql(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append((sql, (time.perf_counter() - started) * 1000))
+
+        mode = _setting('CRM_PROFILE_MODE')
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+        else:
+            profiler = StackSampler(threading.get_ident(), _setting('CRM_PROFILE_INTERVAL'))
+        started = time.perf_counter()
+        with connection.execute_wrapper(record_sql):
+            if mode == 'cprofile':
+                profiler.enable()
+            else:
+                profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                if mode == 'cprofile':
+                    profiler.disable()
+                else:
+                    profiler.stop()
+        duration = (time.perf_counter() - started) * 1000
+        now = datetime.now(timezone.utc)
+
+        profile = {
+            # Sortable by time, which is what the ring trims by
+            'id': f"{now:%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:4]}",
+            'ts': now.isoformat(timespec='milliseconds'),
+            'path': request.path,
+            'operations': [name for name in operation_names(request) if name],
+            'reason': reason,
+            'mode': mode,
+            'status': response.status_code,
+            'duration_ms': round(duration, 2),
+            'sql': {
+                'count': len(queries),
+                'total_ms': round(sum(ms for _, ms in queries), 2),
+                'slowest': [
+                    {'sql': sql, 'ms': round(ms, 3)}
+                    for sql, ms in sorted(queries, key=lambda q: -q[1])[:SLOWEST_QUERIES]
+                ],
+            },
+        }
+        if mode != 'cprofile':
+            profile['samples'] = sum(profiler.stacks.values())
+            profile['stacks'] = dict(profiler.stacks)
+        try:
+            save_profile(profile, profiler if mode == 'cprofile' else None)
+            response['X-CRM-Profile-Id'] = profile['id']
+        except OSError:
+            # A full or missing disk must not fail the request
+            pass
+        return response
+
+
+# Storage
+# -------
+
+def save_profile(profile, cprofile=None):
+    directory = _setting('CRM_PROFILE_DIR')
+    os.makedirs(directory, exist_ok=True)
+    if cprofile is not None:
+        cprofile.dump_stats(os.path.join(directory, f"{profile['id']}.prof"))
+    path = os.path.join(directory, f"{profile['id']}.json")
+    with open(path + '.tmp', 'w') as f:
+        json.dump(profile, f)
+    os.replace(path + '.tmp', path)
+    _trim(directory)
+
+
+def _trim(directory):
+    ids = list_profile_ids()
+    for old in ids[:-_setting('CRM_PROFILE_KEEP')]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, old + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def list_profile_ids():
+    """Ids of the stored profiles, oldest first."""
+    try:
+        names = os.listdir(_setting('CRM_PROFILE_DIR'))
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-5] for name in names if name.endswith('.json'))
+
+
+def load_profile(profile_id):
+    with open(os.path.join(_setting('CRM_PROFILE_DIR'), f"{profile_id}.json")) as f:
+        return json.load(f)
+
+
+def pstats_path(profile_id):
+    """Where the cProfile stats of a cprofile-mode profile are."""
+    return os.path.join(_setting('CRM_PROFILE_DIR'), f"{profile_id}.prof")
+
+
+def folded(profiles):
+    """Folded stacks summed over sample-mode profiles, one 'a;b;c count' line each."""
+    stacks = Counter()
+    for profile in profiles:
+        stacks.update(profile.get('stacks', {}))
+    return [f"{stack} {count}" for stack, count in sorted(stacks.items())]
@@ -0,0 +1,164 @@
+"""
+SQL query budgets for every root field and mutation of the schema.
+
+Each entry is a representative operation for the field and the maximum
+number of SQL queries it may run. crm.testing.check_query_budgets runs
+them against seeded data at two sizes and fails when a count exceeds its
+budget or grows with the number of rows (an N+1). When adding a field to
+crm/schema.py, add its entry here; the test fails for unlisted fields.
+
+Variables available to documents: $customerId, $productId, $jobId, $suffix.
+"""
+
+QUERY_BUDGETS = {
+    # Queries
+    # Connections read one row past the page instead of counting
+    # (crm.connections); selecting totalCount adds a count on a cache miss.
+    'allCustomers': {
+        'budget': 1,
+        'document': '''
+            query { allCustomers(lifetimeValue_Gte: 0, orderBy: "-lifetimeValue") {
+              edges { node { id name email orderCount lifetimeValue lastOrderDate } }
+            } }
+        ''',
+    },
+    'allProducts': {
+        'budget': 1,
+        'document': '''
+            query { allProducts(lowStock: false, price_Gte: 1) {
+              edges { node { id name price stock } }
+            } }
+        ''',
+    },
+    'allOrders': {
+        # archive watermark (crm.archive), orders + customer, products,
+        # items, items' products
+        'budget': 5,
+        'document': '''
+            query { allOrders(totalAmount_Gte: 0) {
+              edges { node {
+                id orderDate totalAmount
+                customer { id name email }
+                products { edges { node { id name price } } }
+                items { product { name } quantity unitPrice }
+              } }
+            } }
+        ''',
+    },
+    'customers': {
+        'budget': 1,
+        'document': 'query { customers { id name orderCount lifetimeValue } }',
+    },
+    'products': {
+        'budget': 1,
+        'document': 'query { products { id name price stock } }',
+    },
+    'orders': {
+        'budget': 4,
+        'document': '''
+            query { orders {
+              id totalAmount
+              customer { name orderCount }
+              items { product { name } quantity }
+            } }
+        ''',
+    },
+    'job': {
+        'budget': 3,
+        'document': '''
+            query($jobId: ID!) { job(id: $jobId) {
+              id status progress errors customers { id name } products { id name }
+            } }
+        ''',
+    },
+    'changes': {
+        'budget': 1,
+        'document': '''
+            query { changes(first: 50) {
+              changes { id entity entityId action payload createdAt } cursor hasMore
+            } }
+        ''',
+    },
+    'revenueSeries': {
+        # archive watermark, then one grouped query (crm.analytics); closed
+        # buckets come from the cache afterwards
+        'budget': 2,
+        'document': '''
+            query { revenueSeries(granularity: MONTH, from: "2020-01-01T00:00:00+00:00", groupBy: PRODUCT) {
+              bucket key revenue orders
+            } }
+        ''',
+    },
+    'topCustomers': {
+        # archive watermark, grouped orders, customers (crm.entity_cache),
+        # their order summaries in one batch (crm.loaders)
+        'budget': 4,
+        'document': '''
+            query { topCustomers(first: 5) { customer { id name email orderCount } revenue orders } }
+        ''',
+    },
+    'hello': {'budget': 0, 'document': 'query { hello }'},
+    'hi': {'budget': 0, 'document': 'query { hi }'},
+
+    # Mutations
+    'createCustomer': {
+        # Every write also appends an outbox row (crm.models.OutboxEvent)
+        'budget': 4,
+        'document': '''
+            mutation($suffix: String!) {
+              createCustomer(name: "Budget", email: $suffix) { customer { id orderCount } message }
+            }
+        ''',
+    },
+    'bulkCreateCustomers': {
+        # Savepoint and release, unique check, insert and outbox insert for
+        # each of the two valid rows, then one order summary query for all
+        # created customers (crm.loaders)
+        'budget': 9,
+        'document': '''
+            mutation($suffix: String!) {
+              bulkCreateCustomers(input: [
+                {name: "A", email: $suffix}, {name: "B", email: "b"}, {name: "C", email: "c@example.org"}
+              ]) { customers { id orderCount lifetimeValue } errors }
+            }
+        ''',
+    },
+    'createProduct': {
+        'budget': 2,
+        'document': '''
+            mutation { createProduct(name: "Budget", price: "9.99", stock: 5) { product { id name } } }
+        ''',
+    },
+    'createOrder': {
+        # transaction (2), customer, products, reserve, stock read back +
+        # outbox, order + outbox, items, total update + outbox, then the
+        # returned items and their products. Customer and products come
+        # from crm.entity_cache once warm; the budget is the cold path.
+        'budget': 14,
+        'document': '''
+            mutation($customerId: ID!, $productId: ID!) {
+              createOrder(customerId: $customerId, items: [{productId: $productId, quantity: 1}]) {
+                order { id totalAmount customer { name } items { product { name } quantity unitPrice } }
+              }
+            }
+        ''',
+    },
+    'adjustStock': {
+        # transaction and savepoint (4), one batched UPDATE (crm.stock),
+        # stock read back, outbox insert
+        'budget': 7,
+        'document': '''
+            mutation($productId: ID!) {
+              adjustStock(adjustments: [{productId: $productId, delta: 5}, {productId: $productId, delta: -2}]) {
+                results { productId stock error }
+              }
+            }
+        ''',
+    },
+    'updateLowStockProducts': {
+        'budget': 6,
+        'document': '''
+            mutation { updateLowStockProducts { updatedProducts { id name stock } success message } }
+        ''',
+    },
+}
@@ -1,47 +1,288 @@
 import graphene
 from graphene_django import DjangoObjectType
-from graphene_django.filter import DjangoFilterConnectionField
+from graphene_django.utils import bypass_get_queryset
+from graphql import GraphQLError
 from django.core.exceptions import ValidationError
 from django.db import transaction
-from crm.models import Customer, Product, Order
+from django.db.models import F, Prefetch
+from django.utils import timezone
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+from crm.models import Customer, Product, Order, OrderItem, ArchivedOrder, ArchivedOrderItem, Job, OutboxEvent
+from . import analytics, counts
+from .connections import CachedFilterConnectionField, CountableConnection, CountStrategy, OrderHistoryConnectionField
+from .entity_cache import customers as customer_cache, products as product_cache
 from .filters import CustomerFilter, ProductFilter, OrderFilter
+from .loaders import get_order_summary_loader
+from .outbox import read_changes
+from .stock import adjust_stock_many, reserve_stock, InsufficientStock
+from .subscriptions import ORDER_CREATED, STOCK_CHANGED, listen, notify_stock_changed
+from collections import Counter
+from datetime import datetime
+
+ORDER_SUMMARY_GRAPHQL_FIELDS = {'orderCount', 'lifetimeValue', 'lastOrderDate'}
+
+def selects_any(info, names):
+    """True if any field in `names` appears anywhere below the current field."""
+    def walk(selection_set):
+        if selection_set is None:
+            return False
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                if selection.name.value in names or walk(selection.selection_set):
+                    return True
+            elif isinstance(selection, FragmentSpreadNode):
+                if walk(info.fragments[selection.name.value].selection_set):
+                    return True
+            elif isinstance(selection, InlineFragmentNode):
+                if walk(selection.selection_set):
+                    return True
+        return False
+    return any(walk(node.selection_set) for node in info.field_nodes)
 
 class CustomerType(DjangoObjectType):
+    order_count = graphene.Int()
+    lifetime_value = graphene.Decimal()
+    last_order_date = graphene.DateTime()
+
     class Meta:
         model = Customer
         fields = ("id", "name", "email", "phone", "created_at")
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        # Compute the summaries in the same query when they are selected
+        if selects_any(info, ORDER_SUMMARY_GRAPHQL_FIELDS):
+            queryset = queryset.with_order_summary()
+        return queryset
+
+    @classmethod
+    def get_node(cls, info, id):
+        # Plain lookups (Relay ids, foreign keys) come from the entity
+        # cache; the order summary needs the annotated query
+        if selects_any(info, ORDER_SUMMARY_GRAPHQL_FIELDS):
+            return super().get_node(info, id)
+        try:
+            return customer_cache.get(id)
+        except Customer.DoesNotExist:
+            return None
+
+    @staticmethod
+    def prime_order_summaries(info, customers):
+        """
+        Load the order summaries of `customers` (not annotated, e.g. created
+        by a mutation or taken from the entity cache) with one query when
+        they are selected below the current field, so each customer's
+        resolver then finds its summary in the loader.
+        """
+        if selects_any(info, ORDER_SUMMARY_GRAPHQL_FIELDS):
+            get_order_summary_loader(info.context).load_many(
+                [c.pk for c in customers if c is not None and not hasattr(c, 'order_count')]
+            )
+
+    def _order_summary(self, info, field):
+        if hasattr(self, field):
+            return getattr(self, field)
+        return get_order_summary_loader(info.context).load(self.pk)[field]
+
+    def resolve_order_count(self, info):
+        return CustomerType._order_summary(self, info, 'order_count')
+
+    def resolve_lifetime_value(self, info):
+        return CustomerType._order_summary(self, info, 'lifetime_value')
+
+    def resolve_last_order_date(self, info):
+        return CustomerType._order_summary(self, info, 'last_order_date')
 
 class ProductType(DjangoObjectType):
     class Meta:
         model = Product
         fields = ("id", "name", "price", "stock")
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    @classmethod
+    def get_node(cls, info, id):
+        # Stock is not cached (see crm.entity_cache); query it directly
+        if selects_any(info, {'stock'}):
+            return super().get_node(info, id)
+        try:
+            return product_cache.get(id)
+        except Product.DoesNotExist:
+            return None
+
+class OrderItemType(DjangoObjectType):
+    class Meta:
+        model = OrderItem
+        fields = ("product", "quantity", "unit_price")
+
+    @classmethod
+    def is_type_of(cls, root, info):
+        return isinstance(root, ArchivedOrderItem) or super().is_type_of(root, info)
 
 class OrderType(DjangoObjectType):
     class Meta:
         model = Order
-        fields = ("id", "customer", "products", "order_date", "total_amount")
+        fields = ("id", "customer", "products", "items", "order_date", "total_amount")
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        # Load the related rows for the whole page up front instead of per order
+        if selects_any(info, ORDER_SUMMARY_GRAPHQL_FIELDS):
+            # Annotated customers for the whole page in one extra query
+            queryset = queryset.prefetch_related(
+                Prefetch('customer', queryset=Customer.objects.with_order_summary())
+            )
+        elif selects_any(info, {'customer'}):
+            queryset = queryset.select_related('customer')
+        if selects_any(info, {'products'}):
+            queryset = queryset.prefetch_related('products')
+        if selects_any(info, {'items'}):
+            queryset = queryset.prefetch_related('items__product')
+        return queryset
+
+    @classmethod
+    def is_type_of(cls, root, info):
+        # Archived orders (crm.archive) are served as orders
+        return isinstance(root, ArchivedOrder) or super().is_type_of(root, info)
+
+    @bypass_get_queryset
+    def resolve_customer(self, info):
+        # Use the (possibly prefetched) customer instead of a get_node per row
+        return self.customer
+
+class JobType(DjangoObjectType):
+    progress = graphene.Float()
+    errors = graphene.List(graphene.String)
+    customers = graphene.List(CustomerType)
+    products = graphene.List(ProductType)
+
+    class Meta:
+        model = Job
+        fields = ("id", "kind", "status", "total", "processed", "result", "errors", "created_at", "updated_at", "finished_at")
+
+    def resolve_customers(self, info):
+        # Partial results: customers created so far by a bulk job
+        customers = Customer.objects.filter(pk__in=self.result.get('customer_ids', []))
+        return CustomerType.get_queryset(customers, info)
+
+    def resolve_products(self, info):
+        return Product.objects.filter(pk__in=self.result.get('product_ids', []))
+
+class ChangeType(DjangoObjectType):
+    """One outbox event; `id` is the cursor to resume from."""
+    class Meta:
+        model = OutboxEvent
+        fields = ("id", "entity", "entity_id", "action", "payload", "created_at")
+
+class ChangeFeedType(graphene.ObjectType):
+    changes = graphene.List(ChangeType)
+    cursor = graphene.ID(description="Pass as `since` to fetch the next page")
+    has_more = graphene.Boolean()
+
+class Granularity(graphene.Enum):
+    DAY = 'day'
+    WEEK = 'week'
+    MONTH = 'month'
+
+class RevenueGroupBy(graphene.Enum):
+    PRODUCT = 'product'
+    CUSTOMER = 'customer'
+
+class RevenuePointType(graphene.ObjectType):
+    """Revenue in one time bucket, for one product or customer when grouped."""
+    bucket = graphene.DateTime(description="Start of the day, week or month")
+    key = graphene.ID(description="Product or customer id; null when not grouped")
+    revenue = graphene.Decimal()
+    orders = graphene.Int()
+
+class TopCustomerType(graphene.ObjectType):
+    customer = graphene.Field(CustomerType)
+    revenue = graphene.Decimal()
+    orders = graphene.Int()
 
 class Query(graphene.ObjectType):
-    all_customers = DjangoFilterConnectionField(CustomerType, filterset_class=CustomerFilter, order_by=graphene.List(graphene.String))
-    all_products = DjangoFilterConnectionField(ProductType, filterset_class=ProductFilter, order_by=graphene.List(graphene.String))
-    all_orders = DjangoFilterConnectionField(OrderType, filterset_class=OrderFilter, order_by=graphene.List(graphene.String))
+    # The large tables count up to CRM_COUNT_CAP by default (see crm.connections)
+    all_customers = CachedFilterConnectionField(CustomerType, filterset_class=CustomerFilter, order_by=graphene.List(graphene.String), count_strategy=CountStrategy.CAPPED)
+    all_products = CachedFilterConnectionField(ProductType, filterset_class=ProductFilter, order_by=graphene.List(graphene.String))
+    all_orders = OrderHistoryConnectionField(OrderType, filterset_class=OrderFilter, order_by=graphene.List(graphene.String), count_strategy=CountStrategy.CAPPED)
 
     # Keep the old ones for backward compatibility or remove if not needed
     customers = graphene.List(CustomerType)
     products = graphene.List(ProductType)
     orders = graphene.List(OrderType)
 
+    job = graphene.Field(JobType, id=graphene.ID(required=True))
+
+    changes = graphene.Field(
+        ChangeFeedType,
+        since=graphene.ID(description="Cursor from a previous page; omit to start from the beginning"),
+        first=graphene.Int(default_value=100),
+        entity=graphene.String(description="Only 'customer', 'product' or 'order' changes"),
+    )
+
+    revenue_series = graphene.List(
+        RevenuePointType,
+        granularity=Granularity(required=True),
+        from_=graphene.DateTime(name='from', required=True),
+        to=graphene.DateTime(description="Defaults to now"),
+        group_by=RevenueGroupBy(),
+    )
+    top_customers = graphene.List(
+        TopCustomerType,
+        first=graphene.Int(default_value=10),
+        from_=graphene.DateTime(name='from'),
+        to=graphene.DateTime(),
+    )
+
+    def resolve_revenue_series(self, info, granularity, from_, to=None, group_by=None):
+        try:
+            return analytics.revenue_series(
+                granularity.value, from_, to or timezone.now(), group_by.value if group_by else None,
+            )
+        except ValueError as e:
+            raise GraphQLError(str(e))
+
+    def resolve_top_customers(self, info, first=10, from_=None, to=None):
+        if first < 1 or first > 100:
+            raise GraphQLError("first must be between 1 and 100")
+        rows = analytics.top_customers(first, from_, to)
+        customers = customer_cache.get_many(row['customer_id'] for row in rows)
+        CustomerType.prime_order_summaries(info, customers.values())
+        return [
+            TopCustomerType(customer=customers.get(row['customer_id']), revenue=row['revenue'], orders=row['orders'])
+            for row in rows
+        ]
+
+    def resolve_changes(self, info, since=None, first=100, entity=None):
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            raise GraphQLError(f"Invalid cursor: {since}")
+        events, has_more = read_changes(since, first, entity)
+        return ChangeFeedType(
+            changes=events,
+            cursor=events[-1].id if events else since,
+            has_more=has_more,
+        )
+
+    def resolve_job(self, info, id):
+        try:
+            return Job.objects.get(pk=id)
+        except (Job.DoesNotExist, ValidationError):
+            return None
+
     def resolve_customers(self, info):
-        return Customer.objects.all()
+        return CustomerType.get_queryset(Customer.objects.all(), info)
 
     def resolve_products(self, info):
         return Product.objects.all()
 
     def resolve_orders(self, info):
-        return Order.objects.all()
+        return OrderType.get_queryset(Order.objects.all(), info)
 
 # Mutations
 
@@ -61,9 +302,9 @@ class CreateCustomer(graphene.Mutation):
             customer.save()
             return CreateCustomer(customer=customer, message="Customer created successfully")
         except ValidationError as e:
-            raise graphene.GraphQLError(str(e))
+            raise GraphQLError(str(e))
         except Exception as e:
-            raise graphene.GraphQLError(f"Error creating customer: {str(e)}")
+            raise GraphQLError(f"Error creating customer: {str(e)}")
 
 class CustomerInput(graphene.InputObjectType):
     name = graphene.String(required=True)
@@ -73,12 +314,24 @@ class CustomerInput(graphene.InputObjectType):
 class BulkCreateCustomers(graphene.Mutation):
     class Arguments:
         input = graphene.List(CustomerInput, required=True)
+        run_async = graphene.Boolean(default_value=False)
 
     customers = graphene.List(CustomerType)
     errors = graphene.List(graphene.String)
+    job_id = graphene.ID()
 
     @transaction.atomic
-    def mutate(self, info, input):
+    def mutate(self, info, input, run_async=False):
+        if run_async:
+            from .tasks import enqueue_job, bulk_create_customers
+            rows = [
+                {'name': c.name, 'email': c.email, 'phone': getattr(c, 'phone', None)}
+                for c in input
+            ]
+            job = Job.objects.create(kind='bulk_create_customers', total=len(rows))
+            enqueue_job(job, bulk_create_customers, rows)
+            return BulkCreateCustomers(customers=[], errors=[], job_id=job.pk)
+
         created = []
         errors = []
         for i, cust_data in enumerate(input):
@@ -93,6 +346,9 @@ class BulkCreateCustomers(graphene.Mutation):
                 created.append(customer)
             except Exception as e:
                 errors.append(f"Customer {i+1}: {str(e)}")
+        if created:
+            counts.invalidate()
+        CustomerType.prime_order_summaries(info, created)
         return BulkCreateCustomers(customers=created, errors=errors)
 
 class CreateProduct(graphene.Mutation):
@@ -110,78 +366,205 @@ class CreateProduct(graphene.Mutation):
             product.save()
             return CreateProduct(product=product)
         except ValidationError as e:
-            raise graphene.GraphQLError(str(e))
+            raise GraphQLError(str(e))
+
+class OrderItemInput(graphene.InputObjectType):
+    product_id = graphene.ID(required=True)
+    quantity = graphene.Int(default_value=1)
 
 class CreateOrder(graphene.Mutation):
+    """
+    Create an order and reserve stock for it in one transaction.
+    Products can be given as productIds (quantity 1 each) and/or items with
+    quantities; the order fails if any product lacks the stock.
+    """
     class Arguments:
         customer_id = graphene.ID(required=True)
-        product_ids = graphene.List(graphene.ID, required=True)
+        product_ids = graphene.List(graphene.ID)
+        items = graphene.List(OrderItemInput)
         order_date = graphene.DateTime()
 
     order = graphene.Field(OrderType)
 
-    def mutate(self, info, customer_id, product_ids, order_date=None):
+    def mutate(self, info, customer_id, product_ids=None, items=None, order_date=None):
         try:
-            customer = Customer.objects.get(pk=customer_id)
-            products = Product.objects.filter(pk__in=product_ids)
-            if not products.exists():
-                raise graphene.GraphQLError("No valid products found")
-            if len(products) != len(product_ids):
-                raise graphene.GraphQLError("Some product IDs are invalid")
-            order = Order(customer=customer, order_date=order_date)
-            order.save()
-            order.products.set(products)
-            order.total_amount = sum(p.price for p in products)
-            order.save()
+            quantities = Counter()
+            for product_id in product_ids or []:
+                quantities[int(product_id)] += 1
+            for item in items or []:
+                if item.quantity is None or item.quantity < 1:
+                    raise GraphQLError("Quantity must be at least 1")
+                quantities[int(item.product_id)] += item.quantity
+            if not quantities:
+                raise GraphQLError("At least one product is required")
+
+            with transaction.atomic():
+                # The entity cache only answers whether the customer and
+                # products exist. Stock is checked and taken by
+                # reserve_stock in the database, and the prices charged come
+                # from its read-back of the rows, never from the cache.
+                customer = customer_cache.get(customer_id)
+                products = product_cache.get_many(quantities)
+                if not products:
+                    raise GraphQLError("No valid products found")
+                if len(products) != len(quantities):
+                    raise GraphQLError("Some product IDs are invalid")
+                products = reserve_stock(quantities)
+                order = Order.objects.create(customer=customer, order_date=order_date)
+                order.add_items([
+                    OrderItem(product=products[pk], quantity=qty)
+                    for pk, qty in quantities.items()
+                ])
             return CreateOrder(order=order)
         except Customer.DoesNotExist:
-            raise graphene.GraphQLError("Customer not found")
+            raise GraphQLError("Customer not found")
+        except InsufficientStock as e:
+            raise GraphQLError(str(e))
+        except (ValueError, TypeError):
+            raise GraphQLError("Some product IDs are invalid")
+        except Exception as e:
+            raise GraphQLError(str(e))
+
+class StockAdjustmentInput(graphene.InputObjectType):
+    product_id = graphene.ID(required=True)
+    delta = graphene.Int(required=True, description="Units to add; negative to remove")
+
+class StockAdjustmentResultType(graphene.ObjectType):
+    product_id = graphene.ID()
+    stock = graphene.Int(description="Stock after the adjustment was committed")
+    error = graphene.String()
+
+class AdjustStock(graphene.Mutation):
+    """
+    Add to or remove from product stock. Adjustments are coalesced with
+    concurrent ones into one UPDATE (see crm.stock) and reported only once
+    committed. Each is accepted or rejected on its own; stock never goes
+    below zero.
+    """
+    class Arguments:
+        adjustments = graphene.List(graphene.NonNull(StockAdjustmentInput), required=True)
+
+    results = graphene.List(StockAdjustmentResultType)
+
+    def mutate(self, info, adjustments):
+        try:
+            outcomes = adjust_stock_many([(a.product_id, a.delta) for a in adjustments])
+        except (ValueError, TypeError):
+            raise GraphQLError("Some product IDs are invalid")
         except Exception as e:
-            raise graphene.GraphQLError(str(e))
+            raise GraphQLError(f"Error adjusting stock: {str(e)}")
+        return AdjustStock(results=[
+            StockAdjustmentResultType(product_id=a.product_id, error=str(outcome))
+            if isinstance(outcome, Exception) else
+            StockAdjustmentResultType(product_id=a.product_id, stock=outcome)
+            for a, outcome in zip(adjustments, outcomes)
+        ])
 
 class UpdateLowStockProducts(graphene.Mutation):
     """
     Mutation to update low-stock products (stock < 10).
     Increments stock by 10 for each product and returns updated products.
+    With runAsync: true the update runs on Celery and a job id is returned instead.
     """
     class Arguments:
-        pass
+        run_async = graphene.Boolean(default_value=False)
 
     updated_products = graphene.List(ProductType)
     success = graphene.Boolean()
     message = graphene.String()
+    job_id = graphene.ID()
+
+    def mutate(self, info, run_async=False):
+        if run_async:
+            from .tasks import enqueue_job, update_low_stock_products
+            with transaction.atomic():
+                job = Job.objects.create(kind='update_low_stock_products')
+                enqueue_job(job, update_low_stock_products)
+            return UpdateLowStockProducts(
+                updated_products=[],
+                success=True,
+                message="Low stock update queued",
+                job_id=job.pk
+            )
 
-    def mutate(self, info):
         try:
             # Query products with stock < 10
-            low_stock_products = Product.objects.filter(stock__lt=10)
-            
-            if not low_stock_products.exists():
+            low_stock_ids = list(Product.objects.filter(stock__lt=10).values_list('pk', flat=True))
+
+            if not low_stock_ids:
                 return UpdateLowStockProducts(
                     updated_products=[],
                     success=True,
                     message="No products with low stock found"
                 )
-            
-            # Increment stock by 10 for each product
-            updated_products = []
-            for product in low_stock_products:
-                product.stock += 10
-                product.full_clean()
-                product.save()
-                updated_products.append(product)
-            
+
+            # Increment stock by 10 for each product in one UPDATE; adding to
+            # stock keeps Product.clean's invariants (price untouched, stock >= 0)
+            with transaction.atomic():
+                Product.objects.filter(pk__in=low_stock_ids).update(stock=F('stock') + 10)
+                updated_products = list(Product.objects.filter(pk__in=low_stock_ids))
+                OutboxEvent.record(updated_products, OutboxEvent.UPDATED)
+                notify_stock_changed(updated_products, {p.pk: p.stock - 10 for p in updated_products})
+
             return UpdateLowStockProducts(
                 updated_products=updated_products,
                 success=True,
                 message=f"Successfully updated {len(updated_products)} products"
             )
         except Exception as e:
-            raise graphene.GraphQLError(f"Error updating low stock products: {str(e)}")
+            raise GraphQLError(f"Error updating low stock products: {str(e)}")
 
 class Mutation(graphene.ObjectType):
     create_customer = CreateCustomer.Field()
     bulk_create_customers = BulkCreateCustomers.Field()
     create_product = CreateProduct.Field()
     create_order = CreateOrder.Field()
-    update_low_stock_products = UpdateLowStockProducts.Field()
\ No newline at end of file
+    adjust_stock = AdjustStock.Field()
+    update_low_stock_products = UpdateLowStockProducts.Field()
+
+
+# Subscriptions
+
+class OrderEventType(graphene.ObjectType):
+    """An order that was just created (see crm.subscriptions)."""
+    id = graphene.ID()
+    customer_id = graphene.ID()
+    total_amount = graphene.Decimal()
+    order_date = graphene.DateTime()
+
+    def resolve_order_date(self, info):
+        return datetime.fromisoformat(self['order_date'])
+
+
+class StockEventType(graphene.ObjectType):
+    """A product's stock level after it changed."""
+    product_id = graphene.ID()
+    name = graphene.String()
+    stock = graphene.Int()
+    previous_stock = graphene.Int(description="Stock before the change, when the writer knows it")
+
+
+def _dropped_below(event, threshold):
+    # Without the previous level, any level below the threshold is reported
+    previous = event.get('previous_stock')
+    return event['stock'] < threshold and (previous is None or previous >= threshold)
+
+
+class Subscription(graphene.ObjectType):
+    order_created = graphene.Field(OrderEventType)
+    stock_changed = graphene.Field(
+        StockEventType,
+        threshold=graphene.Int(description=(
+            "Only report products whose stock drops below this level, i.e. was at "
+            "or above it before the change and is below it after"
+        )),
+    )
+
+    async def subscribe_order_created(root, info):
+        async for event in listen(ORDER_CREATED):
+            yield event
+
+    async def subscribe_stock_changed(root, info, threshold=None):
+        async for event in listen(STOCK_CHANGED):
+            if threshold is None or _dropped_below(event, threshold):
+                yield event
@@ -0,0 +1,80 @@
+"""
+Deterministic synthetic data for benchmarks and query-count tests.
+
+    from crm.seed import seed
+    seed(customers=1000, products=200, orders=5000)
+
+Everything is written with bulk_create, so seeding tens of thousands of
+rows takes seconds. The same `random_seed` always produces the same data.
+"""
+
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Customer, Product, Order, OrderItem, bulk_create_orders
+
+
+def seed(customers=100, products=50, orders=500, items_per_order=3, days=365,
+         low_stock_ratio=0.1, random_seed=0, batch_size=2000):
+    """
+    Create customers, products and orders with 1..items_per_order line
+    items each. Orders are spread over the last `days` days and roughly
+    `low_stock_ratio` of products are created below the low-stock threshold.
+    Returns the counts created.
+    """
+    rng = random.Random(random_seed)
+    now = timezone.now()
+    # Emails only need to be unique within one database
+    tag = Customer.objects.count()
+
+    with transaction.atomic():
+        customer_objs = Customer.objects.bulk_create(
+            [
+                Customer(
+                    name=f"Customer {tag + i}",
+                    email=f"customer{tag + i}@example.com",
+                    phone=f"+1555{rng.randrange(10**6, 10**7)}",
+                )
+                for i in range(customers)
+            ],
+            batch_size=batch_size,
+        )
+        product_objs = Product.objects.bulk_create(
+            [
+                Product(
+                    name=f"Product {i}",
+                    price=Decimal(rng.randrange(100, 50000)) / 100,
+                    stock=rng.randrange(0, 10) if rng.random() < low_stock_ratio else rng.randrange(10, 10000),
+                )
+                for i in range(products)
+            ],
+            batch_size=batch_size,
+        )
+
+        order_objs, order_items = [], []
+        for _ in range(orders if customer_objs and product_objs else 0):
+            chosen = rng.sample(product_objs, min(len(product_objs), rng.randint(1, items_per_order)))
+            items = [OrderItem(product=p, quantity=rng.randint(1, 5), unit_price=p.price) for p in chosen]
+            order_objs.append(Order(
+                customer=rng.choice(customer_objs),
+                order_date=now - timedelta(seconds=rng.randrange(days * 86400)),
+                total_amount=sum(item.line_total for item in items),
+            ))
+            order_items.append(items)
+
+        bulk_create_orders(order_objs, batch_size=batch_size)
+        for order, items in zip(order_objs, order_items):
+            for item in items:
+                item.order = order
+        OrderItem.objects.bulk_create([i for items in order_items for i in items], batch_size=batch_size)
+
+    return {
+        'customers': len(customer_objs),
+        'products': len(product_objs),
+        'orders': len(order_objs),
+        'order_items': sum(len(items) for items in order_items),
+    }
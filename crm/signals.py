@@ -0,0 +1,71 @@
+"""
+Model hooks that feed the GraphQL subscriptions (see crm.subscriptions),
+record deletes in the outbox and invalidate cached entities (see
+crm.entity_cache), revenue buckets (see crm.analytics) and, on deletes,
+connection counts (see crm.counts).
+
+Bulk writes (bulk_create, queryset.update) bypass these hooks; code paths
+that change stock that way call notify_stock_changed() themselves.
+"""
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import analytics, counts, entity_cache
+from .models import Customer, Order, OutboxEvent, Product
+from .subscriptions import notify_order_created, notify_stock_changed
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        notify_order_created(instance)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if created or update_fields is None or 'stock' in update_fields:
+        previous = None if created else getattr(instance, '_saved_stock', None)
+        notify_stock_changed([instance], {instance.pk: previous})
+        instance._saved_stock = instance.stock
+
+
+# post_delete runs inside the deletion's transaction (including cascades),
+# unlike post_save, so deletes are recorded here rather than in OutboxMixin.
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Order)
+def outbox_deleted(sender, instance, **kwargs):
+    OutboxEvent.record([instance], OutboxEvent.DELETED)
+
+
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Order)
+def counts_deleted(sender, instance, **kwargs):
+    counts.invalidate()
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_save, sender=Product)
+def entity_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Stock-only saves leave every cached field as it was
+    if update_fields is not None and set(update_fields) <= {'stock'}:
+        return
+    entity_cache.invalidate(instance)
+
+
+@receiver(post_delete, sender=Customer)
+@receiver(post_delete, sender=Product)
+def entity_deleted(sender, instance, **kwargs):
+    entity_cache.invalidate(instance)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def order_changed(sender, instance, raw=False, **kwargs):
+    # New orders land in today's buckets, which are never cached
+    if not raw:
+        analytics.invalidate(instance.order_date)
@@ -0,0 +1,144 @@
+"""
+Slow-query log: every SQL statement slower than CRM_SLOW_QUERY_MS is
+written through crm.logsink (logger 'slow_queries') as one JSON line with
+
+  ms, sql, params        the statement as Django sent it
+  fingerprint            hash of the statement with literals, IN lists and
+                         repeated OR terms collapsed, so the same filter or
+                         order_by combination always groups together
+  operation, path        the GraphQL operation and resolver path
+                         (allOrders.edges.0.node.items) that ran it, when
+                         it ran under /graphql
+  plan                   EXPLAIN (QUERY PLAN on SQLite) output, computed
+                         once per fingerprint per process for SELECTs
+
+The timing hook is an execute wrapper installed on every database
+connection, so queries from Celery tasks and management commands are
+logged too; below the threshold it costs two clock reads. The operation
+and path come from ResolverPathMiddleware, a graphene middleware
+(GRAPHENE['MIDDLEWARE']). `manage.py crm_slow_queries` aggregates the
+log by fingerprint.
+
+CRM_SLOW_QUERY_MS = None turns the log off; CRM_SLOW_QUERY_EXPLAIN = False
+skips the EXPLAINs.
+"""
+
+import contextvars
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .logsink import get_logger
+
+LOG_PATH = '/tmp/crm_slow_queries.log'
+DEFAULT_THRESHOLD_MS = 100
+MAX_PARAMS_LENGTH = 500
+PLAN_CACHE_SIZE = 1024
+
+# (operation name, graphql Path) of the resolver running in this context
+_resolving = contextvars.ContextVar('crm_slowlog_resolving', default=(None, None))
+
+_plans = OrderedDict()  # fingerprint -> plan lines
+_plans_lock = threading.Lock()
+
+_NORMALIZE = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),                    # string literals
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),                 # numbers (LIMIT 101, ...)
+    (re.compile(r'%s'), '?'),                                # placeholders
+    (re.compile(r'\bIN \(\?(?:\s*,\s*\?)*\)'), 'IN (...)'),  # IN lists of any length
+    (re.compile(r'(\S+ = \?)(?: OR \1)+'), r'\1 OR ...'),    # x = ? OR x = ? OR ...
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize(sql):
+    for pattern, replacement in _NORMALIZE:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def fingerprint(sql):
+    return hashlib.md5(normalize(sql).encode()).hexdigest()[:12]
+
+
+class ResolverPathMiddleware:
+    """Graphene middleware remembering which operation and field is resolving, for the slow-query log."""
+
+    def resolve(self, next, root, info, **args):
+        operation = info.operation.name.value if info.operation.name else None
+        token = _resolving.set((operation, info.path))
+        try:
+            return next(root, info, **args)
+        finally:
+            _resolving.reset(token)
+
+
+def _explain(connection, sql, params):
+    # A backend cursor: no execute wrappers (this one included) and no
+    # debug query log, so the EXPLAIN is neither timed nor counted
+    cursor = connection.create_cursor()
+    try:
+        cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}", params)
+        return [str(row[-1]) if connection.vendor == 'sqlite' else ' '.join(map(str, row)) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def _plan(connection, sql, params, key):
+    with _plans_lock:
+        if key in _plans:
+            _plans.move_to_end(key)
+            return _plans[key]
+    try:
+        plan = _explain(connection, sql, params)
+    except Exception as e:
+        plan = [f"EXPLAIN failed: {type(e).__name__}: {e}"]
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+    return plan
+
+
+def _report(entry):
+    get_logger('slow_queries', LOG_PATH).warning('Slow query', extra=entry)
+
+
+def record_slow_queries(execute, sql, params, many, context):
+    started = time.perf_counter()
+    succeeded = False
+    try:
+        result = execute(sql, params, many, context)
+        succeeded = True
+        return result
+    finally:
+        ms = (time.perf_counter() - started) * 1000
+        threshold = getattr(settings, 'CRM_SLOW_QUERY_MS', DEFAULT_THRESHOLD_MS)
+        if threshold is not None and ms >= threshold:
+            operation, path = _resolving.get()
+            entry = {
+                'ms': round(ms, 3),
+                'fingerprint': fingerprint(sql),
+                'sql': sql,
+                'params': repr(params)[:MAX_PARAMS_LENGTH],
+                'operation': operation,
+                'path': '.'.join(map(str, path.as_list())) if path else None,
+                'failed': not succeeded,
+            }
+            # After a failure the transaction may be unusable for EXPLAIN
+            explainable = succeeded and not many and sql.lstrip()[:6].upper() in ('SELECT', 'WITH')
+            if explainable and getattr(settings, 'CRM_SLOW_QUERY_EXPLAIN', True):
+                entry['plan'] = _plan(context['connection'], sql, params, entry['fingerprint'])
+            _report(entry)
+
+
+@receiver(connection_created)
+def install(sender, connection, **kwargs):
+    if record_slow_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_slow_queries)
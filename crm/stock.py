@@ -0,0 +1,220 @@
+"""
+Stock reservation for order creation, and coalesced stock adjustments.
+
+Stock is decremented with conditional UPDATEs (stock = stock - n WHERE
+stock >= n) so the check and the write happen in one statement in the
+database, instead of a read-modify-write in Python that races under
+concurrent orders.
+
+adjust_stock() is for bursts of small changes to the same products
+(restocking, corrections): instead of a save() per change, concurrent
+adjustments in this process are collected for up to
+CRM_STOCK_COALESCE_WINDOW seconds (or CRM_STOCK_COALESCE_MAX_BATCH
+adjustments) and written in one transaction with one UPDATE, adding each
+product's net delta:
+
+    UPDATE crm_product SET stock = stock + CASE id WHEN 1 THEN 5 WHEN 2 THEN -3 END
+    WHERE id IN (1, 2) AND stock + CASE ... END >= 0
+
+The first caller in a window waits it out and writes the batch; the others
+wait for that write. Each caller gets its result only after the batch has
+committed, so a returned adjustment is durable. There is no timeout on
+that wait: the batch is being written by another request's thread, which
+always resolves it (committed, rejected or failed), so giving up early
+would only report as failed an adjustment that may still commit. Adjustments in one batch
+count as simultaneous: all are accepted when every product's net delta
+fits. If some product's net delta would take it below zero, the batch
+instead locks the rows and applies adjustments in arrival order,
+rejecting (with InsufficientStock) those that do not fit, so stock never
+goes negative and one rejection does not fail the others.
+
+Inside a transaction, adjustments are applied there directly, since a
+separate commit would not roll back with the caller's. The window is per
+process: in a single-threaded worker a caller only batches with itself
+(adjust_stock_many), so CRM_STOCK_COALESCE_WINDOW = 0 suits those.
+"""
+
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.lookups import GreaterThanOrEqual
+
+from .models import OutboxEvent, Product
+from .subscriptions import notify_stock_changed
+
+DEFAULT_COALESCE_WINDOW = 0.01
+DEFAULT_COALESCE_MAX_BATCH = 500
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id, quantity):
+        self.product_id = product_id
+        self.quantity = quantity
+        super().__init__(f"Insufficient stock for product {product_id} (requested {quantity})")
+
+
+def reserve_stock(quantities):
+    """
+    Decrement stock for {product_id: quantity}, all or nothing, and return
+    {product_id: product} as read back from the database after the update.
+
+    Must run inside the caller's transaction: if any product cannot cover
+    its quantity InsufficientStock is raised and the transaction rolls back
+    the decrements already made. Products are updated in primary key order
+    so concurrent reservations lock rows in the same order.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError("reserve_stock() must be called inside transaction.atomic()")
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        updated = Product.objects.filter(pk=product_id, stock__gte=quantity).update(
+            stock=F('stock') - quantity
+        )
+        if not updated:
+            raise InsufficientStock(product_id, quantity)
+    products = list(Product.objects.filter(pk__in=quantities))
+    OutboxEvent.record(products, OutboxEvent.UPDATED)
+    notify_stock_changed(products, {p.pk: p.stock + quantities[p.pk] for p in products})
+    return {product.pk: product for product in products}
+
+
+class _Rejected(Exception):
+    """Rolls back the batched UPDATE when some product cannot take its net delta."""
+
+
+def _net_update(deltas):
+    """Add {product_id: delta} to stock in one UPDATE, unless some product would go negative."""
+    delta = Case(*[When(pk=pk, then=Value(d)) for pk, d in deltas.items()], output_field=IntegerField())
+    return (
+        Product.objects.filter(GreaterThanOrEqual(F('stock') + delta, 0), pk__in=list(deltas))
+        .update(stock=F('stock') + delta)
+    )
+
+
+def apply_adjustments(adjustments):
+    """
+    Apply [(product_id, delta)] in one transaction (joining the caller's,
+    if any). Returns one result per adjustment, in order: the product's
+    stock after the batch, or the exception that rejected it.
+    """
+    deltas = defaultdict(int)
+    for product_id, delta in adjustments:
+        deltas[product_id] += delta
+    results = [None] * len(adjustments)
+
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                if _net_update(deltas) != len(deltas):
+                    raise _Rejected
+        except _Rejected:
+            # Rare: stock ran out, or a product does not exist. Lock the
+            # rows and decide each adjustment in arrival order.
+            stock = dict(Product.objects.select_for_update().filter(pk__in=list(deltas)).values_list('pk', 'stock'))
+            deltas = defaultdict(int)
+            for i, (product_id, delta) in enumerate(adjustments):
+                if product_id not in stock:
+                    results[i] = Product.DoesNotExist(f"Product {product_id} does not exist")
+                elif stock[product_id] + delta < 0:
+                    results[i] = InsufficientStock(product_id, -delta)
+                else:
+                    stock[product_id] += delta
+                    deltas[product_id] += delta
+            if deltas:
+                _net_update(deltas)
+
+        products = {p.pk: p for p in Product.objects.filter(pk__in=list(deltas))}
+        if products:
+            OutboxEvent.record(list(products.values()), OutboxEvent.UPDATED)
+            notify_stock_changed(list(products.values()), {pk: p.stock - deltas[pk] for pk, p in products.items()})
+    for i, (product_id, _) in enumerate(adjustments):
+        if results[i] is None:
+            results[i] = products[product_id].stock
+    return results
+
+
+class StockWriter:
+    """Coalesces concurrent adjustments in this process into batches (see the module docstring)."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = []  # (product_id, delta, future)
+        self._collecting = False
+
+    def submit(self, adjustments):
+        """
+        Queue [(product_id, delta)]; returns a future per adjustment that
+        resolves once it is committed.
+        """
+        batch = [(int(product_id), delta, Future()) for product_id, delta in adjustments]
+        futures = [future for _, _, future in batch]
+        if transaction.get_connection().in_atomic_block:
+            # Coalescing would commit them separately from the caller's
+            # transaction; apply them in that transaction instead
+            self._resolve(batch, apply_adjustments([(pk, d) for pk, d, _ in batch]))
+            return futures
+
+        window = getattr(settings, 'CRM_STOCK_COALESCE_WINDOW', DEFAULT_COALESCE_WINDOW)
+        max_batch = getattr(settings, 'CRM_STOCK_COALESCE_MAX_BATCH', DEFAULT_COALESCE_MAX_BATCH)
+        with self._cond:
+            self._pending.extend(batch)
+            if self._collecting:
+                if len(self._pending) >= max_batch:
+                    self._cond.notify_all()
+                return futures
+            # First in the window: collect, then write the batch from this thread
+            self._collecting = True
+            self._cond.wait_for(lambda: len(self._pending) >= max_batch, timeout=window)
+            batch, self._pending, self._collecting = self._pending, [], False
+
+        try:
+            results = apply_adjustments([(pk, d) for pk, d, _ in batch])
+        except BaseException as e:
+            # Other callers wait on these futures without a timeout
+            for _, _, future in batch:
+                future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            self._resolve(batch, results)
+        return futures
+
+    @staticmethod
+    def _resolve(batch, results):
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+writer = StockWriter()
+
+
+def adjust_stock_many(adjustments):
+    """
+    Submit [(product_id, delta)] together (negative deltas remove stock)
+    and wait for them to commit. Returns, per adjustment, the product's
+    stock after its batch or the exception that rejected it
+    (InsufficientStock, Product.DoesNotExist). If the batch's write fails,
+    its exception is raised and none of the batch was applied.
+    """
+    results = []
+    for future in writer.submit(adjustments):
+        try:
+            results.append(future.result())
+        except (InsufficientStock, Product.DoesNotExist) as e:
+            results.append(e)
+    return results
+
+
+def adjust_stock(product_id, delta):
+    """Add `delta` to one product's stock; returns the stock after, or raises if rejected."""
+    [result] = adjust_stock_many([(product_id, delta)])
+    if isinstance(result, Exception):
+        raise result
+    return result
@@ -0,0 +1,180 @@
+"""
+Event pub/sub behind the orderCreated and stockChanged subscriptions.
+
+Writers call the notify_* helpers from ordinary (sync) Django code; the
+events are published once the surrounding transaction commits. Subscribers
+are async generators (listen()) running on the ASGI event loop.
+
+By default delivery is in-process: only subscribers connected to the same
+process as the writer see an event. Set CRM_EVENTS_REDIS_URL to publish
+through redis instead, so events written by other web processes or by
+Celery workers reach every subscriber.
+
+Payloads are plain JSON-compatible dicts, so subscription resolvers never
+touch the ORM from async code.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+ORDER_CREATED = 'order_created'
+STOCK_CHANGED = 'stock_changed'
+TOPICS = (ORDER_CREATED, STOCK_CHANGED)
+
+REDIS_CHANNEL_PREFIX = 'crm:events:'
+# Events buffered per subscriber; a subscriber that falls further behind
+# loses its oldest events rather than growing without bound.
+SUBSCRIBER_QUEUE_SIZE = 100
+
+_subscribers = {topic: set() for topic in TOPICS}
+_lock = threading.Lock()
+_redis_client = None
+_redis_listeners = {}
+
+
+def _redis_url():
+    return getattr(settings, 'CRM_EVENTS_REDIS_URL', None)
+
+
+def has_listeners(topic):
+    """Whether publishing to `topic` can reach anyone (always true with redis)."""
+    return bool(_redis_url() or _subscribers[topic])
+
+
+def _put(queue, payload):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(payload)
+
+
+def _deliver(topic, payload):
+    with _lock:
+        subscribers = list(_subscribers[topic])
+    for loop, queue in subscribers:
+        try:
+            loop.call_soon_threadsafe(_put, queue, payload)
+        except RuntimeError:
+            # The subscriber's event loop has shut down
+            with _lock:
+                _subscribers[topic].discard((loop, queue))
+
+
+def publish(topic, payload):
+    """Publish `payload` now (use the notify_* helpers from transactional code)."""
+    message = json.dumps(payload, cls=DjangoJSONEncoder)
+    if _redis_url():
+        global _redis_client
+        try:
+            import redis
+
+            if _redis_client is None:
+                _redis_client = redis.Redis.from_url(_redis_url())
+            _redis_client.publish(REDIS_CHANNEL_PREFIX + topic, message)
+            return
+        except Exception:
+            logger.exception("Publishing %s to redis failed; delivering in-process only", topic)
+    _deliver(topic, json.loads(message))
+
+
+def _publish_on_commit(topic, payloads):
+    if payloads:
+        transaction.on_commit(lambda: [publish(topic, payload) for payload in payloads])
+
+
+def order_event(order):
+    # Imported here: workers publish events but never load GraphQL otherwise
+    from graphql_relay import to_global_id
+
+    return {
+        'id': to_global_id('OrderType', order.pk),
+        'customer_id': to_global_id('CustomerType', order.customer_id),
+        'total_amount': order.total_amount,
+        'order_date': order.order_date,
+    }
+
+
+def stock_event(product, previous=None):
+    from graphql_relay import to_global_id
+
+    return {
+        'product_id': to_global_id('ProductType', product.pk),
+        'name': product.name,
+        'stock': product.stock,
+        'previous_stock': previous,
+    }
+
+
+def notify_order_created(order):
+    """Publish orderCreated for `order` when the transaction commits."""
+    if has_listeners(ORDER_CREATED):
+        # Built at commit time so totals added after the INSERT are included
+        transaction.on_commit(lambda: publish(ORDER_CREATED, order_event(order)))
+
+
+def notify_stock_changed(products, previous=None):
+    """
+    Publish stockChanged for each product when the transaction commits.
+
+    `previous` maps product ids to their stock before the change, so
+    subscribers can tell a drop below a threshold from a change that stays
+    below it; omit it where the writer does not know.
+
+    `products` may be a queryset; it is only evaluated when somebody is
+    listening, so writers pay nothing for events nobody receives.
+    """
+    if has_listeners(STOCK_CHANGED):
+        previous = previous or {}
+        _publish_on_commit(STOCK_CHANGED, [stock_event(p, previous.get(p.pk)) for p in products])
+
+
+async def _listen_redis():
+    import redis.asyncio
+
+    delay = 1
+    while True:
+        try:
+            client = redis.asyncio.Redis.from_url(_redis_url())
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(*(REDIS_CHANNEL_PREFIX + t for t in TOPICS))
+                delay = 1
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        topic = message['channel'].decode()[len(REDIS_CHANNEL_PREFIX):]
+                        _deliver(topic, json.loads(message['data']))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Redis event listener failed; reconnecting in %ss", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+def _ensure_redis_listener():
+    # One redis subscription per event loop fans events out to its subscribers
+    loop = asyncio.get_running_loop()
+    task = _redis_listeners.get(loop)
+    if task is None or task.done():
+        _redis_listeners[loop] = loop.create_task(_listen_redis())
+
+
+async def listen(topic):
+    """Async generator yielding every event published to `topic` from now on."""
+    subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE))
+    with _lock:
+        _subscribers[topic].add(subscriber)
+    if _redis_url():
+        _ensure_redis_listener()
+    try:
+        while True:
+            yield await subscriber[1].get()
+    finally:
+        with _lock:
+            _subscribers[topic].discard(subscriber)
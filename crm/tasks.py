@@ -1,60 +1,147 @@
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
 from django.utils import timezone
 from decimal import Decimal
-import os
-from datetime import datetime
-import requests
 
-import graphene
-from graphene.test import Client
-
-# بناء سكيمة GraphQL محلياً من Query و Mutation (بما أن schema غير مصرح به في schema.py)
-from .schema import Query, Mutation
-schema = graphene.Schema(query=Query, mutation=Mutation)
-client = Client(schema)
+from . import counts
+from .logsink import get_logger
+from .models import Customer, CustomerArchiveSummary, Product, Order, Job
+from .outbox import relay
+from .stock import apply_adjustments
 
+# Default report log path; see crm.logsink for overriding it and for rotation
 LOG_PATH = '/tmp/crm_report_log.txt'  # على Windows: C:\tmp\crm_report_log.txt
 
 @shared_task(name='crm.tasks.generate_crm_report')
 def generate_crm_report():
-    # استعلام GraphQL لجلب البيانات
-    query = '''
-    query CRMReport {
-      customers { id }
-      orders { id totalAmount }
-    }
-    '''
-
-    result = client.execute(query)
-
-    if 'errors' in result and result['errors']:
-        raise Exception(f'GraphQL errors: {result["errors"]}')
-
-    data = result.get('data', {}) or {}
-    customers = data.get('customers') or []
-    orders = data.get('orders') or []
-
-    total_customers = len(customers)
-    total_orders = len(orders)
-
-    total_revenue = Decimal('0')
-    for o in orders:
-        val = o.get('totalAmount')
-        if val is not None:
-            # Graphene قد يعيد Decimal كسلسلة، لذا نحوله إلى Decimal
-            total_revenue += Decimal(str(val))
-
-    # صيغة الوقت المطلوبة
-    ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    line = f'{ts} - Report: {total_customers} customers, {total_orders} orders, {total_revenue} revenue\n'
-
-    # تأكد أن المجلد موجود
+    # Aggregate in SQL: order totals are kept up to date from the line
+    # items, so revenue is a single SUM over crm_order, plus the archived
+    # orders' per-customer totals (see crm.archive).
+    total_customers = Customer.objects.count()
+    totals = Order.objects.aggregate(orders=Count('id'), revenue=Sum('total_amount'))
+    archived = CustomerArchiveSummary.objects.aggregate(orders=Sum('order_count'), revenue=Sum('lifetime_value'))
+    total_orders = totals['orders'] + (archived['orders'] or 0)
+    total_revenue = (totals['revenue'] or Decimal('0')) + (archived['revenue'] or Decimal('0'))
+
+    get_logger('crm_report', LOG_PATH).info('Report', extra={
+        'customers': total_customers,
+        'orders': total_orders,
+        'revenue': str(total_revenue),
+    })
+
+    return {'customers': total_customers, 'orders': total_orders, 'revenue': str(total_revenue)}
+
+
+# Async mutations
+# ---------------
+# BulkCreateCustomers and UpdateLowStockProducts can hand their work off to
+# these tasks and return a Job id immediately; the job row is updated after
+# every chunk so the `job(id:)` query can report progress and partial results.
+
+JOB_CHUNK_SIZE = 500
+
+
+def enqueue_job(job, task, *args):
+    """Send `task` to the broker once the transaction that created `job` commits."""
+    def _send():
+        try:
+            task.delay(str(job.pk), *args)
+        except Exception as e:
+            Job.objects.filter(pk=job.pk).update(
+                status=Job.STATUS_FAILED,
+                errors=[f"Could not enqueue job: {e}"],
+                finished_at=timezone.now(),
+            )
+
+    transaction.on_commit(_send)
+
+
+def _start_job(job_id, total):
+    Job.objects.filter(pk=job_id).update(status=Job.STATUS_RUNNING, total=total, updated_at=timezone.now())
+    return Job.objects.get(pk=job_id)
+
+
+def _save_progress(job, processed):
+    job.processed = processed
+    Job.objects.filter(pk=job.pk).update(
+        processed=processed, result=job.result, errors=job.errors, updated_at=timezone.now()
+    )
+
+
+def _finish_job(job, status=Job.STATUS_SUCCEEDED):
+    job.status = status
+    job.finished_at = timezone.now()
+    Job.objects.filter(pk=job.pk).update(
+        status=status, result=job.result, errors=job.errors,
+        processed=job.processed, finished_at=job.finished_at, updated_at=job.finished_at,
+    )
+
+
+@shared_task(name='crm.tasks.bulk_create_customers')
+def bulk_create_customers(job_id, rows, chunk_size=JOB_CHUNK_SIZE):
+    """Create customers from `rows` (dicts with name/email/phone) in chunks."""
+    job = _start_job(job_id, len(rows))
+    job.result = {'customer_ids': []}
+    job.errors = []
+    try:
+        for start in range(0, len(rows), chunk_size):
+            with transaction.atomic():
+                for i, cust_data in enumerate(rows[start:start + chunk_size], start=start):
+                    try:
+                        with transaction.atomic():
+                            customer = Customer(
+                                name=cust_data.get('name'),
+                                email=cust_data.get('email'),
+                                phone=cust_data.get('phone'),
+                            )
+                            customer.full_clean()
+                            customer.save()
+                        job.result['customer_ids'].append(customer.pk)
+                    except Exception as e:
+                        job.errors.append(f"Customer {i+1}: {str(e)}")
+                counts.invalidate()
+            _save_progress(job, min(start + chunk_size, len(rows)))
+    except Exception as e:
+        job.errors.append(str(e))
+        _finish_job(job, Job.STATUS_FAILED)
+        raise
+    _finish_job(job)
+    return {'created': len(job.result['customer_ids']), 'errors': len(job.errors)}
+
+
+@shared_task(name='crm.tasks.update_low_stock_products')
+def update_low_stock_products(job_id, threshold=10, increment=10, chunk_size=JOB_CHUNK_SIZE):
+    """Restock every product below `threshold` by `increment`, chunk by chunk."""
+    product_ids = list(Product.objects.filter(stock__lt=threshold).values_list('pk', flat=True))
+    job = _start_job(job_id, len(product_ids))
+    job.result = {'product_ids': []}
+    job.errors = []
     try:
-        os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
-    except Exception:
-        pass
+        for start in range(0, len(product_ids), chunk_size):
+            chunk = product_ids[start:start + chunk_size]
+            # stock = stock + increment in the database, like every other
+            # stock write (crm.stock), so orders placed meanwhile are not
+            # overwritten; also records the outbox and stockChanged events
+            results = apply_adjustments([(pk, increment) for pk in chunk])
+            for pk, result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    job.errors.append(f"Product {pk}: {result}")
+                else:
+                    job.result['product_ids'].append(pk)
+            _save_progress(job, start + len(chunk))
+    except Exception as e:
+        job.errors.append(str(e))
+        _finish_job(job, Job.STATUS_FAILED)
+        raise
+    _finish_job(job)
+    return {'updated': len(job.result['product_ids']), 'errors': len(job.errors)}
 
-    with open(LOG_PATH, 'a', encoding='utf-8') as f:
-        f.write(line)
 
-    return {'customers': total_customers, 'orders': total_orders, 'revenue': str(total_revenue)}
\ No newline at end of file
+@shared_task(name='crm.tasks.relay_outbox')
+def relay_outbox(batch_size=500):
+    """Push new outbox events to CRM_OUTBOX_WEBHOOK_URL (no-op when unset)."""
+    if not getattr(settings, 'CRM_OUTBOX_WEBHOOK_URL', None):
+        return {'relayed': 0}
+    return {'relayed': relay(batch_size=batch_size)}
@@ -0,0 +1,169 @@
+"""
+Test support: query-count budgets for the GraphQL schema and import-time
+budgets for worker and cron start-up.
+
+    failures = check_query_budgets()
+    assert not failures, "\n".join(failures)
+
+check_query_budgets runs every operation in crm.query_budgets.QUERY_BUDGETS
+against data seeded with crm.seed at a small and a large size, inside the
+caller's database (use it from a TestCase). check_startup_budgets profiles
+fresh interpreters with `python -X importtime`.
+"""
+
+import itertools
+import os
+import subprocess
+import sys
+
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from .models import Customer, Product, Job
+from .query_budgets import QUERY_BUDGETS
+from .seed import seed
+
+SMALL = {'customers': 10, 'products': 8, 'orders': 20}
+LARGE = {'customers': 50, 'products': 40, 'orders': 100}
+
+_suffixes = itertools.count()
+
+
+def schema_root_fields(schema):
+    """Names of every query and mutation root field of a graphene schema."""
+    graphql_schema = schema.graphql_schema
+    names = set(graphql_schema.query_type.fields)
+    if graphql_schema.mutation_type:
+        names |= set(graphql_schema.mutation_type.fields)
+    return names
+
+
+def _variables():
+    customer = Customer.objects.order_by('pk').first()
+    product = Product.objects.filter(stock__gte=100).order_by('pk').first()
+    job = Job.objects.create(
+        kind='budget',
+        result={
+            'customer_ids': list(Customer.objects.values_list('pk', flat=True)[:5]),
+            'product_ids': list(Product.objects.values_list('pk', flat=True)[:5]),
+        },
+    )
+    return {
+        'customerId': customer.pk,
+        'productId': product.pk,
+        'jobId': str(job.pk),
+        'suffix': f'budget{next(_suffixes)}@example.com',
+    }
+
+
+def count_queries(schema, document, variables=None):
+    """Execute `document` and return (number of SQL queries, result)."""
+    request = RequestFactory().post('/graphql')
+    with CaptureQueriesContext(connection) as ctx:
+        result = schema.execute(document, variable_values=variables, context_value=request)
+    return len(ctx.captured_queries), result
+
+
+def measure(schema, budgets=QUERY_BUDGETS):
+    """Run every budgeted operation once and return {field: query count}."""
+    counts = {}
+    for field, entry in budgets.items():
+        count, result = count_queries(schema, entry['document'], _variables())
+        if result.errors:
+            raise AssertionError(f"{field}: operation failed: {result.errors}")
+        counts[field] = count
+    return counts
+
+
+def check_query_budgets(schema=None, budgets=QUERY_BUDGETS, small=SMALL, large=LARGE):
+    """
+    Seed `small`, measure, grow the data to `large`, measure again and
+    return a list of human-readable failures (empty when all is well).
+    """
+    if schema is None:
+        from alx_backend_graphql_crm.schema import schema
+
+    failures = [
+        f"{field}: no entry in QUERY_BUDGETS"
+        for field in sorted(schema_root_fields(schema) - set(budgets))
+    ]
+
+    seed(**small, random_seed=1)
+    before = measure(schema, budgets)
+    seed(**{k: large[k] - small[k] for k in large}, random_seed=2)
+    after = measure(schema, budgets)
+
+    for field, entry in budgets.items():
+        if after[field] > before[field]:
+            failures.append(
+                f"{field}: {before[field]} queries with {small} but {after[field]} with {large}"
+                " (grows with row count)"
+            )
+        if max(before[field], after[field]) > entry['budget']:
+            failures.append(
+                f"{field}: {max(before[field], after[field])} queries exceeds budget of {entry['budget']}"
+            )
+    return failures
+
+
+# Start-up of each entry point, profiled in a fresh interpreter. max_ms is
+# the summed import time (a few times what it takes on a laptop, so only
+# real regressions trip it); forbidden modules must not be imported at all.
+STARTUP_BUDGETS = {
+    # Celery worker: crm.celery loads crm.settings, then autodiscovers tasks
+    'worker': {
+        'settings': 'crm.settings',
+        'code': 'import django; django.setup(); import crm.tasks',
+        'max_ms': 1000,
+        'forbidden': ('graphene', 'graphql', 'gql', 'requests'),
+    },
+    # django-crontab runs jobs through manage.py with the project settings
+    # (graphene_django is an installed app there, so graphene is expected)
+    'cron': {
+        'settings': 'alx_backend_graphql_crm.settings',
+        'code': 'import django; django.setup(); import crm.cron',
+        'max_ms': 1500,
+        'forbidden': ('gql', 'requests'),
+    },
+}
+
+
+def profile_imports(code, settings_module):
+    """
+    Run `code` in a new interpreter under `python -X importtime` and return
+    [(module, self_us, cumulative_us, depth)] in the order reported.
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=base_dir, env=env, capture_output=True, text=True, check=True,
+    )
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def check_startup_budgets(budgets=STARTUP_BUDGETS):
+    """Profile each entry point and return a list of failures (empty when all is well)."""
+    failures = []
+    for name, budget in budgets.items():
+        modules = profile_imports(budget['code'], budget['settings'])
+        imported = {module for module, _, _, _ in modules}
+        for module in budget['forbidden']:
+            if module in imported:
+                failures.append(f"{name}: imports {module} at start-up")
+        total_ms = sum(self_us for _, self_us, _, _ in modules) / 1000
+        if total_ms > budget['max_ms']:
+            top = sorted((m for m in modules if m[3] == 0), key=lambda m: -m[2])[:5]
+            slowest = ', '.join(f"{m[0]} {m[2] / 1000:.0f}ms" for m in top)
+            failures.append(
+                f"{name}: imports take {total_ms:.0f}ms, budget {budget['max_ms']}ms (slowest: {slowest})"
+            )
+    return failures
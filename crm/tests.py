@@ -1,3 +1,956 @@
-from django.test import TestCase
+import asyncio
+import csv
+import glob
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from alx_backend_graphql_crm.schema import schema
+from crm import health
+from crm.analytics import invalidate as invalidate_revenue, revenue_series
+from crm.archive import archive_orders
+from crm.connections import count_queryset
+from crm.entity_cache import customers as customer_cache, products as product_cache
+from crm.logsink import RotatingJsonFileHandler, get_logger, shutdown as shutdown_logs
+from crm.outbox import relay
+from crm.profiling import list_profile_ids, load_profile
+from crm.slowlog import normalize
+from crm.subscriptions import ORDER_CREATED, STOCK_CHANGED, _subscribers, notify_stock_changed, publish
+from crm.models import (
+    ArchivedOrder, ArchivedOrderItem, Customer, CustomerArchiveSummary, Job, Product, Order, OrderItem, OutboxEvent,
+    bulk_create_orders,
+)
+from crm.stock import adjust_stock, adjust_stock_many, apply_adjustments, reserve_stock, InsufficientStock
+from crm.tasks import bulk_create_customers, update_low_stock_products
+from crm.testing import check_query_budgets, check_startup_budgets
+from crm.websocket import GraphQLWebSocketApp
 
 # Create your tests here.
+
+
+class ReserveStockTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name="Widget", price=5, stock=3)
+
+    def test_reserve_decrements_stock(self):
+        with transaction.atomic():
+            reserve_stock({self.product.pk: 2})
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 1)
+
+    def test_insufficient_stock_rolls_back_every_product(self):
+        other = Product.objects.create(name="Gadget", price=5, stock=10)
+        with self.assertRaises(InsufficientStock):
+            with transaction.atomic():
+                reserve_stock({other.pk: 4, self.product.pk: 5})
+        other.refresh_from_db()
+        self.assertEqual(other.stock, 10)
+
+
+class AdjustStockTests(TransactionTestCase):
+    # Not TestCase: inside a transaction adjustments are applied directly
+    def setUp(self):
+        self.product = Product.objects.create(name="Widget", price=5, stock=3)
+
+    def test_rejects_only_what_does_not_fit(self):
+        results = adjust_stock_many([(self.product.pk, -2), (self.product.pk, -2)])
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], InsufficientStock)
+
+    @override_settings(CRM_STOCK_COALESCE_WINDOW=0.01)
+    def test_concurrent_adjustments_never_oversell(self):
+        accepted = []
+
+        def take():
+            for _ in range(3):
+                try:
+                    adjust_stock(self.product.pk, -1)
+                    accepted.append(1)
+                except InsufficientStock:
+                    pass
+            connection.close()
+
+        workers = [threading.Thread(target=take) for _ in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.product.refresh_from_db()
+        self.assertEqual((len(accepted), self.product.stock), (3, 0))
+
+    @override_settings(CRM_STOCK_COALESCE_WINDOW=0.05)
+    def test_callers_wait_for_a_slow_batch_instead_of_reporting_failure(self):
+        def slow(adjustments):
+            time.sleep(0.5)  # e.g. waiting for a database lock
+            return apply_adjustments(adjustments)
+
+        results = []
+
+        def add_one():
+            results.append(adjust_stock_many([(self.product.pk, 1)])[0])
+            connection.close()
+
+        with mock.patch('crm.stock.apply_adjustments', side_effect=slow):
+            workers = [threading.Thread(target=add_one) for _ in range(2)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        self.product.refresh_from_db()
+        # Whichever thread did not write the batch still gets its committed result
+        self.assertEqual(self.product.stock, 5)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(isinstance(r, int) for r in results), results)
+
+
+class AsyncJobTests(TestCase):
+    mutation = """
+        mutation { bulkCreateCustomers(runAsync: true, input: [
+          {name: "A", email: "a@example.com"}, {name: "B", email: "bad"}, {name: "C", email: "c@example.com"}
+        ]) { jobId customers { id } } }
+    """
+    job_query = 'query($id: ID!) { job(id: $id) { status progress errors customers { name } } }'
+
+    def run_job(self, delay):
+        with mock.patch.object(bulk_create_customers, 'delay', side_effect=delay):
+            with self.captureOnCommitCallbacks(execute=True):
+                result = schema.execute(self.mutation)
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data['bulkCreateCustomers']['customers'], [])
+        job = schema.execute(self.job_query, variable_values={'id': result.data['bulkCreateCustomers']['jobId']})
+        return job.data['job']
+
+    def test_job_runs_in_chunks_and_reports_results_and_row_errors(self):
+        job = self.run_job(lambda job_id, rows: bulk_create_customers(job_id, rows, chunk_size=2))
+        self.assertEqual((job['status'], job['progress']), ('SUCCEEDED', 1.0))
+        self.assertEqual([c['name'] for c in job['customers']], ['A', 'C'])
+        self.assertEqual(len(job['errors']), 1)
+        self.assertTrue(job['errors'][0].startswith('Customer 2:'))
+
+    def test_broker_failure_fails_the_job(self):
+        job = self.run_job(ConnectionError("broker down"))
+        self.assertEqual(job['status'], 'FAILED')
+        self.assertIn('broker down', job['errors'][0])
+        self.assertFalse(Customer.objects.exists())
+
+
+class RestockJobTests(TransactionTestCase):
+    # Not TestCase: orders and restocks commit concurrently from several threads
+    def setUp(self):
+        self.product = Product.objects.create(name="Hot item", price=10, stock=3)
+
+    def restock(self, **kwargs):
+        job = Job.objects.create(kind='update_low_stock_products')
+        return update_low_stock_products(str(job.pk), **kwargs)
+
+    def test_records_outbox_and_stock_changed_events(self):
+        with mock.patch('crm.stock.notify_stock_changed') as notify:
+            self.assertEqual(self.restock(), {'updated': 1, 'errors': 0})
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 13)
+        self.assertEqual([p.stock for p in notify.call_args.args[0]], [13])
+        event = OutboxEvent.objects.filter(entity='product', action=OutboxEvent.UPDATED).latest('pk')
+        self.assertEqual(event.payload['stock'], 13)
+
+    def test_concurrent_orders_are_not_overwritten(self):
+        customer = Customer.objects.create(name="Stress", email="stress@example.com")
+        mutation = """
+            mutation($customer: ID!, $product: ID!) {
+              createOrder(customerId: $customer, items: [{productId: $product, quantity: 1}]) { order { id } }
+            }
+        """
+        variables = {'customer': customer.pk, 'product': self.product.pk}
+        placing = threading.Event()
+        placing.set()
+        errors = []
+
+        def place_orders():
+            while placing.is_set():
+                result = schema.execute(mutation, variable_values=variables)
+                # Sold out and SQLite lock contention are expected
+                if result.errors and not any(s in str(result.errors[0]) for s in ('locked', 'Insufficient stock')):
+                    errors.append(str(result.errors[0]))
+                time.sleep(0.001)
+            connection.close()
+
+        restocked = []
+
+        def counted(adjustments):
+            results = apply_adjustments(adjustments)  # committed once it returns
+            restocked.extend(r for r in results if not isinstance(r, Exception))
+            return results
+
+        workers = [threading.Thread(target=place_orders) for _ in range(4)]
+        for w in workers:
+            w.start()
+        try:
+            with mock.patch('crm.tasks.apply_adjustments', side_effect=counted):
+                while len(restocked) < 10:
+                    try:
+                        self.restock(threshold=1000, increment=5)
+                    except OperationalError:
+                        time.sleep(0.001)  # "database table is locked"
+        finally:
+            placing.clear()
+            for w in workers:
+                w.join()
+
+        self.product.refresh_from_db()
+        ordered = OrderItem.objects.filter(product=self.product).count()
+        self.assertEqual(errors, [])
+        self.assertGreater(ordered, 0)
+        self.assertEqual(self.product.stock, 3 + 5 * len(restocked) - ordered)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        Product.objects.bulk_create([Product(name=f"P{i}", price=5, stock=i * 5) for i in range(5)])
+
+    def export(self, query):
+        response = self.client.get(f'/export/products?{query}')
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_csv_applies_the_filterset(self):
+        rows = list(csv.reader(self.export('low_stock=true&chunk_size=1').decode().splitlines()))
+        self.assertEqual(rows[0], ['id', 'name', 'price', 'stock'])
+        self.assertEqual([row[1:] for row in rows[1:]], [['P0', '5.00', '0'], ['P1', '5.00', '5']])
+
+    @mock.patch('crm.views.EXPORT_BUFFER_SIZE', 16)
+    def test_gzipped_ndjson_streams_every_row(self):
+        lines = gzip.decompress(self.export('format=ndjson&gzip=1')).decode().splitlines()
+        self.assertEqual([json.loads(line)['stock'] for line in lines], [0, 5, 10, 15, 20])
+
+    def test_rejects_unknown_format(self):
+        self.assertEqual(self.client.get('/export/products?format=xml').status_code, 400)
+
+
+class ImportCommandTests(TransactionTestCase):
+    # Not TestCase: the command commits per chunk and --wal needs autocommit
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, text):
+        path = f"{self.directory}/{name}"
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_rejects_invalid_and_duplicate_rows(self):
+        Customer.objects.create(name="Old", email="old@example.com")
+        path = self.write('customers.csv', (
+            "name,email,phone\n"
+            "Ann,ann@example.com,\n"
+            "Bad,not-an-email,\n"
+            "Ann again,ann@example.com,\n"   # duplicate within the chunk
+            "Old again,old@example.com,\n"   # already in the database
+            "Bob,bob@example.com,123\n"
+            "Ann later,ann@example.com,\n"   # duplicate of an earlier chunk
+        ))
+        rejects = f"{self.directory}/rejects.ndjson"
+        call_command('crm_import', 'customers', path, chunk_size=2, workers=0, rejects=rejects, stdout=StringIO())
+
+        self.assertEqual(list(Customer.objects.order_by('pk').values_list('name', flat=True)), ['Old', 'Ann'])
+        with open(rejects) as f:
+            reasons = {entry['line']: entry['reason'] for entry in map(json.loads, f)}
+        self.assertEqual(sorted(reasons), [3, 4, 5, 6, 7])
+        self.assertIn('email', reasons[3])
+        self.assertIn('phone', reasons[6])
+        self.assertTrue(all('already exists' in reasons[line] for line in (4, 5, 7)))
+        self.assertEqual(OutboxEvent.objects.filter(entity='customer', action=OutboxEvent.CREATED).count(), 2)
+
+    def test_worker_pool_no_outbox_and_wal(self):
+        path = self.write('products.ndjson', ''.join(
+            json.dumps({'name': f"P{i}", 'price': '2.50', 'stock': i}) + '\n' for i in range(5)
+        ) + '{"name": "Free", "price": "0"}\n')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.addCleanup(connection.cursor().execute, f'PRAGMA synchronous={cursor.fetchone()[0]}')
+        out = StringIO()
+        call_command('crm_import', 'products', path, workers=2, chunk_size=2, wal=True, no_outbox=True,
+                     stdout=out, stderr=StringIO())
+
+        self.assertEqual(Product.objects.count(), 5)
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertIn('6 rows read, 5 inserted, 1 rejected', out.getvalue())
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+
+class OrderTotalTests(TestCase):
+    def setUp(self):
+        customer = Customer.objects.create(name="Ann", email="ann@example.com")
+        self.widget = Product.objects.create(name="Widget", price=5, stock=10)
+        self.gadget = Product.objects.create(name="Gadget", price=20, stock=10)
+        self.order = Order.objects.create(customer=customer)
+        self.order.add_items([OrderItem(product=self.widget, quantity=2), OrderItem(product=self.gadget)])
+
+    def total(self):
+        self.order.refresh_from_db()
+        return self.order.total_amount
+
+    def test_prices_are_captured_when_ordered(self):
+        self.assertEqual(self.total(), Decimal('30.00'))
+        Product.objects.filter(pk=self.widget.pk).update(price=50)
+        self.assertEqual(self.total(), Decimal('30.00'))
+        self.assertEqual(self.order.recalculate_total(), Decimal('30.00'))
+
+    def test_item_edits_adjust_the_total(self):
+        item = self.order.items.get(product=self.widget)
+        item.quantity = 3
+        item.save()
+        self.assertEqual(self.total(), Decimal('35.00'))
+        self.order.items.get(product=self.gadget).delete()
+        self.assertEqual(self.total(), Decimal('15.00'))
+
+
+class BulkCreateOrdersTests(TestCase):
+    def test_keeps_given_dates_without_disabling_auto_now_add(self):
+        customer = Customer.objects.create(name="Ann", email="ann@example.com")
+        month_ago = timezone.now() - timedelta(days=30)
+        dated, undated = bulk_create_orders([Order(customer=customer, order_date=month_ago), Order(customer=customer)])
+        self.assertEqual(Order.objects.get(pk=dated.pk).order_date, month_ago)
+        self.assertGreater(Order.objects.get(pk=undated.pk).order_date, month_ago + timedelta(days=29))
+        # Other writers still get the creation time, whatever they pass
+        self.assertGreater(Order.objects.create(customer=customer, order_date=month_ago).order_date, month_ago)
+
+
+class BatchedGraphQLTests(TestCase):
+    def post(self, operations):
+        return self.client.post('/graphql', json.dumps(operations), content_type='application/json')
+
+    def test_runs_operations_in_order_with_per_operation_status(self):
+        Customer.objects.create(name="Ann", email="ann@example.com")
+        query = '{ customers { name orderCount } }'
+        response = self.post([
+            {'id': 1, 'query': query},
+            {'id': 2, 'query': 'mutation { createCustomer(name: "Bob", email: "bob@example.com") { message } }'},
+            {'id': 3, 'query': query},
+            {'id': 4, 'query': '{ nope }'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual([(r['id'], r['status']) for r in results], [(1, 200), (2, 200), (3, 200), (4, 400)])
+        # The repeated query runs again after the mutation instead of being reused
+        self.assertEqual([c['name'] for c in results[0]['data']['customers']], ['Ann'])
+        self.assertEqual([c['name'] for c in results[2]['data']['customers']], ['Ann', 'Bob'])
+
+    @override_settings(GRAPHQL_MAX_BATCH_SIZE=2)
+    def test_rejects_oversized_and_malformed_batches(self):
+        self.assertEqual(self.post([{'query': '{ hello }'}] * 2).status_code, 200)
+        response = self.post([{'query': '{ hello }'}] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('exceeds the limit of 2', response.json()['errors'][0]['message'])
+        self.assertEqual(self.post([{'query': '{ hello }'}, 'hello']).status_code, 400)
+
+
+class WebSocketClient:
+    """Drives crm.websocket's ASGI app through in-memory queues."""
+
+    def __init__(self, subprotocols=('graphql-transport-ws',)):
+        self.to_app, self.from_app = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'websocket', 'path': '/graphql', 'subprotocols': list(subprotocols)}
+        self.task = asyncio.ensure_future(GraphQLWebSocketApp(schema)(scope, self.to_app.get, self.from_app.put))
+
+    async def connect(self):
+        await self.to_app.put({'type': 'websocket.connect'})
+        return await self.receive()
+
+    async def send(self, message):
+        text = message if isinstance(message, str) else json.dumps(message)
+        await self.to_app.put({'type': 'websocket.receive', 'text': text})
+
+    async def receive(self):
+        event = await asyncio.wait_for(self.from_app.get(), timeout=2)
+        return json.loads(event['text']) if event['type'] == 'websocket.send' else event
+
+    async def close(self):
+        await self.to_app.put({'type': 'websocket.disconnect'})
+        await asyncio.wait_for(self.task, timeout=2)
+
+
+class SubscriptionTests(TestCase):
+    def notify_stock_changed(self, products, previous=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_stock_changed(products, previous)
+
+    async def connect(self):
+        client = WebSocketClient()
+        self.assertEqual(await client.connect(), {'type': 'websocket.accept', 'subprotocol': 'graphql-transport-ws'})
+        await client.send({'type': 'connection_init'})
+        self.assertEqual(await client.receive(), {'type': 'connection_ack'})
+        return client
+
+    async def wait_for_subscribers(self, topic, present=True):
+        while bool(_subscribers[topic]) != present:
+            await asyncio.sleep(0.001)
+
+    async def test_subscribe_next_complete(self):
+        client = await self.connect()
+        await client.send({'id': '1', 'type': 'subscribe', 'payload': {
+            'query': 'subscription { stockChanged(threshold: 5) { name stock } }',
+        }})
+        await self.wait_for_subscribers(STOCK_CHANGED)
+        await sync_to_async(self.notify_stock_changed)([
+            Product(pk=1, name="Plenty", stock=50), Product(pk=2, name="Scarce", stock=2),
+        ])
+        self.assertEqual(await client.receive(), {
+            'id': '1', 'type': 'next', 'payload': {'data': {'stockChanged': {'name': 'Scarce', 'stock': 2}}},
+        })
+        await client.send({'id': '1', 'type': 'complete'})
+        await self.wait_for_subscribers(STOCK_CHANGED, present=False)
+        await client.close()
+
+    async def test_threshold_only_reports_drops_below_it(self):
+        client = await self.connect()
+        await client.send({'id': '1', 'type': 'subscribe', 'payload': {
+            'query': 'subscription { stockChanged(threshold: 5) { name stock previousStock } }',
+        }})
+        await self.wait_for_subscribers(STOCK_CHANGED)
+        await sync_to_async(self.notify_stock_changed)([
+            Product(pk=1, name="Restocked", stock=4), Product(pk=2, name="Still low", stock=3),
+            Product(pk=3, name="Dropped", stock=4),
+        ], {1: 2, 2: 4, 3: 6})
+        await sync_to_async(self.notify_stock_changed)([Product(pk=4, name="At threshold", stock=4)], {4: 5})
+        for name, previous in (("Dropped", 6), ("At threshold", 5)):
+            self.assertEqual(await client.receive(), {'id': '1', 'type': 'next', 'payload': {'data': {
+                'stockChanged': {'name': name, 'stock': 4, 'previousStock': previous},
+            }}})
+        await client.send({'id': '1', 'type': 'complete'})
+        await self.wait_for_subscribers(STOCK_CHANGED, present=False)
+        await client.close()
+
+    def test_stock_events_carry_the_previous_level(self):
+        product = Product.objects.get(pk=Product.objects.create(name="Widget", price=5, stock=8).pk)
+        with mock.patch('crm.subscriptions.has_listeners', return_value=True), \
+                mock.patch('crm.subscriptions.publish') as publish_event:
+            with self.captureOnCommitCallbacks(execute=True):
+                product.stock = 3
+                product.save()
+                reserve_stock({product.pk: 2})
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_adjustments([(product.pk, 10)])
+        self.assertEqual(
+            [(call.args[1]['previous_stock'], call.args[1]['stock']) for call in publish_event.call_args_list],
+            [(8, 3), (3, 1), (1, 11)],
+        )
+
+    async def test_queries_run_over_the_socket(self):
+        client = await self.connect()
+        await client.send({'id': 'q', 'type': 'subscribe', 'payload': {'query': '{ hello }'}})
+        self.assertEqual(await client.receive(), {'id': 'q', 'type': 'next', 'payload': {'data': {'hello': 'Hello, GraphQL!'}}})
+        self.assertEqual(await client.receive(), {'id': 'q', 'type': 'complete'})
+        await client.send({'type': 'ping'})
+        self.assertEqual(await client.receive(), {'type': 'pong'})
+        await client.close()
+
+    async def test_protocol_violations_close_the_socket(self):
+        client = WebSocketClient(subprotocols=())
+        self.assertEqual((await client.connect())['code'], 4406)
+
+        client = WebSocketClient()
+        await client.connect()
+        await client.send({'id': '1', 'type': 'subscribe', 'payload': {'query': '{ hello }'}})
+        self.assertEqual((await client.receive())['code'], 4401)
+
+        client = await self.connect()
+        await client.send('not json')
+        self.assertEqual((await client.receive())['code'], 4400)
+
+        client = await self.connect()
+        subscription = {'id': '1', 'type': 'subscribe', 'payload': {'query': 'subscription { orderCreated { id } }'}}
+        await client.send(subscription)
+        await self.wait_for_subscribers(ORDER_CREATED)
+        await client.send(subscription)
+        self.assertEqual((await client.receive())['code'], 4409)
+        await self.wait_for_subscribers(ORDER_CREATED, present=False)
+        publish(ORDER_CREATED, {'id': 'x'})
+        await client.close()
+        self.assertTrue(client.from_app.empty())
+
+
+class OutboxTests(TransactionTestCase):
+    # Not TestCase: the relay's transactions must really commit
+    def setUp(self):
+        for i in range(5):
+            Product.objects.create(name=f"P{i}", price=5, stock=i)
+
+    def test_events_commit_and_roll_back_with_the_write(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Customer.objects.create(name="Gone", email="gone@example.com")
+                raise ValueError
+        Customer.objects.create(name="Ann", email="ann@example.com")
+        result = schema.execute('{ changes(entity: "customer") { changes { action payload } hasMore } }')
+        [event] = result.data['changes']['changes']
+        self.assertEqual((event['action'], json.loads(event['payload'])['name']), ('CREATED', 'Ann'))
+
+        page = schema.execute('{ changes(first: 2) { changes { entityId } cursor hasMore } }').data['changes']
+        self.assertTrue(page['hasMore'])
+        rest = schema.execute('query($c: ID) { changes(since: $c) { changes { entityId } hasMore } }',
+                              variable_values={'c': page['cursor']}).data['changes']
+        self.assertEqual((len(rest['changes']), rest['hasMore']), (4, False))
+
+    def test_relay_sends_batches_in_order_outside_transactions(self):
+        sent = []
+
+        def sink(batch):
+            sent.append(([e.entity_id for e in batch], connection.in_atomic_block))
+
+        self.assertEqual(relay(sink, batch_size=2), 5)
+        ids = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(sent, [(ids[:2], False), (ids[2:4], False), (ids[4:], False)])
+        self.assertFalse(OutboxEvent.objects.filter(Q(relayed_at__isnull=True) | Q(claimed_until__isnull=False)).exists())
+
+    def test_leased_batch_blocks_other_relays_and_failures_release_it(self):
+        def sink(batch):
+            # A second relay running meanwhile must not skip ahead
+            self.assertEqual(relay(lambda batch: self.fail("sent out of order")), 0)
+            raise ConnectionError("webhook down")
+
+        with self.assertRaises(ConnectionError):
+            relay(sink, batch_size=2)
+        self.assertFalse(OutboxEvent.objects.filter(Q(relayed_at__isnull=False) | Q(claimed_until__isnull=False)).exists())
+        # The lease of a relay that died mid-batch runs out
+        OutboxEvent.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(relay(lambda batch: None), 5)
+
+
+class LogSinkTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_writes_json_lines_with_extra_fields(self):
+        with override_settings(CRM_LOG_DIR=self.directory):
+            get_logger('sink_test', '/tmp/crm_sink_test.log').info('Hello', extra={'orders': 3})
+            shutdown_logs()
+        with open(f"{self.directory}/crm_sink_test.log") as f:
+            [entry] = map(json.loads, f)
+        self.assertEqual(
+            {k: entry[k] for k in ('level', 'logger', 'message', 'orders')},
+            {'level': 'INFO', 'logger': 'crm.sink_test', 'message': 'Hello', 'orders': 3},
+        )
+
+    def test_rotates_by_size_into_bounded_gzipped_backups(self):
+        path = f"{self.directory}/job.log"
+        handler = RotatingJsonFileHandler(path, max_bytes=300, rotate_seconds=0, backup_count=2)
+        for i in range(20):
+            handler.handle(logging.makeLogRecord({'name': 'crm.job', 'levelname': 'INFO', 'msg': f'line {i} ' + 'x' * 50}))
+        handler.close()
+        backups = sorted(glob.glob(path + '.*'))
+        self.assertEqual(len(backups), 2)
+        self.assertTrue(all(backup.endswith('.gz') for backup in backups))
+        self.assertLessEqual(os.path.getsize(path), 300)
+        with open(path) as f:
+            self.assertIn('line 19', f.read().splitlines()[-1])
+        for backup in backups:
+            with gzip.open(backup, 'rt') as f:
+                self.assertTrue(all(json.loads(line)['logger'] == 'crm.job' for line in f))
+
+
+@override_settings(CRM_HEALTH_TIMEOUT=0.2, CRM_HEALTH_CACHE_SECONDS=60, CRM_HEALTH_MAX_QUEUE_DEPTH=10)
+class HealthTests(SimpleTestCase):
+    def setUp(self):
+        health._cache.update(expires=0.0, result=None)
+        self.addCleanup(health._cache.update, expires=0.0, result=None)
+        health._running.clear()
+        patcher = mock.patch('crm.health.check_database', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def readyz(self, broker):
+        with mock.patch('crm.health.check_broker', side_effect=broker):
+            response = self.client.get('/readyz')
+        return response.status_code, response.json()
+
+    def test_healthz_does_no_io(self):
+        response = self.client.get('/healthz')
+        self.assertEqual((response.status_code, response.json()['status']), (200, 'ok'))
+        health.check_database.assert_not_called()
+
+    def test_ok_then_cached(self):
+        self.assertEqual(self.readyz(lambda timeout: {'queue_depth': 3})[1]['status'], 'ok')
+        status, result = self.readyz(ConnectionError("not called"))
+        self.assertEqual((status, result['status'], result['cached']), (200, 'ok', True))
+
+    def test_deep_queue_is_degraded_but_ready(self):
+        status, result = self.readyz(lambda timeout: {'queue_depth': 11})
+        self.assertEqual((status, result['status']), (200, 'degraded'))
+
+    def test_unreachable_or_hanging_broker_fails(self):
+        status, result = self.readyz(ConnectionError("refused"))
+        self.assertEqual((status, result['status']), (503, 'fail'))
+        self.assertEqual(result['checks']['broker']['error'], 'ConnectionError: refused')
+        self.assertEqual(result['checks']['database']['status'], 'ok')
+
+        health._cache.update(expires=0.0)
+        status, result = self.readyz(lambda timeout: time.sleep(1))
+        self.assertEqual((status, result['checks']['broker']['error']), (503, 'timed out after 0.2s'))
+
+    def test_hung_broker_does_not_starve_later_database_checks(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        for _ in range(6):
+            health._cache.update(expires=0.0)
+            status, result = self.readyz(lambda timeout: release.wait())
+            self.assertEqual((status, result['checks']['database']['status']), (503, 'ok'))
+            self.assertEqual(result['checks']['broker']['status'], 'fail')
+        # Later probes wait on the first hung check rather than starting more
+        hung = [t for t in threading.enumerate() if t.name == 'crm-health-broker']
+        self.assertEqual(len(hung), 1)
+        self.assertIn('still running', result['checks']['broker']['error'])
+
+        release.set()
+        hung[0].join(1)
+        health._cache.update(expires=0.0)
+        self.assertEqual(self.readyz(lambda timeout: {'queue_depth': 0})[1]['status'], 'ok')
+
+
+class EntityCacheTests(TransactionTestCase):
+    # Not TestCase: rows written in a still-open transaction bypass the cache
+    def setUp(self):
+        cache.clear()
+        product_cache.clear()
+        self.product = Product.objects.create(name="Widget", price=5, stock=3)
+
+    def test_warm_lookup_skips_database_except_for_stock(self):
+        product_cache.get(self.product.pk)
+        with self.assertNumQueries(0):
+            cached = product_cache.get(self.product.pk)
+        self.assertEqual(cached.price, 5)
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.stock, 3)
+
+    def test_save_invalidates(self):
+        product_cache.get(self.product.pk)
+        self.product.price = 7
+        self.product.save()
+        self.assertEqual(product_cache.get(self.product.pk).price, 7)
+
+    def test_orders_are_charged_database_price_not_cached_one(self):
+        customer = Customer.objects.create(name="Ann", email="ann@example.com")
+        product_cache.get(self.product.pk)
+        # update() sends no signal, so the cached price stays at 5
+        Product.objects.filter(pk=self.product.pk).update(price=9)
+        self.assertEqual(product_cache.get(self.product.pk).price, 5)
+        result = schema.execute(
+            'mutation($customer: ID!, $product: ID!) {'
+            '  createOrder(customerId: $customer, items: [{productId: $product, quantity: 2}]) { order { totalAmount } }'
+            '}',
+            variables={'customer': customer.pk, 'product': self.product.pk},
+        )
+        self.assertIsNone(result.errors)
+        self.assertEqual(Decimal(result.data['createOrder']['order']['totalAmount']), Decimal('18'))
+        self.assertEqual(OrderItem.objects.get().unit_price, Decimal('9'))
+
+
+class ConnectionCountTests(TestCase):
+    query = '{ allProducts(first: 1, countStrategy: %s) { totalCount totalCountIsExact edges { node { id } } } }'
+
+    def setUp(self):
+        cache.clear()
+        Product.objects.bulk_create([Product(name=f"P{i}", price=5, stock=i) for i in range(5)])
+
+    def count(self, strategy):
+        result = schema.execute(self.query % strategy)
+        self.assertIsNone(result.errors)
+        return result.data['allProducts']['totalCount'], result.data['allProducts']['totalCountIsExact']
+
+    def test_exact(self):
+        self.assertEqual(self.count('EXACT'), (5, True))
+
+    @override_settings(CRM_COUNT_CAP=3)
+    def test_capped_reports_cap_as_inexact(self):
+        self.assertEqual(self.count('CAPPED'), (3, False))
+
+    def test_delete_invalidates_cached_count(self):
+        self.assertEqual(self.count('EXACT'), (5, True))
+        Product.objects.first().delete()
+        self.assertEqual(self.count('EXACT'), (4, True))
+
+    def test_archiving_invalidates_cached_order_counts(self):
+        customer = Customer.objects.create(name="Ann", email="ann@example.com")
+        now = timezone.now()
+        for days in (400, 300, 10):
+            order = Order.objects.create(customer=customer)
+            Order.objects.filter(pk=order.pk).update(order_date=now - timedelta(days=days))
+        query = '{ allOrders(first: 1) { totalCount } }'
+        self.assertEqual(count_queryset(Order.objects.all()), (3, True))
+        self.assertEqual(schema.execute(query).data['allOrders']['totalCount'], 3)
+
+        archive_orders(now - timedelta(days=100))
+        self.assertEqual(count_queryset(Order.objects.all()), (1, True))
+        # Hot and archived orders are both counted, neither from before the move
+        self.assertEqual(schema.execute(query).data['allOrders']['totalCount'], 3)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.ann = Customer.objects.create(name="Ann", email="ann@example.com")
+        bob = Customer.objects.create(name="Bob", email="bob@example.com")
+        widget = Product.objects.create(name="Widget", price=5, stock=100)
+        self.now = timezone.now()
+        # Old (archived below) and recent orders interleave by id
+        for customer, days, quantity in [(self.ann, 400, 1), (bob, 10, 1), (self.ann, 300, 2), (bob, 350, 3), (self.ann, 5, 4)]:
+            order = Order.objects.create(customer=customer)
+            order.add_items([OrderItem(product=widget, quantity=quantity)])
+            Order.objects.filter(pk=order.pk).update(order_date=self.now - timedelta(days=days))
+        self.cutoff = self.now - timedelta(days=100)
+
+    def test_moves_orders_with_their_items_batch_by_batch(self):
+        self.assertEqual(archive_orders(self.cutoff, batch_size=2, max_batches=1), (2, 2))
+        self.assertEqual((Order.objects.count(), ArchivedOrder.objects.count()), (3, 2))
+        self.assertEqual(archive_orders(self.cutoff, batch_size=2), (1, 1))
+        self.assertFalse(Order.objects.filter(order_date__lt=self.cutoff).exists())
+        self.assertEqual(OrderItem.objects.count(), 2)
+        self.assertEqual(ArchivedOrderItem.objects.count(), 3)
+        self.assertEqual(sorted(ArchivedOrder.objects.values_list('total_amount', flat=True)), [5, 10, 15])
+
+    def test_each_batch_invalidates_its_customers_now_and_on_commit(self):
+        with mock.patch.object(customer_cache, 'invalidate') as invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                archive_orders(self.cutoff, batch_size=1, max_batches=1)
+        self.assertEqual(invalidate.call_args_list, [mock.call(pks=[self.ann.pk])] * 2)
+
+    def test_summary_totals_add_up_across_batches(self):
+        archive_orders(self.cutoff, batch_size=1)
+        summary = CustomerArchiveSummary.objects.get(customer=self.ann)
+        self.assertEqual(
+            (summary.order_count, summary.lifetime_value, summary.last_order_date),
+            (2, Decimal('15.00'), self.now - timedelta(days=300)),
+        )
+        ann = Customer.objects.with_order_summary().get(pk=self.ann.pk)
+        self.assertEqual(
+            (ann.order_count, ann.lifetime_value, ann.last_order_date),
+            (3, Decimal('35.00'), self.now - timedelta(days=5)),
+        )
+
+    def test_all_orders_pages_through_hot_and_archived_orders_by_id(self):
+        archive_orders(self.cutoff)
+        query = """
+            query($after: String) { allOrders(first: 2, after: $after) {
+              pageInfo { hasNextPage endCursor } edges { node { totalAmount } }
+            } }
+        """
+        totals, after = [], None
+        while True:
+            result = schema.execute(query, variable_values={'after': after})
+            self.assertIsNone(result.errors)
+            page = result.data['allOrders']
+            totals += [Decimal(edge['node']['totalAmount']) for edge in page['edges']]
+            if not page['pageInfo']['hasNextPage']:
+                break
+            after = page['pageInfo']['endCursor']
+        self.assertEqual(totals, [5, 5, 10, 15, 20])
+
+
+class RevenueSeriesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = Customer.objects.create(name="Ann", email="ann@example.com")
+        self.day = timezone.now() - timedelta(days=5)
+        self.add_order(10)
+
+    def add_order(self, amount):
+        order = Order.objects.create(customer=self.customer)
+        Order.objects.filter(pk=order.pk).update(order_date=self.day, total_amount=amount)
+        order.refresh_from_db()
+        return order
+
+    def revenue(self):
+        [point] = revenue_series('day', self.day, self.day)
+        return point['revenue'], point['orders']
+
+    def test_closed_bucket_is_cached_until_an_order_in_it_changes(self):
+        self.assertEqual(self.revenue(), (Decimal('10.00'), 1))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.revenue(), (Decimal('10.00'), 1))
+        self.add_order(5).save()
+        self.assertEqual(self.revenue(), (Decimal('15.00'), 2))
+
+    def test_line_item_writes_drop_the_cached_bucket(self):
+        widget = Product.objects.create(name="Widget", price=5, stock=10)
+        order = self.add_order(0)
+        self.assertEqual(self.revenue(), (Decimal('10.00'), 2))
+        order.add_items([OrderItem(product=widget, quantity=1)])
+        self.assertEqual(self.revenue(), (Decimal('15.00'), 2))
+        item = order.items.get()
+        item.quantity = 3
+        item.save()
+        self.assertEqual(self.revenue(), (Decimal('25.00'), 2))
+        item.delete()
+        self.assertEqual(self.revenue(), (Decimal('10.00'), 2))
+
+    def test_bulk_created_orders_drop_the_cached_bucket(self):
+        self.assertEqual(self.revenue(), (Decimal('10.00'), 1))
+        bulk_create_orders([Order(customer=self.customer, order_date=self.day, total_amount=2)])
+        self.assertEqual(self.revenue(), (Decimal('12.00'), 2))
+
+    def test_queryset_updates_need_a_manual_invalidate(self):
+        self.assertEqual(self.revenue(), (Decimal('10.00'), 1))
+        Order.objects.filter(customer=self.customer).update(total_amount=40)
+        self.assertEqual(self.revenue(), (Decimal('10.00'), 1))
+        invalidate_revenue(self.day)
+        self.assertEqual(self.revenue(), (Decimal('40.00'), 1))
+
+    @skipUnless(importlib.util.find_spec('numpy'), "numpy is not installed")
+    def test_numpy_engine_matches_sql(self):
+        other = Customer.objects.create(name="Bob", email="bob@example.com")
+        widget = Product.objects.create(name="Widget", price=5, stock=100)
+        gadget = Product.objects.create(name="Gadget", price=Decimal('12.50'), stock=100)
+        now = timezone.now()
+        for customer, days, quantities in [
+            (self.customer, 6, (1, 2)), (other, 12, (3, 0)), (other, 40, (0, 1)), (self.customer, 70, (2, 2)),
+        ]:
+            order = Order.objects.create(customer=customer)
+            order.add_items([
+                OrderItem(product=product, quantity=quantity)
+                for product, quantity in zip((widget, gadget), quantities) if quantity
+            ])
+            Order.objects.filter(pk=order.pk).update(order_date=now - timedelta(days=days))
+        archive_orders(now - timedelta(days=50))
+
+        def series(engine, granularity, group_by):
+            cache.clear()  # cached buckets do not record the engine that filled them
+            points = revenue_series(granularity, now - timedelta(days=90), now, group_by=group_by, engine=engine)
+            return sorted((p['bucket'], p['key'] or 0, p['revenue'], p['orders']) for p in points)
+
+        for granularity in ('day', 'week', 'month'):
+            for group_by in (None, 'product', 'customer'):
+                with self.subTest(granularity=granularity, group_by=group_by):
+                    self.assertEqual(series('numpy', granularity, group_by), series('sql', granularity, group_by))
+
+
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def post(self, operation_name):
+        body = json.dumps({'query': f'query {operation_name} {{ hello }}', 'operationName': operation_name})
+        return self.client.post('/graphql', body, content_type='application/json')
+
+    def test_profiles_named_operations_into_a_bounded_ring(self):
+        with override_settings(CRM_PROFILE_DIR=self.directory, CRM_PROFILE_OPERATIONS=['Slow'], CRM_PROFILE_KEEP=2):
+            self.assertNotIn('X-CRM-Profile-Id', self.post('Fast'))
+            ids = [self.post('Slow')['X-CRM-Profile-Id'] for _ in range(3)]
+            self.assertEqual(list_profile_ids(), ids[1:])
+            profile = load_profile(ids[-1])
+        self.assertEqual((profile['operations'], profile['reason'], profile['status']), (['Slow'], 'operation', 200))
+
+
+class SlowQueryLogTests(TestCase):
+    def test_normalize_collapses_literals_in_lists_and_or_chains(self):
+        self.assertEqual(
+            normalize("SELECT a FROM t WHERE (id = 1 OR id = 2 OR id = 3) AND b IN (%s, %s) LIMIT 21"),
+            "SELECT a FROM t WHERE (id = ? OR ...) AND b IN (...) LIMIT ?",
+        )
+
+    def test_logs_slow_selects_with_operation_path_and_plan(self):
+        Product.objects.create(name="Widget", price=5, stock=3)
+        body = json.dumps({'query': 'query Stock { allProducts(first: 1) { edges { node { id } } } }', 'operationName': 'Stock'})
+        with override_settings(CRM_SLOW_QUERY_MS=0), mock.patch('crm.slowlog._report') as report:
+            self.client.post('/graphql', body, content_type='application/json')
+        entries = [call.args[0] for call in report.call_args_list if call.args[0]['operation'] == 'Stock']
+        self.assertTrue(entries)
+        entry = entries[0]
+        self.assertTrue(entry['path'].startswith('allProducts'))
+        self.assertEqual(len(entry['fingerprint']), 12)
+        self.assertTrue(entry['plan'])
+
+
+class QueryBudgetTests(TestCase):
+    def test_every_operation_stays_within_its_query_budget(self):
+        failures = check_query_budgets(schema)
+        self.assertFalse(failures, "\n" + "\n".join(failures))
+
+
+class StartupBudgetTests(SimpleTestCase):
+    def test_worker_and_cron_start_within_import_budget(self):
+        failures = check_startup_budgets()
+        self.assertFalse(failures, "\n" + "\n".join(failures))
+
+
+class ConcurrentOrderStressTest(TransactionTestCase):
+    """
+    Hammer the createOrder mutation from several threads against a product
+    with less stock than requested in total, then check that stock runs out
+    exactly, never goes negative and matches the quantities actually
+    ordered. Concurrent order throughput is measured by the
+    create_order_concurrent benchmark (crm_benchmark).
+    """
+    threads = 8
+    orders_per_thread = 25
+    initial_stock = 120
+
+    def test_no_overselling_under_concurrency(self):
+        customer = Customer.objects.create(name="Stress", email="stress@example.com")
+        product = Product.objects.create(name="Hot item", price=10, stock=self.initial_stock)
+        results = {'ok': 0, 'sold_out': 0, 'error': 0}
+        lock = threading.Lock()
+
+        mutation = """
+            mutation($customer: ID!, $product: ID!) {
+              createOrder(customerId: $customer, items: [{productId: $product, quantity: 1}]) { order { id } }
+            }
+        """
+        variables = {'customer': customer.pk, 'product': product.pk}
+
+        def place_orders():
+            for _ in range(self.orders_per_thread):
+                # Retry SQLite writer contention ("database (table) is
+                # locked") until the order is placed or refused
+                outcome = 'error'
+                for _attempt in range(1000):
+                    result = schema.execute(mutation, variable_values=variables)
+                    if not result.errors:
+                        outcome = 'ok'
+                        break
+                    message = str(result.errors[0])
+                    if 'Insufficient stock' in message:
+                        outcome = 'sold_out'
+                        break
+                    if 'locked' not in message:
+                        break
+                    time.sleep(0.001)
+                with lock:
+                    results[outcome] += 1
+            connection.close()
+
+        workers = [threading.Thread(target=place_orders) for _ in range(self.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        product.refresh_from_db()
+        ordered = sum(OrderItem.objects.filter(product=product).values_list('quantity', flat=True))
+        self.assertEqual(results['error'], 0)
+        self.assertEqual(sum(results.values()), self.threads * self.orders_per_thread)
+        # Every unit sold exactly once, and the rest refused by the guard
+        self.assertEqual(product.stock, 0)
+        self.assertEqual(ordered, results['ok'])
+        self.assertEqual(results['ok'], self.initial_stock)
+        self.assertEqual(results['sold_out'], self.threads * self.orders_per_thread - self.initial_stock)
@@ -1,3 +1,236 @@
-from django.shortcuts import render
+import csv
+import json
+import zlib
+from functools import lru_cache
+
+from django.conf import settings
+from django.http import HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from graphene_django.views import GraphQLView, HttpError
+from graphql import GraphQLError, OperationType, get_operation_ast, parse
+
+from . import entity_cache, health
+from .filters import CustomerFilter, ProductFilter, OrderFilter
+from .models import Customer, Product, Order
 
 # Create your views here.
+
+# Largest number of operations accepted in one batched /graphql request
+# (override with the GRAPHQL_MAX_BATCH_SIZE setting).
+GRAPHQL_MAX_BATCH_SIZE = 20
+
+EXPORT_CHUNK_SIZE = 2000
+MAX_EXPORT_CHUNK_SIZE = 10000
+# Rows are grouped into blocks of roughly this many bytes before being
+# written out, so each yield is one reasonably sized write.
+EXPORT_BUFFER_SIZE = 64 * 1024
+
+
+def _customer_rows(queryset, chunk_size):
+    return queryset.values_list('id', 'name', 'email', 'phone', 'created_at').iterator(chunk_size=chunk_size)
+
+
+def _product_rows(queryset, chunk_size):
+    return queryset.values_list('id', 'name', 'price', 'stock').iterator(chunk_size=chunk_size)
+
+
+def _order_rows(queryset, chunk_size):
+    queryset = queryset.select_related('customer').prefetch_related('items')
+    for o in queryset.iterator(chunk_size=chunk_size):
+        items = list(o.items.all())
+        yield (
+            o.pk, o.customer_id, o.customer.email, o.order_date, o.total_amount,
+            ' '.join(str(i.product_id) for i in items),
+            ' '.join(str(i.quantity) for i in items),
+            ' '.join(str(i.unit_price) for i in items),
+        )
+
+
+EXPORTS = {
+    'customers': (Customer, CustomerFilter, ('id', 'name', 'email', 'phone', 'created_at'), _customer_rows),
+    'products': (Product, ProductFilter, ('id', 'name', 'price', 'stock'), _product_rows),
+    'orders': (Order, OrderFilter, ('id', 'customer_id', 'customer_email', 'order_date', 'total_amount',
+                                    'product_ids', 'quantities', 'unit_prices'), _order_rows),
+}
+
+
+class _Echo:
+    """File-like object whose write() just hands the value back, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (int, str)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _encode_csv(header, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _encode_ndjson(header, rows):
+    for row in rows:
+        yield json.dumps({k: _json_value(v) for k, v in zip(header, row)}) + '\n'
+
+
+def _buffered(lines, compress=False):
+    """Join encoded lines into ~EXPORT_BUFFER_SIZE blocks, gzipping them if asked."""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buf, size = [], 0
+    for line in lines:
+        buf.append(line)
+        size += len(line)
+        if size >= EXPORT_BUFFER_SIZE:
+            data = ''.join(buf).encode('utf-8')
+            buf, size = [], 0
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+    data = ''.join(buf).encode('utf-8')
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+@require_GET
+def export(request, entity):
+    """
+    Stream customers, products or orders as CSV or NDJSON.
+
+    Query parameters are the CustomerFilter/ProductFilter/OrderFilter fields
+    (e.g. ?low_stock=true&price__gte=10), plus:
+      format=csv|ndjson  output format (default csv)
+      gzip=1             gzip the stream
+      chunk_size=N       rows fetched per database round trip
+    Rows are walked with iterator() so memory stays flat regardless of size.
+    """
+    if entity not in EXPORTS:
+        return JsonResponse({'error': f"Unknown export '{entity}'"}, status=404)
+    model, filterset_class, header, rows = EXPORTS[entity]
+
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return JsonResponse({'error': "format must be 'csv' or 'ndjson'"}, status=400)
+    compress = request.GET.get('gzip', '').lower() in ('1', 'true', 'yes')
+    try:
+        chunk_size = min(int(request.GET.get('chunk_size', EXPORT_CHUNK_SIZE)), MAX_EXPORT_CHUNK_SIZE)
+    except ValueError:
+        return JsonResponse({'error': 'chunk_size must be an integer'}, status=400)
+    if chunk_size < 1:
+        return JsonResponse({'error': 'chunk_size must be positive'}, status=400)
+
+    filterset = filterset_class(data=request.GET, queryset=model.objects.order_by('pk'), request=request)
+    if not filterset.is_valid():
+        return JsonResponse({'errors': filterset.errors}, status=400)
+
+    encode = _encode_csv if fmt == 'csv' else _encode_ndjson
+    stream = _buffered(encode(header, rows(filterset.qs, chunk_size)), compress=compress)
+
+    filename = f'{entity}.{fmt}'
+    if compress:
+        content_type = 'application/gzip'
+        filename += '.gz'
+    elif fmt == 'csv':
+        content_type = 'text/csv; charset=utf-8'
+    else:
+        content_type = 'application/x-ndjson; charset=utf-8'
+    response = StreamingHttpResponse(stream, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@require_GET
+def healthz(request):
+    """
+    Liveness: the process is up and serving requests. Does no I/O; also
+    reports this process's entity cache hit rates.
+    """
+    return JsonResponse({'status': 'ok', 'entity_cache': entity_cache.stats()})
+
+
+@require_GET
+def readyz(request):
+    """
+    Readiness: database and Celery broker reachable, queue depth reported.
+    503 when a dependency is down; a deep queue is 'degraded' but still 200.
+    Results are cached briefly (CRM_HEALTH_CACHE_SECONDS), see crm.health.
+    """
+    result = health.run_checks()
+    return JsonResponse(result, status=503 if result['status'] == 'fail' else 200)
+
+
+@lru_cache(maxsize=256)
+def _operation_type(query, operation_name):
+    try:
+        operation = get_operation_ast(parse(query), operation_name)
+    except GraphQLError:
+        return None
+    return operation.operation if operation else None
+
+
+class CRMGraphQLView(GraphQLView):
+    """
+    GraphQLView that also accepts batched requests on the same route.
+
+    A JSON object body is handled exactly as before. A JSON array of
+    operations is executed in order and answered with a 200 and an array of
+    results, each with its own "id" and "status". All operations in a batch share
+    the request, so they also share its database connection and the
+    per-request order summary loader. Identical queries in one batch run
+    once; after a mutation the loader and that reuse are reset so later
+    operations see its writes.
+    """
+
+    def parse_body(self, request):
+        if self.get_content_type(request) == 'application/json' and request.body.lstrip()[:1] == b'[':
+            self.batch = True
+        data = super().parse_body(request)
+        if self.batch:
+            limit = getattr(settings, 'GRAPHQL_MAX_BATCH_SIZE', GRAPHQL_MAX_BATCH_SIZE)
+            if len(data) > limit:
+                raise HttpError(HttpResponseBadRequest(
+                    f"Batch of {len(data)} operations exceeds the limit of {limit}."
+                ))
+            if not all(isinstance(entry, dict) for entry in data):
+                raise HttpError(HttpResponseBadRequest("Every batch entry must be a JSON object."))
+            self._batch_results = {}
+        return data
+
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        # Per-operation failures are reported in each entry's "status"; the
+        # batch itself succeeded if it produced an array of results.
+        if self.batch and response.status_code == 400 and response.content[:1] == b'[':
+            response.status_code = 200
+        return response
+
+    def can_display_graphiql(self, request, data):
+        return not self.batch and super().can_display_graphiql(request, data)
+
+    def get_response(self, request, data, show_graphiql=False):
+        if not self.batch:
+            return super().get_response(request, data, show_graphiql)
+
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+        operation = _operation_type(query, operation_name) if query else None
+        key = (query, json.dumps(variables, sort_keys=True), operation_name, id)
+        if operation == OperationType.QUERY and key in self._batch_results:
+            return self._batch_results[key]
+
+        response = super().get_response(request, data, show_graphiql)
+        if operation == OperationType.QUERY:
+            self._batch_results[key] = response
+        elif operation == OperationType.MUTATION:
+            self._batch_results.clear()
+            request.__dict__.pop('_order_summary_loader', None)
+        return response
@@ -0,0 +1,150 @@
+"""
+ASGI WebSocket endpoint speaking the graphql-transport-ws protocol
+(https://github.com/enisdenjo/graphql-ws/blob/master/PROTOCOL.md), the one
+used by GraphiQL and the `graphql-ws` client library.
+
+Subscriptions run on the event loop and read events from crm.subscriptions;
+queries and mutations sent over the socket are executed in Django's sync
+thread like any other request.
+"""
+
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from graphql import ExecutionResult, GraphQLError, OperationType, get_operation_ast, parse
+
+PROTOCOL = 'graphql-transport-ws'
+CONNECTION_INIT_TIMEOUT = 10
+
+
+class GraphQLWebSocketApp:
+    def __init__(self, schema):
+        self.schema = schema
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        if PROTOCOL not in scope.get('subprotocols', ()):
+            await send({'type': 'websocket.close', 'code': 4406})
+            return
+        await send({'type': 'websocket.accept', 'subprotocol': PROTOCOL})
+        await _Connection(self.schema, scope, receive, send).run()
+
+
+class _Connection:
+    def __init__(self, schema, scope, receive, send):
+        self.schema = schema
+        self.scope = scope
+        self.receive = receive
+        self._send = send
+        self.acknowledged = False
+        self.closed = False
+        self.operations = {}
+
+    async def send(self, message):
+        if not self.closed:
+            await self._send({'type': 'websocket.send', 'text': json.dumps(message)})
+
+    async def close(self, code, reason=''):
+        if not self.closed:
+            self.closed = True
+            await self._send({'type': 'websocket.close', 'code': code, 'reason': reason})
+
+    async def run(self):
+        init_timeout = asyncio.get_running_loop().call_later(
+            CONNECTION_INIT_TIMEOUT,
+            lambda: None if self.acknowledged else asyncio.ensure_future(
+                self.close(4408, 'Connection initialisation timeout')
+            ),
+        )
+        try:
+            while not self.closed:
+                event = await self.receive()
+                if event['type'] == 'websocket.disconnect':
+                    self.closed = True
+                elif event['type'] == 'websocket.receive':
+                    await self.handle(event.get('text') or (event.get('bytes') or b'').decode())
+        finally:
+            init_timeout.cancel()
+            for task in self.operations.values():
+                task.cancel()
+
+    async def handle(self, text):
+        try:
+            message = json.loads(text)
+            kind = message['type']
+        except (ValueError, TypeError, KeyError):
+            await self.close(4400, 'Invalid message')
+            return
+
+        if kind == 'connection_init':
+            if self.acknowledged:
+                await self.close(4429, 'Too many initialisation requests')
+                return
+            self.acknowledged = True
+            await self.send({'type': 'connection_ack'})
+        elif kind == 'ping':
+            await self.send({'type': 'pong'})
+        elif kind == 'pong':
+            pass
+        elif kind == 'subscribe':
+            if not self.acknowledged:
+                await self.close(4401, 'Unauthorized')
+                return
+            id = message.get('id')
+            payload = message.get('payload')
+            if not isinstance(id, str) or not isinstance(payload, dict):
+                await self.close(4400, 'Invalid subscribe message')
+                return
+            if id in self.operations:
+                await self.close(4409, f'Subscriber for {id} already exists')
+                return
+            self.operations[id] = asyncio.ensure_future(self.execute(id, payload))
+        elif kind == 'complete':
+            task = self.operations.pop(message.get('id'), None)
+            if task:
+                task.cancel()
+        else:
+            await self.close(4400, f'Unknown message type {kind!r}')
+
+    async def execute(self, id, payload):
+        query = payload.get('query') or ''
+        variables = payload.get('variables')
+        operation_name = payload.get('operationName')
+        try:
+            operation = get_operation_ast(parse(query), operation_name)
+        except GraphQLError as e:
+            await self.send({'type': 'error', 'id': id, 'payload': [e.formatted]})
+            self.operations.pop(id, None)
+            return
+
+        try:
+            if operation is not None and operation.operation == OperationType.SUBSCRIPTION:
+                result = await self.schema.subscribe(
+                    query, variable_values=variables, operation_name=operation_name, context_value=self.scope,
+                )
+                if isinstance(result, ExecutionResult):
+                    await self.send({'type': 'error', 'id': id, 'payload': [e.formatted for e in result.errors]})
+                    return
+                try:
+                    async for item in result:
+                        await self.send({'type': 'next', 'id': id, 'payload': _format(item)})
+                finally:
+                    await result.aclose()
+            else:
+                result = await sync_to_async(self.schema.execute)(
+                    query, variable_values=variables, operation_name=operation_name, context_value=None,
+                )
+                await self.send({'type': 'next', 'id': id, 'payload': _format(result)})
+            await self.send({'type': 'complete', 'id': id})
+        finally:
+            self.operations.pop(id, None)
+
+
+def _format(result):
+    payload = {'data': result.data}
+    if result.errors:
+        payload['errors'] = [e.formatted for e in result.errors]
+    return payload